@@ -0,0 +1,582 @@
+"""Load and scaling benchmark for the Secret Garden journal server.
+
+Seeds a throwaway database with a synthetic dataset, starts ``journal.py``
+on it as a subprocess, drives it with a weighted mix of real API requests
+from several client processes and reports throughput and latency
+percentiles per scenario. Results can be saved as a JSON baseline and later
+runs compared against it; the exit status is 1 when a run regresses.
+
+Run locally:
+    python bench_journal.py --rows 100000 --mode threaded --save baseline.json
+    python bench_journal.py --rows 100000 --mode threaded --baseline baseline.json
+
+Clients and server share the machine, so compare runs from the same host
+only. Anonymous posts and logins come from a fresh 127.x.y.z address each
+(Linux routes all of 127/8 to loopback) so per-IP rate limits behave as they
+would with real visitors; elsewhere they fall back to 127.0.0.1 and are
+mostly answered with 429.
+"""
+from __future__ import annotations
+
+import argparse
+import http.client
+import json
+import os
+import platform
+import random
+import signal
+import socket
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+from urllib.parse import quote
+
+import journal
+
+JOURNAL = Path(__file__).parent / "journal.py"
+BENCH_PASSWORD = "bench-password"
+SERVER_READY_TIMEOUT = 60  # seconds the server (and its workers) get to start answering
+CLIENT_TIMEOUT = 30  # seconds before a single request counts as failed
+SEED_BATCH = 10_000  # rows per executemany while seeding
+# rows seeded per diary row for the other tables
+DATASET_RATIOS = {"users": 0.02, "messages_public": 1.0, "messages_private": 0.5, "messages_user": 0.5}
+MIN_USERS = 20
+WORDS = (
+    "月光 花园 夜色 秘密 星星 微风 晚安 梦境 清晨 雨声 玫瑰 小径 灯火 温柔 远方 记忆 "
+    "garden moon letter quiet river lantern morning story"
+).split()
+SEARCH_TERMS = ("月光", "花园", "秘密 星星", "garden", "晚安", "lantern", "雨声 玫瑰")
+# scenario -> relative weight in the default client mix
+DEFAULT_MIX = {
+    "public_diaries": 30,
+    "public_messages": 12,
+    "public_user_messages": 5,
+    "search_diaries": 5,
+    "login": 3,
+    "auth_me": 5,
+    "secret_diaries": 12,
+    "diary_write": 10,
+    "public_message_post": 5,
+    "admin_summary": 8,
+    "admin_diaries": 3,
+    "admin_messages": 2,
+}
+
+
+def _text(rng, low, high):
+    return " ".join(rng.choice(WORDS) for _ in range(rng.randint(low, high)))
+
+
+def _timestamps(count, rng, span):
+    """``count`` ascending 'YYYY-MM-DD HH:MM:SS' stamps spread over the last ``span`` seconds."""
+    start = time.time() - span
+    step = span / max(count, 1)
+    for i in range(count):
+        yield time.strftime("%Y-%m-%d %H:%M:%S", time.gmtime(start + i * step + rng.random() * step))
+
+
+def seed_database(path, rows, seed):
+    """Create ``path`` with ``rows`` diaries and proportionally sized other tables.
+
+    Every user shares BENCH_PASSWORD and owns one long-lived session.
+    Rows go through the real schema and triggers (stats counters, FTS).
+    """
+    rng = random.Random(seed)
+    journal.DB_PATH = Path(path)
+    journal.init_db()
+    conn = journal.connect_db()
+    counts = {table: max(1, int(rows * ratio)) for table, ratio in DATASET_RATIOS.items()}
+    counts["users"] = max(MIN_USERS, counts["users"])
+    users = [f"user{i:06d}" for i in range(counts["users"])]
+    password_hash = journal.hash_password(BENCH_PASSWORD)
+    span = 365 * 24 * 3600
+    expires_at = time.time() + journal.SESSION_TTL
+
+    def batched(sql, params):
+        batch = []
+        for item in params:
+            batch.append(item)
+            if len(batch) >= SEED_BATCH:
+                conn.executemany(sql, batch)
+                batch.clear()
+        if batch:
+            conn.executemany(sql, batch)
+
+    with conn:
+        batched(
+            "INSERT INTO users (username, role, password_hash, registration_ip) VALUES (?, 'user', ?, '127.0.0.1')",
+            ((name, password_hash) for name in users),
+        )
+        batched(
+            "INSERT INTO sessions (token, role, username, expires_at) VALUES (?, 'user', ?, ?)",
+            ((f"bench-{rng.getrandbits(96):024x}", name, expires_at) for name in users),
+        )
+        batched(
+            "INSERT INTO diaries (author_name, title, content, is_public, created_at, updated_at) VALUES (?, ?, ?, ?, ?, ?)",
+            (
+                (rng.choice(users), _text(rng, 1, 4), _text(rng, 20, 200), int(rng.random() < 0.3), at, at)
+                for at in _timestamps(rows, rng, span)
+            ),
+        )
+        batched(
+            "INSERT INTO messages_public (nickname, content, is_hidden, created_at) VALUES (?, ?, ?, ?)",
+            (
+                (f"guest{rng.randint(1, 9999)}", _text(rng, 3, 30), int(rng.random() < 0.05), at)
+                for at in _timestamps(counts["messages_public"], rng, span)
+            ),
+        )
+        batched(
+            "INSERT INTO messages_private (from_name, to_name, content, created_at) VALUES (?, ?, ?, ?)",
+            (
+                (rng.choice(users), rng.choice(users), _text(rng, 3, 40), at)
+                for at in _timestamps(counts["messages_private"], rng, span)
+            ),
+        )
+        batched(
+            "INSERT INTO messages_user (username, content, created_at) VALUES (?, ?, ?)",
+            ((rng.choice(users), _text(rng, 3, 30), at) for at in _timestamps(counts["messages_user"], rng, span)),
+        )
+        conn.execute(
+            "INSERT INTO sessions (token, role, username, expires_at) VALUES (?, 'admin', 'admin', ?)",
+            (f"bench-admin-{rng.getrandbits(96):024x}", expires_at),
+        )
+        conn.execute("INSERT OR REPLACE INTO settings (key, value) VALUES ('bench_rows', ?)", (str(rows),))
+    conn.execute("PRAGMA optimize")
+    journal.close_db_connections()
+    return {"diaries": rows, **counts}
+
+
+def load_credentials(path):
+    """(user sessions, admin token) from a seeded database."""
+    conn = sqlite3.connect(path)
+    try:
+        users = conn.execute(
+            "SELECT username, token FROM sessions WHERE role='user' AND token LIKE 'bench-%' ORDER BY username"
+        ).fetchall()
+        admin = conn.execute("SELECT token FROM sessions WHERE role='admin' AND token LIKE 'bench-%'").fetchone()
+        return users, admin[0]
+    finally:
+        conn.close()
+
+
+def seeded_rows(path):
+    conn = sqlite3.connect(path)
+    try:
+        row = conn.execute("SELECT value FROM settings WHERE key='bench_rows'").fetchone()
+        return int(row[0]) if row else None
+    except sqlite3.Error:
+        return None
+    finally:
+        conn.close()
+
+
+# each scenario returns (method, path, body, token, fresh_ip)
+def _public_diaries(rng, ctx):
+    return "GET", "/api/public/diaries", None, None, False
+
+
+def _public_messages(rng, ctx):
+    return "GET", "/api/public/messages", None, None, False
+
+
+def _public_user_messages(rng, ctx):
+    return "GET", "/api/public/user-messages", None, None, False
+
+
+def _search_diaries(rng, ctx):
+    return "GET", f"/api/public/search/diaries?q={quote(rng.choice(SEARCH_TERMS))}", None, None, False
+
+
+def _login(rng, ctx):
+    body = {"username": rng.choice(ctx["users"])[0], "password": BENCH_PASSWORD}
+    return "POST", "/api/auth/login", body, None, True
+
+
+def _auth_me(rng, ctx):
+    return "GET", "/api/auth/me", None, rng.choice(ctx["users"])[1], False
+
+
+def _secret_diaries(rng, ctx):
+    return "GET", "/api/secret/diaries", None, rng.choice(ctx["users"])[1], False
+
+
+def _diary_write(rng, ctx):
+    body = {"title": _text(rng, 1, 4), "content": _text(rng, 20, 200), "is_public": rng.random() < 0.3}
+    return "POST", "/api/secret/diaries", body, rng.choice(ctx["users"])[1], False
+
+
+def _public_message_post(rng, ctx):
+    body = {"nickname": f"guest{rng.randint(1, 9999)}", "content": _text(rng, 3, 30)}
+    return "POST", "/api/public/messages", body, None, True
+
+
+def _admin_summary(rng, ctx):
+    return "GET", "/api/admin/summary", None, ctx["admin"], False
+
+
+def _admin_diaries(rng, ctx):
+    return "GET", "/api/admin/diaries?limit=200", None, ctx["admin"], False
+
+
+def _admin_messages(rng, ctx):
+    return "GET", "/api/admin/messages/public?limit=200", None, ctx["admin"], False
+
+
+SCENARIOS = {
+    "public_diaries": _public_diaries,
+    "public_messages": _public_messages,
+    "public_user_messages": _public_user_messages,
+    "search_diaries": _search_diaries,
+    "login": _login,
+    "auth_me": _auth_me,
+    "secret_diaries": _secret_diaries,
+    "diary_write": _diary_write,
+    "public_message_post": _public_message_post,
+    "admin_summary": _admin_summary,
+    "admin_diaries": _admin_diaries,
+    "admin_messages": _admin_messages,
+}
+
+
+def _random_loopback(rng):
+    return f"127.{rng.randint(1, 254)}.{rng.randint(0, 255)}.{rng.randint(1, 254)}"
+
+
+def spread_ips_supported():
+    try:
+        with socket.socket() as probe:
+            probe.bind(("127.23.45.67", 0))
+        return True
+    except OSError:
+        return False
+
+
+def _request(conn, method, path, body, token):
+    headers = {"Accept-Encoding": "identity"}
+    data = None
+    if body is not None:
+        data = json.dumps(body).encode()
+        headers["Content-Type"] = "application/json"
+    if token:
+        headers["Authorization"] = f"Bearer {token}"
+    conn.request(method, path, body=data, headers=headers)
+    response = conn.getresponse()
+    response.read()
+    return response.status
+
+
+def _client_thread(ctx, seed, results):
+    rng = random.Random(seed)
+    names = list(ctx["mix"])
+    weights = list(ctx["mix"].values())
+    host, port = ctx["host"], ctx["port"]
+    conn = http.client.HTTPConnection(host, port, timeout=CLIENT_TIMEOUT)
+    while True:
+        started_at = time.time()
+        if started_at >= ctx["stop_at"]:
+            break
+        name = rng.choices(names, weights)[0]
+        method, path, body, token, fresh_ip = SCENARIOS[name](rng, ctx)
+        target = conn
+        if fresh_ip and ctx["spread_ips"]:
+            target = http.client.HTTPConnection(
+                host, port, timeout=CLIENT_TIMEOUT, source_address=(_random_loopback(rng), 0)
+            )
+        started = time.perf_counter()
+        try:
+            status = _request(target, method, path, body, token)
+        except (OSError, http.client.HTTPException):
+            status = 0
+            target.close()
+        elapsed = time.perf_counter() - started
+        if target is not conn:
+            target.close()
+        if started_at >= ctx["record_at"]:
+            latencies, statuses = results.setdefault(name, ([], Counter()))
+            latencies.append(elapsed)
+            statuses[status] += 1
+    conn.close()
+
+
+def run_client(ctx, index):
+    """One client process: ``ctx["threads"]`` threads issuing requests until ``stop_at``."""
+    per_thread = [{} for _ in range(ctx["threads"])]
+    threads = [
+        threading.Thread(target=_client_thread, args=(ctx, ctx["seed"] * 1000 + index * 100 + i, results))
+        for i, results in enumerate(per_thread)
+    ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    merged = {}
+    for results in per_thread:
+        for name, (latencies, statuses) in results.items():
+            into = merged.setdefault(name, ([], Counter()))
+            into[0].extend(latencies)
+            into[1].update(statuses)
+    return merged
+
+
+def _percentile(ordered, fraction):
+    if not ordered:
+        return 0.0
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+
+def summarize(merged, duration):
+    routes = {}
+    total = errors = 0
+    for name in sorted(merged):
+        latencies, statuses = merged[name]
+        ordered = sorted(latencies)
+        failed = sum(count for status, count in statuses.items() if status == 0 or status >= 500)
+        total += len(ordered)
+        errors += failed
+        routes[name] = {
+            "requests": len(ordered),
+            "errors": failed,
+            "statuses": {str(status): count for status, count in sorted(statuses.items())},
+            "rps": round(len(ordered) / duration, 1),
+            "mean_ms": round(sum(ordered) / len(ordered) * 1000, 3) if ordered else 0.0,
+            "p50_ms": round(_percentile(ordered, 0.50) * 1000, 3),
+            "p90_ms": round(_percentile(ordered, 0.90) * 1000, 3),
+            "p99_ms": round(_percentile(ordered, 0.99) * 1000, 3),
+            "max_ms": round(ordered[-1] * 1000, 3) if ordered else 0.0,
+        }
+    return {"requests": total, "errors": errors, "rps": round(total / duration, 1)}, routes
+
+
+class Server:
+    """``journal.py`` running as a subprocess on a free local port."""
+
+    def __init__(self, db, args):
+        with socket.socket() as probe:
+            probe.bind(("127.0.0.1", 0))
+            self.port = probe.getsockname()[1]
+        self.log = tempfile.NamedTemporaryFile("w+", prefix="bench-server-", suffix=".log", delete=False)
+        argv = [
+            sys.executable, str(JOURNAL),
+            "--db", str(db),
+            "--host", "127.0.0.1",
+            "--port", str(self.port),
+            "--mode", args.mode,
+            "--workers", str(args.workers),
+            "--processes", str(args.processes),
+            *args.server_arg,
+        ]
+        self.process = subprocess.Popen(argv, stdout=self.log, stderr=subprocess.STDOUT)
+
+    def wait_ready(self):
+        deadline = time.monotonic() + SERVER_READY_TIMEOUT
+        while time.monotonic() < deadline:
+            if self.process.poll() is not None:
+                break
+            try:
+                conn = http.client.HTTPConnection("127.0.0.1", self.port, timeout=2)
+                if _request(conn, "GET", "/api/public/diaries", None, None) == 200:
+                    conn.close()
+                    return
+            except (OSError, http.client.HTTPException):
+                time.sleep(0.2)
+        self.stop()
+        raise SystemExit(f"server did not start; see {self.log.name}")
+
+    def metrics(self, admin_token):
+        conn = http.client.HTTPConnection("127.0.0.1", self.port, timeout=CLIENT_TIMEOUT)
+        try:
+            conn.request("GET", "/api/admin/metrics", headers={"Authorization": f"Bearer {admin_token}"})
+            response = conn.getresponse()
+            return json.loads(response.read()) if response.status == 200 else None
+        except (OSError, http.client.HTTPException, ValueError):
+            return None
+        finally:
+            conn.close()
+
+    def stop(self):
+        if self.process.poll() is None:
+            self.process.send_signal(signal.SIGTERM)
+            try:
+                self.process.wait(journal.WORKER_STOP_TIMEOUT)
+            except subprocess.TimeoutExpired:
+                self.process.kill()
+                self.process.wait()
+        self.log.close()
+
+
+def compare(result, baseline, tolerance, noise_ms):
+    """Regressions of ``result`` against ``baseline``, as printable lines."""
+    regressions = []
+    for key in ("rows", "mode", "processes", "workers", "concurrency", "mix"):
+        if result["config"].get(key) != baseline["config"].get(key):
+            print(f"warning: baseline was run with {key}={baseline['config'].get(key)!r}, this run {result['config'].get(key)!r}")
+    base_rps, rps = baseline["total"]["rps"], result["total"]["rps"]
+    if rps < base_rps * (1 - tolerance):
+        regressions.append(f"throughput: {rps} req/s vs {base_rps} req/s")
+    for name, route in result["routes"].items():
+        base = baseline["routes"].get(name)
+        if not base:
+            continue
+        for key in ("p50_ms", "p99_ms"):
+            if route[key] > base[key] * (1 + tolerance) and route[key] - base[key] > noise_ms:
+                regressions.append(f"{name} {key[:-3]}: {route[key]} ms vs {base[key]} ms")
+        error_rate = route["errors"] / max(route["requests"], 1)
+        base_error_rate = base["errors"] / max(base["requests"], 1)
+        if error_rate > base_error_rate + 0.01:
+            regressions.append(f"{name} errors: {error_rate:.1%} vs {base_error_rate:.1%}")
+    return regressions
+
+
+def print_report(result, baseline=None):
+    header = f"{'scenario':<22}{'requests':>9}{'req/s':>9}{'p50':>9}{'p90':>9}{'p99':>9}{'max':>9}  statuses"
+    print(header)
+    print("-" * len(header))
+    for name, route in result["routes"].items():
+        line = (
+            f"{name:<22}{route['requests']:>9}{route['rps']:>9}"
+            f"{route['p50_ms']:>9.2f}{route['p90_ms']:>9.2f}{route['p99_ms']:>9.2f}{route['max_ms']:>9.1f}  "
+            + " ".join(f"{status}:{count}" for status, count in route["statuses"].items())
+        )
+        base = (baseline or {}).get("routes", {}).get(name)
+        if base and base["p50_ms"]:
+            line += f"  (p50 {route['p50_ms'] / base['p50_ms'] - 1:+.0%} vs baseline)"
+        print(line)
+    total = result["total"]
+    print(f"total: {total['requests']} requests, {total['rps']} req/s, {total['errors']} errors (status 0 or 5xx)")
+
+
+def parse_mix(value):
+    mix = dict(DEFAULT_MIX)
+    for part in filter(None, value.split(",")):
+        name, _, weight = part.partition("=")
+        if name not in SCENARIOS:
+            raise argparse.ArgumentTypeError(f"unknown scenario {name!r} (choose from {', '.join(SCENARIOS)})")
+        mix[name] = float(weight)
+    return {name: weight for name, weight in mix.items() if weight > 0}
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the Secret Garden journal server")
+    parser.add_argument("--rows", type=int, default=10_000, help="diaries to seed; other tables are sized from it")
+    parser.add_argument("--db", type=Path, help="database to seed (default: a temporary file)")
+    parser.add_argument("--reuse-db", action="store_true", help="reuse --db if it was seeded with the same --rows")
+    parser.add_argument("--seed", type=int, default=1, help="random seed for the dataset and the request mix")
+    parser.add_argument("--mode", choices=("single", "threaded", "asyncio"), default="threaded")
+    parser.add_argument("--workers", type=int, default=journal.DEFAULT_WORKERS)
+    parser.add_argument("--processes", type=int, default=1, help="journal.py --processes")
+    parser.add_argument(
+        "--server-arg", action="append", default=[], help="extra journal.py argument, e.g. --server-arg=--group-commit"
+    )
+    parser.add_argument("--concurrency", type=int, default=32, help="client threads in total")
+    parser.add_argument("--client-processes", type=int, default=min(4, os.cpu_count() or 1))
+    parser.add_argument("--duration", type=float, default=20, help="measured seconds")
+    parser.add_argument("--warmup", type=float, default=3, help="seconds of load before measuring starts")
+    parser.add_argument(
+        "--mix", type=parse_mix, default=dict(DEFAULT_MIX), help="scenario weights to override, e.g. login=0,diary_write=30"
+    )
+    parser.add_argument("--save", type=Path, help="write the result as JSON (usable later as --baseline)")
+    parser.add_argument("--baseline", type=Path, help="compare against a saved result; exit 1 on regression")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="allowed relative slowdown before flagging")
+    parser.add_argument("--noise-ms", type=float, default=1.0, help="latency changes below this are never flagged")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    temporary = None
+    db = args.db
+    if db is None:
+        temporary = tempfile.TemporaryDirectory(prefix="bench-garden-")
+        db = Path(temporary.name) / "garden.db"
+    dataset = None
+    if not (args.reuse_db and db.exists() and seeded_rows(db) == args.rows):
+        if db.exists():
+            for suffix in ("", "-wal", "-shm"):
+                Path(f"{db}{suffix}").unlink(missing_ok=True)
+        started = time.perf_counter()
+        dataset = seed_database(db, args.rows, args.seed)
+        print(f"seeded {dataset} in {time.perf_counter() - started:.1f}s")
+    users, admin = load_credentials(db)
+
+    server = Server(db, args)
+    try:
+        server.wait_ready()
+        processes = max(1, min(args.client_processes, args.concurrency))
+        record_at = time.time() + 1 + args.warmup
+        ctx = {
+            "host": "127.0.0.1",
+            "port": server.port,
+            "mix": args.mix,
+            "users": users,
+            "admin": admin,
+            "seed": args.seed,
+            "spread_ips": spread_ips_supported(),
+            "record_at": record_at,
+            "stop_at": record_at + args.duration,
+        }
+        with ProcessPoolExecutor(processes) as pool:
+            futures = [
+                pool.submit(run_client, {**ctx, "threads": args.concurrency // processes + (i < args.concurrency % processes)}, i)
+                for i in range(processes)
+            ]
+            merged = {}
+            for future in futures:
+                for name, (latencies, statuses) in future.result().items():
+                    into = merged.setdefault(name, ([], Counter()))
+                    into[0].extend(latencies)
+                    into[1].update(statuses)
+        server_metrics = server.metrics(admin)
+    finally:
+        server.stop()
+        if temporary is not None:
+            temporary.cleanup()
+
+    total, routes = summarize(merged, args.duration)
+    result = {
+        "config": {
+            "rows": args.rows,
+            "mode": args.mode,
+            "processes": args.processes,
+            "workers": args.workers,
+            "server_args": args.server_arg,
+            "concurrency": args.concurrency,
+            "client_processes": processes,
+            "duration": args.duration,
+            "mix": args.mix,
+            "seed": args.seed,
+        },
+        "environment": {
+            "python": platform.python_version(),
+            "sqlite": sqlite3.sqlite_version,
+            "platform": platform.platform(),
+            "cpus": os.cpu_count(),
+        },
+        "recorded_at": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+        "dataset": dataset,
+        "total": total,
+        "routes": routes,
+        # one worker's view when --processes > 1
+        "server_metrics": server_metrics,
+    }
+    baseline = json.loads(args.baseline.read_text()) if args.baseline else None
+    print_report(result, baseline)
+    if args.save:
+        args.save.write_text(json.dumps(result, ensure_ascii=False, indent=2))
+        print(f"saved {args.save}")
+    if baseline is not None:
+        regressions = compare(result, baseline, args.tolerance, args.noise_ms)
+        for line in regressions:
+            print(f"REGRESSION {line}")
+        if regressions:
+            raise SystemExit(1)
+        print("no regressions against baseline")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,486 @@
+"""Bulk import and export for the Secret Garden database.
+
+Moves whole tables in and out of ``garden.db`` as NDJSON (one JSON object
+per line, the format of ``GET /api/admin/export``) or CSV with a header row,
+optionally gzip-compressed (``.gz``). Exports stream in id order with
+bounded memory; ``all`` writes every table from one consistent snapshot.
+
+Imports load in large batched transactions. By default the target table's
+secondary indexes and triggers are dropped for the load and rebuilt once at
+the end, together with the full-text index, the summary counters and the
+response-cache versions, so stop the server first. ``--online`` keeps
+everything in place and commits small batches so a running server only
+waits briefly for the write lock.
+
+Run locally:
+    python garden_io.py export all backup/
+    python garden_io.py import all backup/ --db /srv/garden/garden.db
+    python garden_io.py import diaries diaries.csv --on-conflict skip
+"""
+from __future__ import annotations
+
+import argparse
+import csv
+import gzip
+import json
+import sqlite3
+import sys
+import time
+from pathlib import Path
+
+import journal
+
+# columns moved per table, in dependency order; users carry their password hashes
+IO_TABLES = {
+    "users": (
+        "id", "username", "role", "password_hash", "registration_ip", "last_login_ip", "last_login_at", "created_at",
+    ),
+    **journal.EXPORT_TABLES,
+}
+FORMATS = ("ndjson", "csv")
+CONFLICT_CLAUSES = {"abort": "INSERT", "skip": "INSERT OR IGNORE", "replace": "INSERT OR REPLACE"}
+IMPORT_BATCH_ROWS = 50_000  # rows per transaction for offline imports
+ONLINE_BATCH_ROWS = 2_000  # rows per transaction with --online, so server writes are not held up
+IMPORT_CACHE_KIB = 256 * 1024  # page cache of the importing connection, which rebuilds the indexes
+EXPORT_FETCH_ROWS = 1_000  # rows fetched from SQLite at a time while exporting
+PROGRESS_INTERVAL = 2  # seconds between progress lines
+# settings key holding the DDL dropped by an offline import until it is restored
+DEFERRED_SCHEMA_KEY = "bulk_import_deferred_schema"
+
+
+class ImportFailed(Exception):
+    """Raised for input that does not match the table it is imported into."""
+
+
+class Progress:
+    """Rate-limited ``rows (rows/s)`` lines on stderr."""
+
+    def __init__(self, label, total=None, quiet=False):
+        self.label = label
+        self.total = total
+        self.quiet = quiet
+        self.rows = 0
+        self.started = self._shown = time.monotonic()
+
+    def add(self, rows):
+        self.rows += rows
+        now = time.monotonic()
+        if now - self._shown >= PROGRESS_INTERVAL:
+            self._shown = now
+            self._print(now)
+
+    def done(self, note=""):
+        self._print(time.monotonic(), final=True, note=note)
+
+    def _print(self, now, final=False, note=""):
+        if self.quiet:
+            return
+        rate = self.rows / max(now - self.started, 1e-9)
+        share = f" / {self.total:,} ({self.rows / self.total:.0%})" if self.total and not final else ""
+        took = f" in {now - self.started:.1f}s" if final else ""
+        print(f"{self.label}: {self.rows:,}{share} rows{took} ({rate:,.0f} rows/s){note}", file=sys.stderr, flush=True)
+
+
+def detect_format(path, fmt=None):
+    if fmt:
+        return fmt
+    suffixes = [suffix.lower() for suffix in Path(str(path)).suffixes if suffix.lower() != ".gz"]
+    if suffixes and suffixes[-1] == ".csv":
+        return "csv"
+    return "ndjson"
+
+
+def open_text(path, mode):
+    """Open ``path`` for text ``mode`` ("r"/"w"); "-" is stdin/stdout and ``.gz`` is compressed."""
+    if str(path) == "-":
+        stream = sys.stdin if mode == "r" else sys.stdout
+        stream.reconfigure(encoding="utf-8", newline="")
+        return stream
+    if str(path).endswith(".gz"):
+        return gzip.open(path, mode + "t", encoding="utf-8", newline="")
+    return open(path, mode, encoding="utf-8", newline="")
+
+
+def read_ndjson(stream, allowed):
+    """(columns, rows) of an NDJSON stream; the first record fixes the columns."""
+    lines = enumerate(stream, 1)
+    first = None
+    for number, line in lines:
+        if line.strip():
+            first = (number, line)
+            break
+    if first is None:
+        return (), iter(())
+
+    def parse(number, line):
+        try:
+            record = json.loads(line)
+        except json.JSONDecodeError as exc:
+            raise ImportFailed(f"line {number}: invalid JSON ({exc.msg})") from None
+        if not isinstance(record, dict):
+            raise ImportFailed(f"line {number}: expected a JSON object")
+        return record
+
+    head = parse(*first)
+    columns = tuple(head)
+    _check_columns(columns, allowed)
+
+    def rows():
+        yield tuple(head.get(column) for column in columns)
+        for number, line in lines:
+            if not line.strip():
+                continue
+            record = parse(number, line)
+            extra = record.keys() - set(columns)
+            if extra:
+                raise ImportFailed(f"line {number}: column(s) {', '.join(sorted(extra))} not in the first record")
+            yield tuple(record.get(column) for column in columns)
+
+    return columns, rows()
+
+
+def read_csv(stream, allowed):
+    """(columns, rows) of a CSV stream with a header row; empty fields load as NULL."""
+    reader = csv.reader(stream)
+    columns = tuple(next(reader, ()))
+    _check_columns(columns, allowed)
+
+    def rows():
+        for values in reader:
+            if len(values) != len(columns):
+                raise ImportFailed(f"line {reader.line_num}: expected {len(columns)} fields, got {len(values)}")
+            yield tuple(value if value != "" else None for value in values)
+
+    return columns, rows()
+
+
+def _check_columns(columns, allowed):
+    unknown = [column for column in columns if column not in allowed]
+    if unknown:
+        raise ImportFailed(f"unknown column(s): {', '.join(unknown)} (expected some of {', '.join(allowed)})")
+    if len(set(columns)) != len(columns):
+        raise ImportFailed("duplicate columns")
+
+
+def _batches(rows, size):
+    batch = []
+    for row in rows:
+        batch.append(row)
+        if len(batch) >= size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def defer_schema(conn, table):
+    """Drop ``table``'s secondary indexes and triggers, remembering their DDL in settings."""
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        cur = conn.cursor()
+        cur.execute(
+            "SELECT type, name, sql FROM sqlite_master "
+            "WHERE tbl_name=? AND type IN ('index', 'trigger') AND sql IS NOT NULL ORDER BY type, name",
+            (table,),
+        )
+        dropped = cur.fetchall()
+        cur.execute("SELECT value FROM settings WHERE key=?", (DEFERRED_SCHEMA_KEY,))
+        row = cur.fetchone()
+        pending = json.loads(row[0]) if row else []
+        pending += [sql for _, _, sql in dropped]
+        cur.execute("INSERT OR REPLACE INTO settings (key, value) VALUES (?, ?)", (DEFERRED_SCHEMA_KEY, json.dumps(pending)))
+        for kind, name, _ in dropped:
+            cur.execute(f'DROP {kind.upper()} "{name}"')
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    return len(dropped)
+
+
+def restore_schema(conn, changed, full=True, quiet=False):
+    """Recreate deferred indexes and triggers and rebuild what they would have maintained.
+
+    ``changed`` are the tables rows were loaded into. With ``full`` their
+    search index is rebuilt from scratch; otherwise only rows it is missing
+    are added, which is enough when no existing row was replaced. Safe to
+    run again after an interrupted import.
+    """
+    started = time.monotonic()
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        cur = conn.cursor()
+        cur.execute("SELECT value FROM settings WHERE key=?", (DEFERRED_SCHEMA_KEY,))
+        row = cur.fetchone()
+        for sql in json.loads(row[0]) if row else ():
+            cur.execute(sql)
+        cur.execute("DELETE FROM settings WHERE key=?", (DEFERRED_SCHEMA_KEY,))
+        for table, columns, _ in journal.FTS_TABLES:
+            if table not in changed:
+                continue
+            fts = f"{table}_fts"
+            cols = ", ".join(columns)
+            if full:
+                cur.execute(f"DELETE FROM {fts}")
+            cur.execute(
+                f"INSERT INTO {fts}(rowid, {cols}) SELECT id, "
+                + ", ".join(f"cjk_segment({column})" for column in columns)
+                + f" FROM {table}"
+                + ("" if full else f" WHERE id NOT IN (SELECT rowid FROM {fts})")
+            )
+            if full:
+                cur.execute(f"INSERT INTO {fts}({fts}) VALUES ('optimize')")
+        journal._recount_stats(cur)
+        cur.executemany(
+            f"UPDATE table_versions SET version=version+1, changed_at={journal.SQL_EPOCH_NOW} WHERE name=?",
+            [(table,) for table in changed],
+        )
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    conn.execute("PRAGMA optimize")
+    if not quiet:
+        print(f"rebuilt indexes, search and counters in {time.monotonic() - started:.1f}s", file=sys.stderr)
+
+
+def has_deferred_schema(conn):
+    return conn.execute("SELECT 1 FROM settings WHERE key=?", (DEFERRED_SCHEMA_KEY,)).fetchone() is not None
+
+
+# tables init_db fills in a brand-new database
+SEEDED_TABLES = ("users", "diaries")
+
+
+def clear_seed_rows(conn, tables):
+    """Delete what init_db put into a brand-new database, in the ``tables`` being imported.
+
+    Imported rows then keep their ids. Only users and diaries are seeded, so
+    e.g. ``import messages_public`` leaves the admin account alone;
+    journal.py seeds an admin again on start if a users import brought none.
+    """
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        for table in SEEDED_TABLES:
+            if table in tables:
+                conn.execute(f"DELETE FROM {table}")
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+
+
+def check_input(table, path, fmt=None):
+    """Fail early on a file whose columns do not fit ``table``, before any index is dropped."""
+    if str(path) == "-":
+        return
+    with open_text(path, "r") as stream:
+        reader = read_csv if detect_format(path, fmt) == "csv" else read_ndjson
+        reader(stream, IO_TABLES[table])
+
+
+def import_table(conn, table, path, fmt=None, batch_rows=None, on_conflict="abort", online=False, quiet=False):
+    """Load one file into ``table``; returns (rows read, rows inserted)."""
+    fmt = detect_format(path, fmt)
+    batch_rows = batch_rows or (ONLINE_BATCH_ROWS if online else IMPORT_BATCH_ROWS)
+    progress = Progress(f"import {table}", quiet=quiet)
+    inserted = 0
+    with open_text(path, "r") as stream:
+        reader = read_csv if fmt == "csv" else read_ndjson
+        columns, rows = reader(stream, IO_TABLES[table])
+        if not columns:
+            progress.done(" (empty input)")
+            return 0, 0
+        sql = (
+            f"{CONFLICT_CLAUSES[on_conflict]} INTO {table} ({', '.join(columns)}) "
+            f"VALUES ({', '.join('?' for _ in columns)})"
+        )
+        for batch in _batches(rows, batch_rows):
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                inserted += conn.executemany(sql, batch).rowcount
+                conn.commit()
+            except Exception:
+                conn.rollback()
+                raise
+            progress.add(len(batch))
+    skipped = progress.rows - inserted
+    progress.done(f", {skipped:,} skipped" if skipped else "")
+    return progress.rows, inserted
+
+
+def export_table(conn, table, path, fmt=None, after_id=0, quiet=False):
+    """Stream ``table`` rows with id > ``after_id`` to ``path``; returns the rows written."""
+    fmt = detect_format(path, fmt)
+    columns = IO_TABLES[table]
+    total = journal.read_stats().get(table) if table != "users" else None
+    progress = Progress(f"export {table}", total=total, quiet=quiet)
+    cur = conn.cursor()
+    cur.arraysize = EXPORT_FETCH_ROWS
+    cur.execute(f"SELECT {', '.join(columns)} FROM {table} WHERE id > ? ORDER BY id", (after_id,))
+    with open_text(path, "w") as stream:
+        if fmt == "csv":
+            writer = csv.writer(stream)
+            writer.writerow(columns)
+        while True:
+            rows = cur.fetchmany()
+            if not rows:
+                break
+            if fmt == "csv":
+                writer.writerows(["" if value is None else value for value in row] for row in rows)
+            else:
+                stream.writelines(json.dumps(dict(zip(columns, row)), ensure_ascii=False) + "\n" for row in rows)
+            progress.add(len(rows))
+    cur.close()
+    progress.done()
+    return progress.rows
+
+
+def _table_paths(table, path, fmt, must_exist):
+    """[(table, file)] for one table, or every table's file in the directory ``path`` for "all"."""
+    if table != "all":
+        return [(table, path)]
+    if str(path) == "-":
+        raise ImportFailed("'all' reads and writes a directory of files, not stdin/stdout")
+    directory = Path(path)
+    suffix = "." + (fmt or "ndjson")
+    if must_exist:
+        found = []
+        for name in IO_TABLES:
+            for candidate in (directory / f"{name}{suffix}", directory / f"{name}{suffix}.gz"):
+                if candidate.exists():
+                    found.append((name, candidate))
+                    break
+        if not found:
+            raise ImportFailed(f"no <table>{suffix} files in {directory}")
+        return found
+    directory.mkdir(parents=True, exist_ok=True)
+    return [(name, directory / f"{name}{suffix}") for name in IO_TABLES]
+
+
+def run_import(args):
+    conn = journal.connect_db()
+    conn.execute(f"PRAGMA cache_size=-{IMPORT_CACHE_KIB}")
+    # rows removed by INSERT OR REPLACE fire the DELETE triggers only with this on; an
+    # --online import relies on them to keep the counters and search index in step
+    conn.execute("PRAGMA recursive_triggers=ON")
+    # index builds over millions of rows would otherwise sort entirely in memory
+    conn.execute("PRAGMA temp_store=FILE")
+    if has_deferred_schema(conn):
+        print("finishing an interrupted import first", file=sys.stderr)
+        restore_schema(conn, tuple(IO_TABLES), quiet=args.quiet)
+    jobs = _table_paths(args.table, args.path, args.format, must_exist=True)
+    tables = tuple(table for table, _ in jobs)
+    started = time.monotonic()
+    for table, path in jobs:
+        check_input(table, path, args.format)
+    if args.created:
+        clear_seed_rows(conn, tables)
+    if not args.online:
+        for table in tables:
+            defer_schema(conn, table)
+    changed = []
+    try:
+        for table, path in jobs:
+            # counted as changed before loading: a failed batch may still follow committed ones
+            changed.append(table)
+            _, inserted = import_table(
+                conn, table, path, args.format, args.batch_size, args.on_conflict, args.online, args.quiet
+            )
+            if not inserted:
+                changed.pop()
+    finally:
+        if not args.online:
+            restore_schema(conn, changed, full=args.on_conflict == "replace", quiet=args.quiet)
+    conn.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+    conn.close()
+    if not args.quiet:
+        print(f"done in {time.monotonic() - started:.1f}s", file=sys.stderr)
+
+
+def run_export(args):
+    conn = journal.connect_db()
+    jobs = _table_paths(args.table, args.path, args.format, must_exist=False)
+    # one read transaction: every table comes from the same snapshot
+    conn.execute("BEGIN")
+    try:
+        for table, path in jobs:
+            export_table(conn, table, path, args.format, args.after_id, args.quiet)
+    finally:
+        conn.rollback()
+        conn.close()
+
+
+def run_repair(args):
+    conn = journal.connect_db()
+    if has_deferred_schema(conn):
+        restore_schema(conn, tuple(IO_TABLES), quiet=args.quiet)
+    else:
+        print("nothing to repair", file=sys.stderr)
+    conn.close()
+
+
+def parse_args(argv=None):
+    common = argparse.ArgumentParser(add_help=False)
+    common.add_argument("--db", type=Path, default=journal.DB_PATH, help="SQLite database file")
+    common.add_argument("--quiet", action="store_true", help="no progress output")
+    parser = argparse.ArgumentParser(description="Bulk import and export for the Secret Garden database")
+    commands = parser.add_subparsers(dest="command", required=True)
+    tables = (*IO_TABLES, "all")
+
+    export = commands.add_parser("export", parents=[common], help="stream a table (or all of them) to NDJSON/CSV")
+    export.add_argument("table", choices=tables)
+    export.add_argument("path", help="output file, '-' for stdout, or a directory for 'all'")
+    export.add_argument("--format", choices=FORMATS, help="default: from the file name, else ndjson")
+    export.add_argument("--after-id", type=int, default=0, help="only rows with a larger id (to resume)")
+    export.set_defaults(run=run_export)
+
+    load = commands.add_parser(
+        "import",
+        parents=[common],
+        help="load NDJSON/CSV into a table (or all of them)",
+        description="Load NDJSON/CSV into a table (or all of them). When --db names a file that does not exist "
+        "yet, the admin account and sample diaries it is created with are removed from the tables being "
+        "imported (users, diaries), so imported rows keep their ids.",
+    )
+    load.add_argument("table", choices=tables)
+    load.add_argument("path", help="input file, '-' for stdin, or a directory of <table>.ndjson files for 'all'")
+    load.add_argument("--format", choices=FORMATS, help="default: from the file name, else ndjson")
+    load.add_argument(
+        "--on-conflict",
+        choices=tuple(CONFLICT_CLAUSES),
+        default="abort",
+        help="rows whose id or username already exists: abort the batch, skip them, or replace the old row",
+    )
+    load.add_argument(
+        "--batch-size",
+        type=int,
+        help=f"rows per transaction (default {IMPORT_BATCH_ROWS:,}, or {ONLINE_BATCH_ROWS:,} with --online)",
+    )
+    load.add_argument(
+        "--online",
+        action="store_true",
+        help="keep indexes and triggers in place, for loading into a database the server is using",
+    )
+    load.set_defaults(run=run_import)
+
+    repair = commands.add_parser("repair", parents=[common], help="restore indexes and triggers left dropped by an interrupted import")
+    repair.set_defaults(run=run_repair)
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    journal.DB_PATH = args.db
+    args.created = not args.db.exists()
+    journal.init_db()
+    try:
+        args.run(args)
+    except ImportFailed as exc:
+        raise SystemExit(f"error: {exc}") from None
+    except sqlite3.IntegrityError as exc:
+        raise SystemExit(f"error: {exc} (use --on-conflict skip or replace to load over existing rows)") from None
+
+
+if __name__ == "__main__":
+    main()
@@ -1,41 +1,966 @@
+import argparse
+import asyncio
+import io
 import json
+import logging
+import logging.handlers
+import math
+import multiprocessing
+import os
+import re
+import signal
 import sqlite3
 import hashlib
 import base64
+import bisect
+import gzip
+import mimetypes
 import secrets
+import select
+import selectors
+import socket
+import subprocess
+import sys
+import threading
 import time
+import traceback
+import zlib
+from collections import OrderedDict, deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from email.utils import formatdate, parsedate_to_datetime
+from http import HTTPStatus
 from http.server import HTTPServer, SimpleHTTPRequestHandler
-from urllib.parse import urlparse, parse_qs
+from urllib.parse import urlparse, parse_qs, unquote
 from pathlib import Path
 
+try:
+    import brotli
+except ImportError:  # optional: without it only gzip variants are built
+    brotli = None
+
 DB_PATH = Path(__file__).parent / "garden.db"
 PUBLIC_DIR = Path(__file__).parent / "public"
+# directories --build-static precompresses: the diary front end plus the main site's assets
+STATIC_SITE_DIRS = (PUBLIC_DIR, Path(__file__).parent / "assets", Path(__file__).parent / "orange" / "assets")
+STATIC_COMPRESSIBLE = {".html", ".css", ".js", ".json", ".svg", ".txt", ".xml", ".ico", ".map"}
+STATIC_UTF8_TYPES = {"application/javascript", "application/json", "image/svg+xml"}
+STATIC_VARIANT_SUFFIXES = {"br": ".br", "gzip": ".gz"}  # in order of preference
+STATIC_MIN_COMPRESS_BYTES = 512  # smaller files are sent as they are
+STATIC_INLINE_BYTES = 256 * 1024  # files up to this size are served from memory, larger ones with sendfile
+STATIC_CACHE_BYTES = 32 * 1024 * 1024  # memory held by cached static files and their variants
+STATIC_IMMUTABLE_AGE = 365 * 24 * 3600  # max-age of ?v=<hash> URLs
+STATIC_SENDFILE_CHUNK = 1024 * 1024  # bytes per sendfile hand-off in asyncio mode
+# local stylesheet/script links in HTML pages, rewritten to versioned URLs
+STATIC_LINK_PATTERN = re.compile(r'((?:href|src)=")(/[^"?#:]+\.(?:css|js))(")')
+API_COMPRESS_LEVEL = 6  # gzip level of API responses (brotli quality when brotli is installed); 0 turns it off
+API_COMPRESS_MIN_BYTES = 1024  # smaller API responses are sent as they are
 PUBLIC_MESSAGE_COOLDOWN = 12  # seconds between public messages per IP
-LAST_PUBLIC_MESSAGE = {}
-LOGIN_ATTEMPTS = {}
 LOGIN_WINDOW = 60
 LOGIN_MAX_ATTEMPTS = 8
+RATE_LIMIT_SHARDS = 16  # independently locked slices of the in-memory limiter
+RATE_LIMIT_MAX_KEYS = 100_000  # (policy, client) buckets kept in memory before the least recent are dropped
+RATE_LIMIT_SWEEP_INTERVAL = 60  # seconds between sweeps of buckets that have refilled
+DEFAULT_WORKERS = 16  # request threads in --mode threaded / asyncio
+DEFAULT_BACKLOG = 128  # pending connections queued by the kernel
+REQUEST_TIMEOUT = 30  # seconds a client may stall before its socket is dropped
+KEEPALIVE_TIMEOUT = 15  # seconds an idle keep-alive connection stays open (asyncio mode)
+MAX_HEADER_BYTES = 64 * 1024  # request line + headers accepted in asyncio mode
+MAX_BODY_BYTES = 1024 * 1024  # request body accepted in asyncio mode
+DB_BUSY_TIMEOUT_MS = 5000  # how long a writer waits for the write lock
+DB_CACHE_SIZE_KIB = 16384  # page cache per connection
+DB_MMAP_SIZE = 256 * 1024 * 1024
+SESSION_TTL = 7 * 24 * 3600  # seconds a login token stays valid
+SESSION_CACHE_SIZE = 4096  # sessions kept in memory in front of the sessions table
+SESSION_CACHE_TTL = 60  # seconds a cached session is trusted without re-reading it
+SESSION_SWEEP_INTERVAL = 300  # seconds between expired-session sweeps
+SESSION_SWEEP_BATCH = 500  # rows deleted per sweep transaction
+STATS_RECONCILE_INTERVAL = 24 * 3600  # seconds between from-scratch recounts of the stats table
+# scrypt cost for new hashes; older hashes are upgraded on the next good login
+SCRYPT_N = 2 ** 14
+SCRYPT_R = 8
+SCRYPT_P = 1
+SCRYPT_WORKERS = min(4, os.cpu_count() or 1)  # hashing processes
+SCRYPT_MAX_PENDING = 16  # running + queued hashes before auth requests are shed
+STREAM_CHUNK_SIZE = 64 * 1024  # bytes buffered per chunk of a streamed response
+SSE_HEARTBEAT = 15  # seconds between keep-alive comments on an idle event stream
+SSE_DISCONNECT_POLL = 1  # seconds between hang-up checks on a thread-held event stream
+SSE_RETRY_MS = 3000  # reconnect delay suggested to EventSource clients
+SSE_CLIENT_BUFFER = 256  # events queued for one stream client before it is dropped as too slow
+SSE_HISTORY = 512  # recent events replayed to clients reconnecting with Last-Event-ID
+SEARCH_MAX_QUERY = 100  # characters accepted in a search query
+SEARCH_MAX_TERMS = 8  # whitespace-separated terms, each matched as a phrase
+SEARCH_MAX_OFFSET = 500  # ranked results cannot be keyset-paged, so deep OFFSETs are refused
+SNIPPET_TOKENS = 24  # tokens (roughly CJK characters) around each search hit
+# characters of a diary shown in list views; baked into the excerpt column, so changing it needs a migration
+DIARY_EXCERPT_CHARS = 120
+# extra seconds a group-commit batch waits for rows; 0 batches whatever queued during the last commit
+GROUP_COMMIT_WINDOW = 0
+GROUP_COMMIT_MAX_ROWS = 256  # rows committed in one group-commit transaction
+GROUP_COMMIT_MAX_PENDING = 4096  # queued rows before message posts are answered with 503
+# upper bounds, in seconds, of the latency histogram buckets
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+SLOW_QUERY_LOG = Path(__file__).parent / "slow_queries.log"
+SLOW_QUERY_LOG_BYTES = 10 * 1024 * 1024  # size at which the slow-query log rotates
+SLOW_QUERY_LOG_BACKUPS = 5
+TRACE_HEADER_STATEMENTS = 40  # statements listed in one Server-Timing header
+TRACE_HEADER_SQL_CHARS = 80
+REQUEST_ID = re.compile(r"[\w.:-]{1,64}")  # accepted X-Request-Id values; others are replaced
+WORKER_READY_TIMEOUT = 30  # seconds a replacement worker gets to start serving during a rolling restart
+WORKER_STOP_TIMEOUT = 60  # seconds a stopping worker gets to drain before it is killed
+WORKER_MIN_UPTIME = 10  # workers exiting sooner than this are restarted after a growing delay
+WORKER_MAX_RESTART_DELAY = 30
+SUPERVISOR_LINK_TIMEOUT = 5  # seconds the supervisor blocks on a worker's control socket before dropping it
+
+_db_local = threading.local()
+_db_lock = threading.Lock()
+_db_connections = []
+_db_generation = 0
+
+
+def _scrypt(password: str, salt: bytes, n: int, r: int, p: int) -> bytes:
+    # scrypt needs ~128*r*(n+p+2) bytes; leave headroom over OpenSSL's 32 MiB default
+    maxmem = 2 * 128 * r * (n + p + 2)
+    return hashlib.scrypt(password.encode(), salt=salt, n=n, r=r, p=p, maxmem=max(maxmem, 32 * 1024 * 1024))
+
+
+def _parse_password_hash(stored: str):
+    """Split a stored hash into (n, r, p, salt, digest).
+
+    Current hashes look like ``scrypt$n$r$p$salt$digest``; hashes written before
+    the cost was recorded are plain ``salt:digest`` with n=2**14, r=8, p=1.
+    """
+    if stored.startswith("scrypt$"):
+        _, n, r, p, salt_b64, hash_b64 = stored.split("$")
+        n, r, p = int(n), int(r), int(p)
+    else:
+        salt_b64, hash_b64 = stored.split(":")
+        n, r, p = 2 ** 14, 8, 1
+    return n, r, p, base64.b64decode(salt_b64), base64.b64decode(hash_b64)
 
 
 def hash_password(password: str) -> str:
     salt = secrets.token_bytes(16)
-    digest = hashlib.scrypt(password.encode(), salt=salt, n=2 ** 14, r=8, p=1)
-    return f"{base64.b64encode(salt).decode()}:{base64.b64encode(digest).decode()}"
+    digest = _scrypt(password, salt, SCRYPT_N, SCRYPT_R, SCRYPT_P)
+    return (
+        f"scrypt${SCRYPT_N}${SCRYPT_R}${SCRYPT_P}$"
+        f"{base64.b64encode(salt).decode()}${base64.b64encode(digest).decode()}"
+    )
 
 
 def verify_password(password: str, stored: str) -> bool:
     try:
-        salt_b64, hash_b64 = stored.split(":")
-        salt = base64.b64decode(salt_b64)
-        expected = base64.b64decode(hash_b64)
-        digest = hashlib.scrypt(password.encode(), salt=salt, n=2 ** 14, r=8, p=1)
+        n, r, p, salt, expected = _parse_password_hash(stored)
+        digest = _scrypt(password, salt, n, r, p)
         return secrets.compare_digest(digest, expected)
     except Exception:
         return False
 
 
+def needs_rehash(stored: str) -> bool:
+    try:
+        n, r, p, _, _ = _parse_password_hash(stored)
+    except Exception:
+        return True
+    return (n, r, p) != (SCRYPT_N, SCRYPT_R, SCRYPT_P) or not stored.startswith("scrypt$")
+
+
+def _ignore_sigint():
+    # Ctrl+C is handled by the server process, which shuts the pool down itself
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+
+class Histogram:
+    """Fixed-bucket latency histogram; quantiles are interpolated within a bucket."""
+
+    __slots__ = ("bounds", "counts", "count", "total", "max", "_lock")
+
+    def __init__(self, bounds=LATENCY_BUCKETS):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)  # the last bucket is +Inf
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+        self._lock = threading.Lock()
+
+    def observe(self, seconds):
+        index = bisect.bisect_left(self.bounds, seconds)
+        with self._lock:
+            self.counts[index] += 1
+            self.count += 1
+            self.total += seconds
+            if seconds > self.max:
+                self.max = seconds
+
+    def quantile(self, q):
+        with self._lock:
+            counts, count, largest = list(self.counts), self.count, self.max
+        if not count:
+            return 0.0
+        rank = q * count
+        seen = 0
+        for index, bucket in enumerate(counts):
+            if bucket and seen + bucket >= rank:
+                if index == len(self.bounds):
+                    return largest
+                lower = self.bounds[index - 1] if index else 0.0
+                upper = min(self.bounds[index], largest)
+                return lower + (upper - lower) * (rank - seen) / bucket
+            seen += bucket
+        return largest
+
+    def snapshot(self):
+        return {
+            "count": self.count,
+            "sum": round(self.total, 6),
+            "max": round(self.max, 6),
+            **{f"p{int(q * 100)}": round(self.quantile(q), 6) for q in (0.5, 0.95, 0.99)},
+        }
+
+    def cumulative(self):
+        """``(le, count)`` pairs as Prometheus histogram buckets expect."""
+        with self._lock:
+            counts = list(self.counts)
+        running = 0
+        for bound, bucket in zip((*self.bounds, "+Inf"), counts):
+            running += bucket
+            yield bound, running
+
+
+class RouteMetrics:
+    __slots__ = ("latency", "statuses")
+
+    def __init__(self):
+        self.latency = Histogram()
+        self.statuses = {}
+
+
+class Metrics:
+    """Per-route request counts and latencies plus the time spent in SQLite, scrypt and JSON.
+
+    Everything is per process; with --processes each scrape sees one worker.
+    """
+
+    def __init__(self):
+        self.routes = {}
+        self.sqlite = Histogram()
+        self.scrypt = Histogram()
+        self.json = Histogram()
+        self._lock = threading.Lock()
+
+    def observe_request(self, route, status, seconds):
+        metrics = self.routes.get(route)
+        if metrics is None:
+            with self._lock:
+                metrics = self.routes.setdefault(route, RouteMetrics())
+        metrics.latency.observe(seconds)
+        with self._lock:
+            metrics.statuses[status] = metrics.statuses.get(status, 0) + 1
+
+    def timers(self):
+        return {"sqlite": self.sqlite, "scrypt": self.scrypt, "json_encode": self.json}
+
+    def route_items(self):
+        """``(route, statuses, latency)`` per route, sorted, with the status counts copied."""
+        with self._lock:
+            return [(name, dict(metrics.statuses), metrics.latency) for name, metrics in sorted(self.routes.items())]
+
+
+METRICS = Metrics()
+
+
+def encode_json(data) -> bytes:
+    started = time.perf_counter()
+    body = json.dumps(data).encode()
+    METRICS.json.observe(time.perf_counter() - started)
+    return body
+
+
+class GardenCursor(sqlite3.Cursor):
+    """Cursor that adds the time spent executing and fetching to METRICS.sqlite,
+    and each statement to the request's SqlTrace while TRACER is active.
+
+    Rows pulled by iterating the cursor (the streaming endpoints) are not timed.
+    """
+
+    traced = None  # TracedStatement of the last execute, while tracing
+
+    def execute(self, sql, parameters=()):
+        started = time.perf_counter()
+        try:
+            return super().execute(sql, parameters)
+        finally:
+            self._executed(sql, started)
+
+    def executemany(self, sql, seq_of_parameters):
+        started = time.perf_counter()
+        try:
+            return super().executemany(sql, seq_of_parameters)
+        finally:
+            self._executed(sql, started)
+
+    def fetchone(self):
+        started = time.perf_counter()
+        row = None
+        try:
+            row = super().fetchone()
+            return row
+        finally:
+            self._fetched(started, 0 if row is None else 1)
+
+    def fetchall(self):
+        started = time.perf_counter()
+        rows = []
+        try:
+            rows = super().fetchall()
+            return rows
+        finally:
+            self._fetched(started, len(rows))
+
+    def _executed(self, sql, started):
+        seconds = time.perf_counter() - started
+        METRICS.sqlite.observe(seconds)
+        if TRACER.active:
+            # rowcount covers writes; rows returned by a SELECT are added as they are fetched
+            self.traced = TRACER.record(sql, started, seconds, max(self.rowcount, 0))
+
+    def _fetched(self, started, rows):
+        seconds = time.perf_counter() - started
+        METRICS.sqlite.observe(seconds)
+        if self.traced is not None:
+            self.traced.seconds += seconds
+            self.traced.rows += rows
+
+
+class GardenConnection(sqlite3.Connection):
+    # Connection.execute does not go through cursor(), so route both to GardenCursor
+    def cursor(self, factory=GardenCursor):
+        return super().cursor(factory)
+
+    def execute(self, sql, parameters=()):
+        return self.cursor().execute(sql, parameters)
+
+
+class TracedStatement:
+    __slots__ = ("sql", "offset", "seconds", "rows")
+
+    def __init__(self, sql, offset, seconds, rows):
+        self.sql = sql
+        self.offset = offset
+        self.seconds = seconds
+        self.rows = rows
+
+
+class SqlTrace:
+    __slots__ = ("request_id", "route", "started", "statements")
+
+    def __init__(self, request_id):
+        self.request_id = request_id
+        self.route = None
+        self.started = time.perf_counter()
+        self.statements = []
+
+
+class SqlTracer:
+    """Opt-in SQL tracing: ``--slow-query-ms`` and ``--trace-sql`` switch it on.
+
+    handle_api opens a SqlTrace for each API request on its thread and
+    GardenCursor appends every statement run there, so require_token and
+    the handlers are covered alike. When the request ends, statements slower
+    than ``slow_seconds`` (execute plus fetch) go to the rotating slow-query
+    log as JSON lines; statements run outside a request (background jobs,
+    the group-commit writer) are checked on execute alone. With ``timeline``
+    on, a request sending ``X-Debug-Sql: 1`` gets its statements back in a
+    ``Server-Timing`` header. Parameters are never recorded.
+    """
+
+    def __init__(self):
+        self.active = False
+        self.slow_seconds = None
+        self.timeline = False
+        self._local = threading.local()
+        self._log = None
+
+    def configure(self, slow_ms=None, timeline=False, log_path=SLOW_QUERY_LOG):
+        self.slow_seconds = None if slow_ms is None else slow_ms / 1000
+        self.timeline = timeline
+        if self.slow_seconds is not None and self._log is None:
+            handler = logging.handlers.RotatingFileHandler(
+                log_path, maxBytes=SLOW_QUERY_LOG_BYTES, backupCount=SLOW_QUERY_LOG_BACKUPS, encoding="utf-8"
+            )
+            handler.setFormatter(logging.Formatter("%(message)s"))
+            self._log = logging.getLogger("garden.slow_queries")
+            self._log.setLevel(logging.INFO)
+            self._log.propagate = False
+            self._log.addHandler(handler)
+        self.active = self.slow_seconds is not None or timeline
+
+    def begin(self, request_id):
+        trace = self._local.trace = SqlTrace(request_id)
+        return trace
+
+    def record(self, sql, started, seconds, rows):
+        trace = getattr(self._local, "trace", None)
+        if trace is None:
+            if self.slow_seconds is not None and seconds >= self.slow_seconds:
+                self._write(None, TracedStatement(sql, 0.0, seconds, rows))
+            return None
+        statement = TracedStatement(sql, started - trace.started, seconds, rows)
+        trace.statements.append(statement)
+        return statement
+
+    def finish(self, trace, route):
+        self._local.trace = None
+        trace.route = route
+        if self.slow_seconds is not None:
+            for statement in trace.statements:
+                if statement.seconds >= self.slow_seconds:
+                    self._write(trace, statement)
+
+    def _write(self, trace, statement):
+        entry = {
+            "at": formatdate(usegmt=True),
+            "request_id": trace.request_id if trace else None,
+            "route": trace.route if trace else None,
+            "ms": round(statement.seconds * 1000, 3),
+            "rows": statement.rows,
+            "sql": " ".join(statement.sql.split()),
+        }
+        self._log.info(json.dumps(entry, ensure_ascii=False))
+
+    def server_timing(self, trace):
+        """The statements so far as ``Server-Timing`` metrics (sql-1, sql-2, ...)."""
+        parts = []
+        for index, statement in enumerate(trace.statements[:TRACE_HEADER_STATEMENTS], 1):
+            sql = " ".join(statement.sql.split())[:TRACE_HEADER_SQL_CHARS].replace("\\", "").replace('"', "'")
+            desc = f"+{statement.offset * 1000:.2f}ms {statement.rows} rows: {sql}"
+            # header values are latin-1; escape anything else rather than drop the entry
+            desc = desc.encode("ascii", "backslashreplace").decode()
+            parts.append(f'sql-{index};dur={statement.seconds * 1000:.3f};desc="{desc}"')
+        return ", ".join(parts)
+
+
+TRACER = SqlTracer()
+
+
+class AuthOverloaded(Exception):
+    """Raised when too many password hashes are already running or queued."""
+
+
+class ScryptPool:
+    """Runs scrypt on a bounded pool of worker processes.
+
+    Each hash costs ~16 MiB and tens of milliseconds of CPU, so at most
+    ``max_pending`` may be in flight; beyond that ``AuthOverloaded`` is raised
+    and the request is shed instead of queueing unbounded memory. Until
+    ``start`` is called (tools, init_db) hashes run inline on the caller.
+    """
+
+    def __init__(self, workers=SCRYPT_WORKERS, max_pending=SCRYPT_MAX_PENDING):
+        self.workers = workers
+        self.max_pending = max_pending
+        self.pending = 0
+        self.shed = 0
+        self._lock = threading.Lock()
+        self._executor = None
+
+    def start(self):
+        if self.workers > 0 and self._executor is None:
+            self._executor = ProcessPoolExecutor(
+                max_workers=self.workers,
+                mp_context=multiprocessing.get_context("spawn"),
+                initializer=_ignore_sigint,
+            )
+        return self
+
+    def shutdown(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=True)
+            self._executor = None
+
+    def _run(self, func, *args):
+        with self._lock:
+            if self.pending >= self.max_pending:
+                self.shed += 1
+                raise AuthOverloaded()
+            self.pending += 1
+        started = time.perf_counter()
+        try:
+            if self._executor is None:
+                return func(*args)
+            return self._executor.submit(func, *args).result()
+        finally:
+            METRICS.scrypt.observe(time.perf_counter() - started)
+            with self._lock:
+                self.pending -= 1
+
+    def hash(self, password: str) -> str:
+        return self._run(hash_password, password)
+
+    def verify(self, password: str, stored: str) -> bool:
+        return self._run(verify_password, password, stored)
+
+
+SCRYPT_POOL = ScryptPool()
+
+
+# CJK ideographs, kana and hangul. FTS5's unicode61 tokenizer would read a run
+# of them as one huge token, so each character is fenced with zero-width spaces
+# (a separator to unicode61, invisible on screen) and indexed as its own token.
+CJK_CHARS = re.compile(
+    "[\u2e80-\u2fdf\u3040-\u30ff\u3100-\u312f\u3190-\u31ff\u3400-\u4dbf"
+    "\u4e00-\u9fff\uac00-\ud7af\uf900-\ufaff\U00020000-\U0002ffff]"
+)
+ZWSP = "\u200b"
+
+
+def cjk_segment(text):
+    """Split CJK text into one FTS token per character; other text is untouched."""
+    if text is None:
+        return None
+    return CJK_CHARS.sub(lambda m: ZWSP + m.group(0) + ZWSP, text)
+
+
+def connect_db(path=None):
+    """Open a connection tuned for concurrent use: WAL, relaxed fsync, big cache."""
+    conn = sqlite3.connect(
+        path or DB_PATH,
+        timeout=DB_BUSY_TIMEOUT_MS / 1000,
+        isolation_level="IMMEDIATE",
+        check_same_thread=False,
+        factory=GardenConnection,
+    )
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    conn.execute(f"PRAGMA cache_size=-{DB_CACHE_SIZE_KIB}")
+    conn.execute(f"PRAGMA mmap_size={DB_MMAP_SIZE}")
+    conn.execute(f"PRAGMA busy_timeout={DB_BUSY_TIMEOUT_MS}")
+    conn.execute("PRAGMA temp_store=MEMORY")
+    # the full-text triggers call this, so every connection that writes needs it
+    conn.create_function("cjk_segment", 1, cjk_segment, deterministic=True)
+    return conn
+
+
+def get_db():
+    """Return the calling thread's pooled connection, opening it on first use.
+
+    Connections live for the life of the thread, so request handlers must not
+    close them; they only commit or roll back their own writes.
+    """
+    local = _db_local
+    if getattr(local, "conn", None) is None or local.path != DB_PATH or local.generation != _db_generation:
+        conn = connect_db()
+        with _db_lock:
+            _db_connections.append(conn)
+            local.generation = _db_generation
+        local.conn = conn
+        local.path = DB_PATH
+    return local.conn
+
+
+def close_db_connections():
+    """Close every pooled connection; threads reconnect lazily afterwards."""
+    global _db_generation
+    with _db_lock:
+        connections = list(_db_connections)
+        _db_connections.clear()
+        _db_generation += 1
+    for conn in connections:
+        try:
+            conn.close()
+        except sqlite3.Error:
+            pass
+
+
+class WriteOverloaded(Exception):
+    """Raised when the group-commit queue is full or its writer thread died."""
+
+
+class PendingWrite:
+    __slots__ = ("sql", "params", "done", "result", "error")
+
+    def __init__(self, sql, params):
+        self.sql = sql
+        self.params = params
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class WriteBatcher:
+    """Group commit: single-row inserts from concurrent requests share one transaction.
+
+    A writer thread with its own connection commits up to ``max_rows`` queued
+    rows in one transaction; rows arriving during that commit form the next
+    batch, so batches grow with load and an idle server adds no delay.
+    ``window`` optionally holds each batch open a little longer for more rows.
+    Each caller blocks until its row is committed. Every row
+    runs under a savepoint so one failing insert does not sink the batch.
+    Past ``max_pending`` queued rows ``WriteOverloaded`` is raised. Until
+    ``start`` is called, or after the writer thread died, each write commits
+    on the caller's own connection.
+    """
+
+    def __init__(self, window=GROUP_COMMIT_WINDOW, max_rows=GROUP_COMMIT_MAX_ROWS, max_pending=GROUP_COMMIT_MAX_PENDING):
+        self.window = window
+        self.max_rows = max_rows
+        self.max_pending = max_pending
+        self._queue = deque()
+        self._cond = threading.Condition()
+        self._thread = None
+        self._stopping = False
+        self.batches = 0
+        self.rows = 0
+        self.largest_batch = 0
+        self.shed = 0
+
+    def start(self):
+        if self._thread is None:
+            self._stopping = False
+            self._thread = threading.Thread(target=self._loop, name="group-commit", daemon=True)
+            self._thread.start()
+        return self
+
+    def stop(self):
+        """Commit whatever is queued, then stop the writer thread."""
+        thread = self._thread
+        if thread is None:
+            return
+        with self._cond:
+            self._stopping = True
+            self._cond.notify()
+        thread.join()
+
+    def execute(self, sql, params):
+        """Run one INSERT (optionally ``RETURNING``) and return its first row once committed."""
+        item = PendingWrite(sql, params)
+        with self._cond:
+            queued = self._thread is not None
+            if queued:
+                if len(self._queue) >= self.max_pending:
+                    self.shed += 1
+                    raise WriteOverloaded()
+                self._queue.append(item)
+                self._cond.notify()
+        if not queued:
+            conn = get_db()
+            try:
+                row = conn.execute(sql, params).fetchone()
+                conn.commit()
+            except Exception:
+                conn.rollback()
+                raise
+            return row
+        item.done.wait()
+        if item.error is not None:
+            raise item.error
+        return item.result
+
+    def _take_batch(self):
+        with self._cond:
+            while not self._queue:
+                if self._stopping:
+                    self._thread = None
+                    return None
+                self._cond.wait()
+            deadline = time.monotonic() + self.window
+            while len(self._queue) < self.max_rows and not self._stopping:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                self._cond.wait(remaining)
+            return [self._queue.popleft() for _ in range(min(len(self._queue), self.max_rows))]
+
+    def _loop(self):
+        batch = None
+        try:
+            conn = connect_db()
+            try:
+                while (batch := self._take_batch()) is not None:
+                    self._commit(conn, batch)
+            finally:
+                conn.close()
+        except Exception as exc:
+            print(f"[group-commit] writer stopped: {exc!r}")
+            with self._cond:
+                # later writes fall back to the callers' own connections
+                self._thread = None
+                stranded = [*(batch or ()), *self._queue]
+                self._queue.clear()
+            for item in stranded:
+                if not item.done.is_set():
+                    item.error = WriteOverloaded()
+                    item.done.set()
+
+    def _commit(self, conn, batch):
+        try:
+            cur = conn.cursor()
+            cur.execute("BEGIN IMMEDIATE")
+            for item in batch:
+                cur.execute("SAVEPOINT batched_row")
+                try:
+                    # fetchall finishes the statement so the savepoint can be released
+                    rows = cur.execute(item.sql, item.params).fetchall()
+                    item.result = rows[0] if rows else None
+                    cur.execute("RELEASE batched_row")
+                except sqlite3.Error as exc:
+                    cur.execute("ROLLBACK TO batched_row")
+                    cur.execute("RELEASE batched_row")
+                    item.error = exc
+            conn.commit()
+        except Exception as exc:
+            if conn.in_transaction:
+                conn.rollback()
+            for item in batch:
+                item.error = exc
+        self.batches += 1
+        self.rows += len(batch)
+        self.largest_batch = max(self.largest_batch, len(batch))
+        for item in batch:
+            item.done.set()
+
+    def stats(self):
+        with self._cond:
+            return {
+                "running": self._thread is not None,
+                "queued": len(self._queue),
+                "batches": self.batches,
+                "rows": self.rows,
+                "largest_batch": self.largest_batch,
+                "shed": self.shed,
+            }
+
+
+WRITE_BATCHER = WriteBatcher()
+
+
+# Tables whose changes feed the Last-Modified validator of the list endpoints.
+VERSIONED_TABLES = ("users", "diaries", "messages_public", "messages_private", "messages_user")
+SQL_EPOCH_NOW = "((julianday('now') - 2440587.5) * 86400.0)"
+
+
+def _version_trigger_ddl():
+    statements = [
+        "CREATE TABLE IF NOT EXISTS table_versions ("
+        "name TEXT PRIMARY KEY, version INTEGER NOT NULL DEFAULT 0, changed_at REAL)",
+    ]
+    for table in VERSIONED_TABLES:
+        statements.append(
+            f"INSERT OR IGNORE INTO table_versions (name, version, changed_at) VALUES ('{table}', 0, {SQL_EPOCH_NOW})"
+        )
+        for event in ("INSERT", "UPDATE", "DELETE"):
+            statements.append(
+                f"CREATE TRIGGER IF NOT EXISTS trg_{table}_version_{event.lower()} AFTER {event} ON {table} "
+                f"BEGIN UPDATE table_versions SET version=version+1, changed_at={SQL_EPOCH_NOW} "
+                f"WHERE name='{table}'; END"
+            )
+    return tuple(statements)
+
+
+# FTS5 index per searchable table: (table, indexed columns, bm25 column weights)
+FTS_TABLES = (
+    ("diaries", ("title", "content"), (5.0, 1.0)),
+    ("messages_public", ("content",), (1.0,)),
+    ("messages_user", ("content",), (1.0,)),
+)
+
+
+def _fts_ddl():
+    """Full-text tables holding segmented copies of the text, synced by triggers."""
+    statements = []
+    for table, columns, weights in FTS_TABLES:
+        fts = f"{table}_fts"
+        cols = ", ".join(columns)
+        new_values = ", ".join(f"cjk_segment(new.{col})" for col in columns)
+        statements += [
+            f"CREATE VIRTUAL TABLE IF NOT EXISTS {fts} USING fts5({cols}, tokenize='unicode61 remove_diacritics 2')",
+            f"INSERT INTO {fts}({fts}, rank) VALUES ('rank', 'bm25({', '.join(map(str, weights))})')",
+            f"INSERT INTO {fts}(rowid, {cols}) SELECT id, "
+            + ", ".join(f"cjk_segment({col})" for col in columns)
+            + f" FROM {table}",
+            f"CREATE TRIGGER IF NOT EXISTS trg_{table}_fts_insert AFTER INSERT ON {table} "
+            f"BEGIN INSERT INTO {fts}(rowid, {cols}) VALUES (new.id, {new_values}); END",
+            f"CREATE TRIGGER IF NOT EXISTS trg_{table}_fts_update AFTER UPDATE OF {cols} ON {table} "
+            f"BEGIN UPDATE {fts} SET "
+            + ", ".join(f"{col}=cjk_segment(new.{col})" for col in columns)
+            + " WHERE rowid=new.id; END",
+            f"CREATE TRIGGER IF NOT EXISTS trg_{table}_fts_delete AFTER DELETE ON {table} "
+            f"BEGIN DELETE FROM {fts} WHERE rowid=old.id; END",
+        ]
+    return tuple(statements)
+
+
+# Counters kept in the stats table, with the query that recounts each from scratch.
+STATS_QUERIES = {
+    "users": "SELECT COUNT(*) FROM users WHERE role!='admin'",
+    "diaries": "SELECT COUNT(*) FROM diaries",
+    "diaries_public": "SELECT IFNULL(SUM(is_public), 0) FROM diaries",
+    "diary_authors": "SELECT COUNT(DISTINCT author_name) FROM diaries",
+    "messages_public": "SELECT COUNT(*) FROM messages_public",
+    "messages_private": "SELECT COUNT(*) FROM messages_private",
+    "messages_user": "SELECT COUNT(*) FROM messages_user",
+}
+SQL_REBUILD_DIARY_AUTHORS = (
+    "INSERT INTO diary_authors (author_name, diaries) "
+    "SELECT author_name, COUNT(*) FROM diaries WHERE author_name IS NOT NULL GROUP BY author_name"
+)
+
+
+def _bump(name, delta):
+    return f"UPDATE stats SET value = value + ({delta}) WHERE name = '{name}';"
+
+
+def _recount_stats(cur):
+    """Recompute every counter, store it, and return {name: (stored, actual)} for those that drifted."""
+    # read before the rebuild: the diary_authors triggers move the stored count while it runs
+    cur.execute("SELECT name, value FROM stats")
+    stored = dict(cur.fetchall())
+    cur.execute("DELETE FROM diary_authors")
+    cur.execute(SQL_REBUILD_DIARY_AUTHORS)
+    drift = {}
+    for name, sql in STATS_QUERIES.items():
+        cur.execute(sql)
+        actual = cur.fetchone()[0]
+        if stored.get(name) != actual:
+            drift[name] = (stored.get(name), actual)
+        cur.execute("INSERT OR REPLACE INTO stats (name, value) VALUES (?, ?)", (name, actual))
+    return drift
+
+
+def _stats_ddl():
+    """Counters behind the summary endpoints, kept current by triggers on every write."""
+    author_added = (
+        "INSERT INTO diary_authors (author_name, diaries) SELECT new.author_name, 1 "
+        "WHERE new.author_name IS NOT NULL ON CONFLICT(author_name) DO UPDATE SET diaries = diaries + 1;"
+    )
+    author_removed = (
+        "UPDATE diary_authors SET diaries = diaries - 1 WHERE author_name = old.author_name;"
+        "DELETE FROM diary_authors WHERE author_name = old.author_name AND diaries <= 0;"
+    )
+    is_user = "IFNULL({}.role != 'admin', 0)"
+    statements = [
+        "CREATE TABLE IF NOT EXISTS stats (name TEXT PRIMARY KEY, value INTEGER NOT NULL DEFAULT 0) WITHOUT ROWID",
+        # one row per author with a diary; its size is the poster count
+        "CREATE TABLE IF NOT EXISTS diary_authors ("
+        "author_name TEXT PRIMARY KEY NOT NULL, diaries INTEGER NOT NULL) WITHOUT ROWID",
+        SQL_REBUILD_DIARY_AUTHORS,
+        _recount_stats,
+        # users: only non-admin accounts count
+        "CREATE TRIGGER IF NOT EXISTS trg_users_stats_insert AFTER INSERT ON users "
+        f"BEGIN {_bump('users', is_user.format('new'))} END",
+        "CREATE TRIGGER IF NOT EXISTS trg_users_stats_delete AFTER DELETE ON users "
+        f"BEGIN {_bump('users', '-' + is_user.format('old'))} END",
+        "CREATE TRIGGER IF NOT EXISTS trg_users_stats_update AFTER UPDATE OF role ON users "
+        f"BEGIN {_bump('users', is_user.format('new') + ' - ' + is_user.format('old'))} END",
+        # diaries: total, public, and the per-author table
+        "CREATE TRIGGER IF NOT EXISTS trg_diaries_stats_insert AFTER INSERT ON diaries BEGIN "
+        f"{_bump('diaries', 1)} {_bump('diaries_public', 'IFNULL(new.is_public, 0)')} END",
+        "CREATE TRIGGER IF NOT EXISTS trg_diaries_stats_delete AFTER DELETE ON diaries BEGIN "
+        f"{_bump('diaries', -1)} {_bump('diaries_public', '-IFNULL(old.is_public, 0)')} END",
+        "CREATE TRIGGER IF NOT EXISTS trg_diaries_stats_update AFTER UPDATE OF is_public ON diaries BEGIN "
+        f"{_bump('diaries_public', 'IFNULL(new.is_public, 0) - IFNULL(old.is_public, 0)')} END",
+        f"CREATE TRIGGER IF NOT EXISTS trg_diaries_author_insert AFTER INSERT ON diaries BEGIN {author_added} END",
+        f"CREATE TRIGGER IF NOT EXISTS trg_diaries_author_delete AFTER DELETE ON diaries BEGIN {author_removed} END",
+        "CREATE TRIGGER IF NOT EXISTS trg_diaries_author_update AFTER UPDATE OF author_name ON diaries "
+        f"WHEN old.author_name IS NOT new.author_name BEGIN {author_removed} {author_added} END",
+        "CREATE TRIGGER IF NOT EXISTS trg_diary_authors_stats_insert AFTER INSERT ON diary_authors "
+        f"BEGIN {_bump('diary_authors', 1)} END",
+        "CREATE TRIGGER IF NOT EXISTS trg_diary_authors_stats_delete AFTER DELETE ON diary_authors "
+        f"BEGIN {_bump('diary_authors', -1)} END",
+    ]
+    for table in ("messages_public", "messages_private", "messages_user"):
+        statements += [
+            f"CREATE TRIGGER IF NOT EXISTS trg_{table}_stats_insert AFTER INSERT ON {table} "
+            f"BEGIN {_bump(table, 1)} END",
+            f"CREATE TRIGGER IF NOT EXISTS trg_{table}_stats_delete AFTER DELETE ON {table} "
+            f"BEGIN {_bump(table, -1)} END",
+        ]
+    return tuple(statements)
+
+
+# Schema migrations, applied in order by init_db. PRAGMA user_version records
+# the last migration that ran, so each step executes exactly once per database.
+MIGRATIONS = [
+    (
+        1,
+        (
+            "CREATE INDEX IF NOT EXISTS idx_diaries_public_created ON diaries(is_public, created_at)",
+            "CREATE INDEX IF NOT EXISTS idx_diaries_author_created ON diaries(author_name, created_at)",
+            "CREATE INDEX IF NOT EXISTS idx_diaries_created ON diaries(created_at)",
+            "CREATE INDEX IF NOT EXISTS idx_messages_public_visible_created ON messages_public(is_hidden, created_at)",
+            "CREATE INDEX IF NOT EXISTS idx_messages_public_created ON messages_public(created_at)",
+            "CREATE INDEX IF NOT EXISTS idx_messages_private_from_created ON messages_private(from_name, created_at)",
+            "CREATE INDEX IF NOT EXISTS idx_messages_private_to_created ON messages_private(to_name, created_at)",
+            "CREATE INDEX IF NOT EXISTS idx_messages_private_created ON messages_private(created_at)",
+            "CREATE INDEX IF NOT EXISTS idx_messages_user_created ON messages_user(created_at)",
+            "CREATE INDEX IF NOT EXISTS idx_users_created ON users(created_at)",
+        ),
+    ),
+    (
+        2,
+        (
+            "ALTER TABLE sessions ADD COLUMN expires_at REAL",
+            lambda cur: cur.execute(
+                "UPDATE sessions SET expires_at = CAST(strftime('%s', created_at) AS REAL) + ?",
+                (SESSION_TTL,),
+            ),
+            "CREATE INDEX IF NOT EXISTS idx_sessions_expires ON sessions(expires_at)",
+        ),
+    ),
+    (3, _version_trigger_ddl()),
+    (4, _fts_ddl()),
+    (5, _stats_ddl()),
+    (
+        6,
+        (
+            # buckets of the sqlite rate-limit backend, shared by every process on this database
+            "CREATE TABLE IF NOT EXISTS rate_limits ("
+            "key TEXT PRIMARY KEY, tokens REAL NOT NULL, updated REAL NOT NULL) WITHOUT ROWID",
+        ),
+    ),
+    (
+        7,
+        (
+            # one character past the excerpt tells lists whether the diary goes on
+            "ALTER TABLE diaries ADD COLUMN excerpt TEXT "
+            f"GENERATED ALWAYS AS (substr(content, 1, {DIARY_EXCERPT_CHARS + 1})) VIRTUAL",
+            # the list indexes carry every column the lists show, so paging never reads content
+            "DROP INDEX IF EXISTS idx_diaries_public_created",
+            "CREATE INDEX idx_diaries_public_created ON diaries(is_public, created_at, id, author_name, title, excerpt)",
+            "DROP INDEX IF EXISTS idx_diaries_author_created",
+            "CREATE INDEX idx_diaries_author_created ON diaries(author_name, created_at, id, title, excerpt, is_public)",
+            "DROP INDEX IF EXISTS idx_diaries_created",
+            "CREATE INDEX idx_diaries_created ON diaries(created_at, id, author_name, title, excerpt, is_public)",
+        ),
+    ),
+]
+
+
+def apply_migrations(conn):
+    """Bring the schema up to the newest entry in MIGRATIONS."""
+    cur = conn.cursor()
+    for version, steps in MIGRATIONS:
+        cur.execute("BEGIN IMMEDIATE")
+        try:
+            # re-read under the write lock in case another process migrated first
+            cur.execute("PRAGMA user_version")
+            if cur.fetchone()[0] >= version:
+                conn.rollback()
+                continue
+            for step in steps:
+                if callable(step):
+                    step(cur)
+                else:
+                    cur.execute(step)
+            cur.execute(f"PRAGMA user_version={version}")
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+    cur.execute("PRAGMA optimize")
+
+
 def init_db():
-    conn = sqlite3.connect(DB_PATH)
+    conn = connect_db()
     cur = conn.cursor()
     cur.execute(
         """
@@ -168,19 +1093,418 @@ def init_db():
         )
 
     conn.commit()
+    apply_migrations(conn)
     conn.close()
 
+# Queries behind the list endpoints. They live here rather than inline so
+# explain_query_plans() can check every access path against the indexes above.
+# Every list pages by keyset on (created_at, id): :before_created/:before_id
+# come from the client's cursor (or FIRST_PAGE) and :limit is one more than
+# the page size so the handler can tell whether another page exists.
+KEYSET = "(created_at, id) < (:before_created, :before_id)"
+KEYSET_ORDER = "ORDER BY created_at DESC, id DESC LIMIT :limit"
+SQL_PUBLIC_DIARIES = (
+    "SELECT id, author_name, title, excerpt, created_at FROM diaries"
+    f" WHERE is_public=1 AND {KEYSET} {KEYSET_ORDER}"
+)
+SQL_PUBLIC_MESSAGES = (
+    "SELECT id, nickname, content, created_at FROM messages_public"
+    f" WHERE is_hidden=0 AND {KEYSET} {KEYSET_ORDER}"
+)
+SQL_PUBLIC_USER_MESSAGES = f"SELECT id, username, content, created_at FROM messages_user WHERE {KEYSET} {KEYSET_ORDER}"
+SQL_SECRET_DIARIES = (
+    "SELECT id, author_name, title, excerpt, is_public, created_at FROM diaries"
+    f" WHERE author_name=:username AND {KEYSET} {KEYSET_ORDER}"
+)
+# Two index searches merged in created_at order instead of an OR that would
+# force a sort of every matching row; the second branch skips notes to self.
+SQL_SECRET_MESSAGES = f"""
+    SELECT id, from_name, to_name, content, created_at FROM messages_private
+    WHERE from_name=:username AND {KEYSET}
+    UNION ALL
+    SELECT id, from_name, to_name, content, created_at FROM messages_private
+    WHERE to_name=:username AND from_name<>:username AND {KEYSET}
+    {KEYSET_ORDER}
+"""
+SQL_ADMIN_DIARIES = (
+    f"SELECT id, author_name, title, excerpt, is_public, created_at FROM diaries WHERE {KEYSET} {KEYSET_ORDER}"
+)
+# the full text of one diary, read only when a reader opens it
+SQL_DIARY = "SELECT id, author_name, title, content, is_public, created_at, updated_at FROM diaries WHERE id=?"
+SQL_ADMIN_MESSAGES_PUBLIC = (
+    f"SELECT id, nickname, content, is_hidden, created_at FROM messages_public WHERE {KEYSET} {KEYSET_ORDER}"
+)
+SQL_ADMIN_MESSAGES_PRIVATE = (
+    f"SELECT id, from_name, to_name, content, created_at FROM messages_private WHERE {KEYSET} {KEYSET_ORDER}"
+)
+SQL_ADMIN_USERS = (
+    "SELECT id, username, role, registration_ip, created_at, last_login_ip, last_login_at FROM users"
+    f" WHERE {KEYSET} {KEYSET_ORDER}"
+)
+
+# Ranked full-text searches; :query is an FTS5 expression built by fts_query.
+# char(2)/char(3) mark the hits and are turned into <mark> by render_snippet.
+_SNIPPET = f"snippet({{fts}}, -1, char(2), char(3), '…', {SNIPPET_TOKENS})"
+_SEARCH_PAGE = "ORDER BY rank LIMIT :limit OFFSET :offset"
+SQL_SEARCH_DIARIES = (
+    "SELECT d.id, d.author_name, highlight(diaries_fts, 0, char(2), char(3)), "
+    f"{_SNIPPET.format(fts='diaries_fts')}, d.is_public, d.created_at "
+    # CROSS JOIN pins the MATCH as the outer loop; otherwise the planner may scan an author's diaries.
+    "FROM diaries_fts CROSS JOIN diaries d ON d.id = diaries_fts.rowid WHERE diaries_fts MATCH :query"
+)
+SQL_PUBLIC_SEARCH_DIARIES = f"{SQL_SEARCH_DIARIES} AND d.is_public = 1 {_SEARCH_PAGE}"
+SQL_SECRET_SEARCH_DIARIES = f"{SQL_SEARCH_DIARIES} AND d.author_name = :username {_SEARCH_PAGE}"
+SQL_ADMIN_SEARCH_DIARIES = f"{SQL_SEARCH_DIARIES} {_SEARCH_PAGE}"
+SQL_SEARCH_MESSAGES = (
+    f"SELECT m.id, m.nickname, {_SNIPPET.format(fts='messages_public_fts')}, m.is_hidden, m.created_at "
+    "FROM messages_public_fts JOIN messages_public m ON m.id = messages_public_fts.rowid "
+    "WHERE messages_public_fts MATCH :query"
+)
+SQL_PUBLIC_SEARCH_MESSAGES = f"{SQL_SEARCH_MESSAGES} AND m.is_hidden = 0 {_SEARCH_PAGE}"
+SQL_ADMIN_SEARCH_MESSAGES = f"{SQL_SEARCH_MESSAGES} {_SEARCH_PAGE}"
+SQL_PUBLIC_SEARCH_USER_MESSAGES = (
+    f"SELECT m.id, m.username, {_SNIPPET.format(fts='messages_user_fts')}, m.created_at "
+    "FROM messages_user_fts JOIN messages_user m ON m.id = messages_user_fts.rowid "
+    f"WHERE messages_user_fts MATCH :query {_SEARCH_PAGE}"
+)
+
+# (default, max) page sizes for each list endpoint
+PAGE_PUBLIC_DIARIES = (6, 50)
+PAGE_PUBLIC_MESSAGES = (50, 100)
+PAGE_PUBLIC_USER_MESSAGES = (80, 100)
+PAGE_SECRET_DIARIES = (50, 100)
+PAGE_SECRET_MESSAGES = (80, 100)
+# admin pages are streamed, so they may be much larger without costing memory
+PAGE_ADMIN_DIARIES = (50, 1000)
+PAGE_ADMIN_MESSAGES_PUBLIC = (100, 1000)
+PAGE_ADMIN_MESSAGES_PRIVATE = (120, 1000)
+PAGE_ADMIN_USERS = (100, 1000)
+PAGE_SEARCH = (20, 50)
+FIRST_PAGE = ("9999-12-31 23:59:59", 2 ** 63 - 1)
+
+
+class BadRequest(Exception):
+    """Raised for malformed query parameters; handle_api answers 400."""
+
+
+def encode_cursor(created_at, row_id) -> str:
+    raw = json.dumps([created_at, row_id], separators=(",", ":")).encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip("=")
+
+
+def decode_cursor(cursor: str):
+    try:
+        raw = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4))
+        created_at, row_id = json.loads(raw)
+        if not isinstance(created_at, str) or not isinstance(row_id, int):
+            raise ValueError(cursor)
+    except (ValueError, TypeError):  # TypeError: valid JSON that is not a two-item list
+        raise BadRequest("无效的分页游标") from None
+    return created_at, row_id
+
+
+def page_limit(query, page_sizes):
+    default_limit, max_limit = page_sizes
+    limit = query.get("limit", [""])[0]
+    if not limit:
+        return default_limit
+    # isdigit alone accepts digits like "²" that int() rejects
+    if not (limit.isascii() and limit.isdigit()) or int(limit) < 1:
+        raise BadRequest("limit 必须是正整数")
+    return min(int(limit), max_limit)
+
+
+def page_params(query, page_sizes, **params):
+    """Build the named SQL parameters for one keyset page from ``?before=&limit=``."""
+    limit = page_limit(query, page_sizes)
+    before = query.get("before", [""])[0]
+    before_created, before_id = decode_cursor(before) if before else FIRST_PAGE
+    return {**params, "before_created": before_created, "before_id": before_id, "limit": limit + 1}
+
+
+def iter_page(cur, sql, params, to_item, cursor_key, page):
+    """Yield one keyset page item by item straight off the SQLite cursor.
+
+    ``page["next_cursor"]`` is filled in once the generator is exhausted.
+    """
+    page_size = params["limit"] - 1
+    page["next_cursor"] = None
+    cur.execute(sql, params)
+    last = None
+    try:
+        for count, row in enumerate(cur, 1):
+            if count > page_size:
+                page["next_cursor"] = encode_cursor(*cursor_key(last))
+                break
+            last = row
+            yield to_item(row)
+    finally:
+        # release the read snapshot even if the client went away mid-stream
+        cur.close()
+
+
+def fetch_page(cur, sql, params, to_item, cursor_key):
+    """Run a keyset query and return ``{"items": [...], "next_cursor": ...}``."""
+    page_size = params["limit"] - 1
+    cur.execute(sql, params)
+    rows = cur.fetchall()
+    next_cursor = None
+    if len(rows) > page_size:
+        rows = rows[:page_size]
+        next_cursor = encode_cursor(*cursor_key(rows[-1]))
+    return {"items": [to_item(row) for row in rows], "next_cursor": next_cursor}
+
+
+def fts_query(text):
+    """Turn user input into an FTS5 expression: every term must appear as a phrase."""
+    terms = text.split()[:SEARCH_MAX_TERMS]
+    # quoting makes FTS5 operators and punctuation in the input literal
+    return " ".join('"' + cjk_segment(term).replace('"', '""') + '"' for term in terms)
+
+
+def search_params(query, **params):
+    """Build the named parameters for one ranked page from ``?q=&limit=&cursor=``."""
+    text = query.get("q", [""])[0].strip()
+    if not text or len(text) > SEARCH_MAX_QUERY:
+        raise BadRequest(f"搜索内容不能为空，且不超过{SEARCH_MAX_QUERY}字")
+    cursor = query.get("cursor", [""])[0]
+    if cursor and not (cursor.isascii() and cursor.isdigit()):
+        raise BadRequest("无效的分页游标")
+    offset = int(cursor or 0)
+    if offset > SEARCH_MAX_OFFSET:
+        raise BadRequest("搜索结果太靠后了，请换个更具体的关键词")
+    limit = page_limit(query, PAGE_SEARCH)
+    return {**params, "query": fts_query(text), "limit": limit + 1, "offset": offset}
+
+
+def render_snippet(text):
+    """Escape a snippet like stored messages are escaped and turn hit markers into <mark>."""
+    text = (text or "").replace(ZWSP, "").replace("<", "&lt;").replace(">", "&gt;")
+    return text.replace("\x02", "<mark>").replace("\x03", "</mark>")
+
+
+def fetch_search(cur, sql, params, to_item):
+    """Run a ranked search and return ``{"items": [...], "next_cursor": ...}``."""
+    page_size = params["limit"] - 1
+    try:
+        cur.execute(sql, params)
+    except sqlite3.OperationalError as exc:
+        # e.g. a query made only of punctuation leaves FTS5 an empty phrase
+        if "fts5" not in str(exc):
+            raise
+        return {"items": [], "next_cursor": None}
+    rows = cur.fetchall()
+    next_cursor = None
+    if len(rows) > page_size:
+        rows = rows[:page_size]
+        next_cursor = str(params["offset"] + page_size)
+    return {"items": [to_item(row) for row in rows], "next_cursor": next_cursor}
+
+
+def _diary_hit(row):
+    return {
+        "id": row[0],
+        "author": row[1],
+        "title": render_snippet(row[2]),
+        "snippet": render_snippet(row[3]),
+        "is_public": bool(row[4]),
+        "created_at": row[5],
+    }
+
+
+def _message_hit(row):
+    return {"id": row[0], "nickname": row[1] or "匿名", "snippet": render_snippet(row[2]), "created_at": row[4]}
+
+
+def _admin_message_hit(row):
+    return {**_message_hit(row), "is_hidden": bool(row[3])}
+
+
+def _user_message_hit(row):
+    return {"id": row[0], "username": row[1], "snippet": render_snippet(row[2]), "created_at": row[3]}
+
+
+SQL_READ_STATS = f"SELECT name, value FROM stats WHERE name IN ({', '.join(repr(name) for name in STATS_QUERIES)})"
+SQL_RATE_HIT = """
+    INSERT INTO rate_limits (key, tokens, updated) VALUES (:key, :capacity - 1, :now)
+    ON CONFLICT(key) DO UPDATE SET tokens = MIN(:capacity, tokens + (:now - updated) * :rate) - 1, updated = :now
+    WHERE MIN(:capacity, tokens + (:now - updated) * :rate) >= 1
+    RETURNING tokens
+"""
+SQL_RATE_READ = "SELECT tokens, updated FROM rate_limits WHERE key = ?"
+SQL_RATE_REFUND = "UPDATE rate_limits SET tokens = MIN(?, tokens + 1) WHERE key = ?"
+SQL_RATE_SWEEP = "DELETE FROM rate_limits WHERE updated < ?"
+SQL_PRUNE_SESSIONS = (
+    "DELETE FROM sessions WHERE rowid IN (SELECT rowid FROM sessions WHERE expires_at<=? LIMIT ?)"
+)
+
+_SAMPLE_PAGE = {"before_created": FIRST_PAGE[0], "before_id": FIRST_PAGE[1], "limit": 51}
+
+# Columns written per table by the NDJSON export, in primary-key order.
+EXPORT_TABLES = {
+    "diaries": ("id", "author_name", "title", "content", "is_public", "created_at", "updated_at"),
+    "messages_public": ("id", "nickname", "content", "is_hidden", "created_at"),
+    "messages_private": ("id", "from_name", "to_name", "content", "created_at"),
+    "messages_user": ("id", "username", "content", "created_at"),
+}
+
+
+def export_sql(table):
+    return f"SELECT {', '.join(EXPORT_TABLES[table])} FROM {table} WHERE id > ? ORDER BY id"
+
+
+_SAMPLE_SEARCH = {"query": '"x"', "limit": 21, "offset": 0}
+
+# (endpoint, sql, sample params, why a full pass is expected or None)
+QUERY_PLAN_CHECKS = [
+    ("require_token", "SELECT role, username, expires_at FROM sessions WHERE token=? AND expires_at>?", ("t", 0), None),
+    ("prune_expired_sessions", SQL_PRUNE_SESSIONS, (0, SESSION_SWEEP_BATCH), None),
+    ("RateLimiter.hit", SQL_RATE_READ, ("login|127.0.0.1",), None),
+    ("RateLimiter.refund", SQL_RATE_REFUND, (1, "login|127.0.0.1"), None),
+    ("RateLimiter.sweep", SQL_RATE_SWEEP, (0,), "periodic sweep of a small table"),
+    ("api_public_diaries", SQL_PUBLIC_DIARIES, _SAMPLE_PAGE, None),
+    ("api_public_messages", SQL_PUBLIC_MESSAGES, _SAMPLE_PAGE, None),
+    ("api_public_user_messages", SQL_PUBLIC_USER_MESSAGES, _SAMPLE_PAGE, None),
+    ("api_auth_login", "SELECT id, password_hash FROM users WHERE username=? AND role!='admin'", ("u",), None),
+    (
+        "api_auth_me",
+        "SELECT username, created_at, registration_ip, last_login_ip, last_login_at FROM users WHERE username=?",
+        ("u",),
+        None,
+    ),
+    ("api_auth_summary", SQL_READ_STATS, (), None),
+    ("api_secret_diaries", SQL_SECRET_DIARIES, {**_SAMPLE_PAGE, "username": "u"}, None),
+    ("api_secret_diary", SQL_DIARY, (1,), None),
+    ("api_secret_update_diary", "SELECT author_name, title, content, is_public FROM diaries WHERE id=?", (1,), None),
+    ("api_secret_messages", SQL_SECRET_MESSAGES, {**_SAMPLE_PAGE, "username": "u"}, None),
+    ("api_secret_post_message", "SELECT 1 FROM users WHERE username=?", ("u",), None),
+    ("api_admin_summary", SQL_READ_STATS, (), None),
+    ("api_admin_diaries", SQL_ADMIN_DIARIES, _SAMPLE_PAGE, None),
+    ("api_admin_messages_public", SQL_ADMIN_MESSAGES_PUBLIC, _SAMPLE_PAGE, None),
+    ("api_admin_messages_private", SQL_ADMIN_MESSAGES_PRIVATE, _SAMPLE_PAGE, None),
+    ("api_admin_users", SQL_ADMIN_USERS, _SAMPLE_PAGE, None),
+    *[("api_admin_export", export_sql(table), (0,), None) for table in EXPORT_TABLES],
+    *[("reconcile_stats", sql, (), "periodic recount") for sql in STATS_QUERIES.values()],
+    ("api_public_search_diaries", SQL_PUBLIC_SEARCH_DIARIES, _SAMPLE_SEARCH, None),
+    ("api_public_search_messages", SQL_PUBLIC_SEARCH_MESSAGES, _SAMPLE_SEARCH, None),
+    ("api_public_search_user_messages", SQL_PUBLIC_SEARCH_USER_MESSAGES, _SAMPLE_SEARCH, None),
+    ("api_secret_search_diaries", SQL_SECRET_SEARCH_DIARIES, {**_SAMPLE_SEARCH, "username": "u"}, None),
+    ("api_admin_search_diaries", SQL_ADMIN_SEARCH_DIARIES, _SAMPLE_SEARCH, None),
+    ("api_admin_search_messages", SQL_ADMIN_SEARCH_MESSAGES, _SAMPLE_SEARCH, None),
+]
+
+
+def plan_problems(sql, plan_details):
+    """Return the plan lines that read a whole table or sort every match."""
+    bounded = " LIMIT " in " ".join(sql.upper().split())
+    problems = []
+    for detail in plan_details:
+        if detail.startswith("SCAN ") and not detail.startswith("SCAN (") and "CONSTANT ROW" not in detail:
+            # walking an index in ORDER BY order is fine when LIMIT stops it early
+            if not (bounded and "INDEX" in detail):
+                problems.append(detail)
+        elif detail.startswith("USE TEMP B-TREE"):
+            problems.append(detail)
+    return problems
+
+
+def explain_query_plans(conn=None):
+    """Run EXPLAIN QUERY PLAN for every endpoint query.
+
+    Returns (endpoint, plan lines, problems, allowance) tuples; problems are
+    only acceptable when the check lists a reason for a full pass.
+    """
+    conn = conn or get_db()
+    report = []
+    for endpoint, sql, params, allowance in QUERY_PLAN_CHECKS:
+        details = [row[3] for row in conn.execute("EXPLAIN QUERY PLAN " + sql, params)]
+        report.append((endpoint, details, plan_problems(sql, details), allowance))
+    return report
+
+
+def print_query_plans():
+    """Print every endpoint's plan; returns False if an unexpected scan shows up."""
+    ok = True
+    for endpoint, details, problems, allowance in explain_query_plans():
+        status = "ok"
+        if problems:
+            status = f"full pass ({allowance})" if allowance else "SCAN"
+            ok = ok and bool(allowance)
+        print(f"{endpoint}: {status}")
+        for detail in details:
+            print(f"    {detail}")
+    return ok
+
+
+
+class SessionCache:
+    """Bounded LRU of token -> session in front of the sessions table.
+
+    Entries are trusted for ``ttl`` seconds (never past the session's own
+    expiry), so revocations made by other processes are seen within ``ttl``.
+    """
+
+    def __init__(self, max_entries=SESSION_CACHE_SIZE, ttl=SESSION_CACHE_TTL):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, token):
+        now = time.time()
+        with self._lock:
+            entry = self._entries.get(token)
+            if entry is None:
+                return None
+            session, valid_until = entry
+            if valid_until <= now:
+                del self._entries[token]
+                return None
+            self._entries.move_to_end(token)
+            return session
+
+    def put(self, token, session, expires_at):
+        valid_until = min(time.time() + self.ttl, expires_at)
+        with self._lock:
+            self._entries[token] = (session, valid_until)
+            self._entries.move_to_end(token)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, token):
+        with self._lock:
+            self._entries.pop(token, None)
+
+    def prune(self):
+        now = time.time()
+        with self._lock:
+            stale = [token for token, (_, valid_until) in self._entries.items() if valid_until <= now]
+            for token in stale:
+                del self._entries[token]
+        return len(stale)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self):
+        return len(self._entries)
+
+
+SESSION_CACHE = SessionCache()
+
 
 def make_token(role: str, username: str = "") -> str:
     token = secrets.token_urlsafe(24)
-    conn = sqlite3.connect(DB_PATH)
+    expires_at = time.time() + SESSION_TTL
+    conn = get_db()
     cur = conn.cursor()
     cur.execute(
-        "INSERT OR REPLACE INTO sessions (token, role, username) VALUES (?, ?, ?)",
-        (token, role, username),
+        "INSERT OR REPLACE INTO sessions (token, role, username, expires_at) VALUES (?, ?, ?, ?)",
+        (token, role, username, expires_at),
     )
     conn.commit()
-    conn.close()
+    SESSION_CACHE.put(token, {"role": role, "username": username}, expires_at)
     return token
 
 
@@ -189,55 +1513,1081 @@ def require_token(headers, role=None):
     if not auth.startswith("Bearer "):
         return None
     token = auth.split(" ", 1)[1]
-    conn = sqlite3.connect(DB_PATH)
-    cur = conn.cursor()
-    cur.execute("SELECT role, username FROM sessions WHERE token=?", (token,))
-    row = cur.fetchone()
-    conn.close()
-    if not row:
-        return None
-    data = {"role": row[0], "username": row[1] or ""}
+    data = SESSION_CACHE.get(token)
+    if data is None:
+        conn = get_db()
+        cur = conn.cursor()
+        cur.execute(
+            "SELECT role, username, expires_at FROM sessions WHERE token=? AND expires_at>?",
+            (token, time.time()),
+        )
+        row = cur.fetchone()
+        if not row:
+            return None
+        data = {"role": row[0], "username": row[1] or ""}
+        SESSION_CACHE.put(token, data, row[2])
     if role and data["role"] != role:
         return None
     return {**data, "token": token}
 
 
-def check_login_window(ip: str, key: str):
+def revoke_token(token: str):
+    SESSION_CACHE.invalidate(token)
+    conn = get_db()
+    conn.execute("DELETE FROM sessions WHERE token=?", (token,))
+    conn.commit()
+
+
+def reconcile_stats():
+    """Recount the stats table from scratch and return the counters that had drifted.
+
+    Runs under the write lock so no trigger fires between the recount and the
+    write; drift means a write bypassed the triggers (e.g. a manual fix-up).
+    """
+    conn = get_db()
+    cur = conn.cursor()
+    cur.execute("BEGIN IMMEDIATE")
+    try:
+        drift = _recount_stats(cur)
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    for name, (stored, actual) in drift.items():
+        print(f"[stats] {name} drifted: stored {stored}, actual {actual}")
+    return drift
+
+
+def read_stats():
+    cur = get_db().cursor()
+    cur.execute(SQL_READ_STATS)
+    return dict(cur.fetchall())
+
+
+def prune_expired_sessions(batch=SESSION_SWEEP_BATCH):
+    """Delete expired sessions in short transactions so writers are never held up."""
+    conn = get_db()
     now = time.time()
-    attempts = LOGIN_ATTEMPTS.get((ip, key), [])
-    attempts = [t for t in attempts if now - t < LOGIN_WINDOW]
-    if len(attempts) >= LOGIN_MAX_ATTEMPTS:
-        LOGIN_ATTEMPTS[(ip, key)] = attempts
-        return False
-    attempts.append(now)
-    LOGIN_ATTEMPTS[(ip, key)] = attempts
-    return True
+    removed = 0
+    while True:
+        cur = conn.execute(SQL_PRUNE_SESSIONS, (now, batch))
+        conn.commit()
+        removed += cur.rowcount
+        if cur.rowcount < batch:
+            break
+    SESSION_CACHE.prune()
+    return removed
+
+
+class PeriodicTask:
+    """Run ``func`` every ``interval`` seconds on a daemon thread until stopped."""
+
+    def __init__(self, name, interval, func):
+        self.name = name
+        self.interval = interval
+        self.func = func
+        self._stop = threading.Event()
+        self._thread = None
+
+    def _loop(self):
+        while not self._stop.wait(self.interval):
+            try:
+                self.func()
+            except Exception as exc:  # keep sweeping even if one pass fails
+                print(f"[{self.name}] {exc!r}")
+
+    def start(self):
+        self._thread = threading.Thread(target=self._loop, name=self.name, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+
+
+def background_tasks(primary=True):
+    """Periodic jobs for this process; database-wide ones only run in the primary worker."""
+    tasks = [PeriodicTask("rate-limit-sweeper", RATE_LIMIT_SWEEP_INTERVAL, RATE_LIMITER.sweep)]
+    if primary:
+        tasks += [
+            PeriodicTask("session-sweeper", SESSION_SWEEP_INTERVAL, prune_expired_sessions),
+            PeriodicTask("stats-reconciler", STATS_RECONCILE_INTERVAL, reconcile_stats),
+        ]
+    return tasks
+
+
+class RatePolicy:
+    """Token bucket: ``capacity`` requests at once, refilled evenly over ``period`` seconds."""
+
+    __slots__ = ("capacity", "period", "rate", "message")
+
+    def __init__(self, capacity, period, message):
+        self.capacity = capacity
+        self.period = period
+        self.rate = capacity / period
+        self.message = message
+
+
+class TokenBucket:
+    __slots__ = ("tokens", "updated")
+
+    def __init__(self, tokens, updated):
+        self.tokens = tokens
+        self.updated = updated
+
+
+RATE_POLICIES = {
+    "public_message": RatePolicy(1, PUBLIC_MESSAGE_COOLDOWN, "留言太快啦，稍等一下下。"),
+    "register": RatePolicy(LOGIN_MAX_ATTEMPTS, LOGIN_WINDOW, "尝试过于频繁，请稍后再试"),
+    "login": RatePolicy(LOGIN_MAX_ATTEMPTS, LOGIN_WINDOW, "尝试太多，请稍后重试"),
+    "admin_login": RatePolicy(LOGIN_MAX_ATTEMPTS, LOGIN_WINDOW, "尝试太多，请稍后再试"),
+}
+
+class RateLimiter:
+    """Per-client token buckets for the policies in RATE_POLICIES.
+
+    The "memory" backend keeps buckets in lock-striped shards, each an LRU
+    capped at its share of RATE_LIMIT_MAX_KEYS. The "sqlite" backend keeps
+    them in the rate_limits table so every process sharing the database
+    enforces the same limits, at the cost of one write per limited request.
+    A bucket that has refilled is the same as no bucket, so sweeping those
+    loses nothing.
+    """
+
+    def __init__(self, policies, backend="memory", shards=RATE_LIMIT_SHARDS, max_keys=RATE_LIMIT_MAX_KEYS):
+        self.policies = policies
+        self.backend = backend
+        self._shards = [(threading.Lock(), OrderedDict()) for _ in range(shards)]
+        self._shard_keys = max(1, max_keys // shards)
+        self.evicted = 0
+
+    def hit(self, policy_name, client):
+        """Take a token for ``client``; return 0 if allowed, else seconds until one is available."""
+        policy = self.policies[policy_name]
+        now = time.time()
+        if self.backend == "sqlite":
+            return self._hit_sqlite(policy, f"{policy_name}|{client}", now)
+        key = (policy_name, client)
+        lock, buckets = self._shards[hash(key) % len(self._shards)]
+        with lock:
+            bucket = buckets.get(key)
+            if bucket is None:
+                bucket = buckets[key] = TokenBucket(policy.capacity, now)
+                if len(buckets) > self._shard_keys:
+                    buckets.popitem(last=False)
+                    self.evicted += 1
+            else:
+                buckets.move_to_end(key)
+                bucket.tokens = min(policy.capacity, bucket.tokens + (now - bucket.updated) * policy.rate)
+                bucket.updated = now
+            if bucket.tokens < 1:
+                return (1 - bucket.tokens) / policy.rate
+            bucket.tokens -= 1
+            return 0
+
+    def refund(self, policy_name, client):
+        """Give back the token taken by a request that turned out not to count (e.g. a 400)."""
+        policy = self.policies[policy_name]
+        if self.backend == "sqlite":
+            conn = get_db()
+            conn.execute(SQL_RATE_REFUND, (policy.capacity, f"{policy_name}|{client}"))
+            conn.commit()
+            return
+        key = (policy_name, client)
+        lock, buckets = self._shards[hash(key) % len(self._shards)]
+        with lock:
+            bucket = buckets.get(key)
+            if bucket is not None:
+                bucket.tokens = min(policy.capacity, bucket.tokens + 1)
+
+    def _hit_sqlite(self, policy, key, now):
+        conn = get_db()
+        params = {"key": key, "capacity": policy.capacity, "rate": policy.rate, "now": now}
+        try:
+            allowed = conn.execute(SQL_RATE_HIT, params).fetchone() is not None
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        if allowed:
+            return 0
+        row = conn.execute(SQL_RATE_READ, (key,)).fetchone()
+        tokens = min(policy.capacity, row[0] + (now - row[1]) * policy.rate) if row else 0
+        return max(1 - tokens, 0) / policy.rate
+
+    def sweep(self):
+        """Drop buckets that have refilled completely; return how many were dropped."""
+        now = time.time()
+        if self.backend == "sqlite":
+            conn = get_db()
+            longest = max(policy.period for policy in self.policies.values())
+            removed = conn.execute(SQL_RATE_SWEEP, (now - longest,)).rowcount
+            conn.commit()
+            return removed
+        removed = 0
+        for lock, buckets in self._shards:
+            with lock:
+                full = [
+                    key
+                    for key, bucket in buckets.items()
+                    if bucket.tokens + (now - bucket.updated) * self.policies[key[0]].rate >= self.policies[key[0]].capacity
+                ]
+                for key in full:
+                    del buckets[key]
+            removed += len(full)
+        return removed
+
+    def stats(self):
+        return {
+            "backend": self.backend,
+            "buckets": sum(len(buckets) for _, buckets in self._shards),
+            "evicted": self.evicted,
+        }
+
+
+RATE_LIMITER = RateLimiter(RATE_POLICIES)
+
+
+def last_changed(tables):
+    """Epoch seconds of the newest write to any of ``tables`` (None if unknown)."""
+    placeholders = ",".join("?" * len(tables))
+    cur = get_db().execute(f"SELECT MAX(changed_at) FROM table_versions WHERE name IN ({placeholders})", tables)
+    return cur.fetchone()[0]
+
+
+def version_etag(tables, *parts):
+    """Weak ETag from the ``table_versions`` counters of ``tables`` plus ``parts``.
+
+    Lets a streamed response offer a validator before its body exists; any
+    write to one of the tables bumps a counter and so changes the tag.
+    """
+    placeholders = ",".join("?" * len(tables))
+    cur = get_db().execute(
+        f"SELECT name, version, changed_at FROM table_versions WHERE name IN ({placeholders}) ORDER BY name", tables
+    )
+    state = repr((cur.fetchall(), parts)).encode()
+    return "W/" + make_etag(state)
+
+
+def make_etag(body: bytes) -> str:
+    return '"' + hashlib.blake2b(body, digest_size=12).hexdigest() + '"'
+
+
+class CachedBody:
+    __slots__ = ("body", "etag", "last_modified", "variants")
+
+    def __init__(self, body, etag, last_modified):
+        self.body = body
+        self.etag = etag
+        self.last_modified = last_modified
+        self.variants = {}  # compressed encodings of body, filled in as clients ask for them
+
+
+CACHE_PUBLIC_DIARIES = "public_diaries"
+CACHE_PUBLIC_MESSAGES = "public_messages"
+CACHE_PUBLIC_USER_MESSAGES = "public_user_messages"
+
+
+class ResponseCache:
+    """Encoded JSON bodies (``CachedBody``) of the public feeds, keyed per endpoint.
+
+    Entries never expire on their own; the write paths that change a feed
+    call ``invalidate``. Each key carries a generation so a response built
+    from data read before an invalidation is never stored after it. When
+    ``shared`` is set other processes write to the database too, so callers
+    re-check an entry's Last-Modified against table_versions before using it.
+    """
+
+    def __init__(self):
+        self._entries = {}
+        self._generations = {}
+        self._lock = threading.Lock()
+        self.shared = False
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+        self.stale = 0
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+            return entry
+
+    def generation(self, key):
+        with self._lock:
+            return self._generations.get(key, 0)
+
+    def put(self, key, entry, generation):
+        with self._lock:
+            if self._generations.get(key, 0) == generation:
+                self._entries[key] = entry
+
+    def expire(self, key, entry):
+        """Drop ``entry`` found to be out of date, unless it was already replaced."""
+        with self._lock:
+            self.stale += 1
+            if self._entries.get(key) is entry:
+                self._entries.pop(key)
+
+    def invalidate(self, *keys):
+        with self._lock:
+            for key in keys:
+                self._generations[key] = self._generations.get(key, 0) + 1
+                self._entries.pop(key, None)
+                self.invalidations += 1
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_ratio": round(self.hits / lookups, 4) if lookups else 0.0,
+                "invalidations": self.invalidations,
+                "stale": self.stale,
+                "entries": len(self._entries),
+                "bytes": sum(
+                    len(entry.body) + sum(map(len, entry.variants.values())) for entry in self._entries.values()
+                ),
+            }
+
+
+RESPONSE_CACHE = ResponseCache()
+
+
+def _created_cursor(row):
+    # every list query selects id first and created_at last
+    return row[-1], row[0]
+
+
+def excerpt_fields(excerpt):
+    """``excerpt`` and ``truncated`` of a list item from the excerpt column."""
+    excerpt = excerpt or ""
+    return {"excerpt": excerpt[:DIARY_EXCERPT_CHARS], "truncated": len(excerpt) > DIARY_EXCERPT_CHARS}
+
+
+def diary_detail(row):
+    return {
+        "id": row[0],
+        "author": row[1],
+        "title": row[2],
+        "content": row[3],
+        "is_public": bool(row[4]),
+        "created_at": row[5],
+        "updated_at": row[6],
+    }
+
+
+def public_diaries_payload(params):
+    return fetch_page(
+        get_db().cursor(),
+        SQL_PUBLIC_DIARIES,
+        params,
+        lambda row: {
+            "id": row[0],
+            "author": row[1],
+            "title": row[2],
+            **excerpt_fields(row[3]),
+            "created_at": row[4],
+        },
+        _created_cursor,
+    )
+
+
+def public_messages_payload(params):
+    return fetch_page(
+        get_db().cursor(),
+        SQL_PUBLIC_MESSAGES,
+        params,
+        lambda row: {"id": row[0], "nickname": row[1] or "匿名", "content": row[2], "created_at": row[3]},
+        _created_cursor,
+    )
+
+
+def public_user_messages_payload(params):
+    return fetch_page(
+        get_db().cursor(),
+        SQL_PUBLIC_USER_MESSAGES,
+        params,
+        lambda row: {"id": row[0], "username": row[1], "content": row[2], "created_at": row[3]},
+        _created_cursor,
+    )
+
+
+class FeedSubscriber:
+    """One live-feed client: a bounded queue of pre-encoded events plus a wake-up hook.
+
+    ``notify`` is called from the publishing thread; it must only signal the
+    consumer (set an Event, schedule a loop callback), never block.
+    """
+
+    __slots__ = ("events", "limit", "overflowed", "closed", "notify")
+
+    def __init__(self, notify, limit=SSE_CLIENT_BUFFER):
+        self.events = deque()
+        self.limit = limit
+        self.overflowed = False
+        self.closed = False
+        self.notify = notify
+
+    def push(self, payload: bytes):
+        if self.overflowed:
+            return
+        if len(self.events) >= self.limit:
+            # a client this far behind reconnects and resumes from Last-Event-ID
+            self.overflowed = True
+        else:
+            self.events.append(payload)
+        self.notify()
+
+    def drain(self) -> bytes:
+        chunks = []
+        while self.events:
+            chunks.append(self.events.popleft())
+        return b"".join(chunks)
+
+    def close(self):
+        self.closed = True
+        self.notify()
+
+
+class EventBroadcaster:
+    """In-process fan-out of server-sent events to every subscribed client.
+
+    Each event is encoded once and appended to every subscriber's queue; a
+    short history lets reconnecting clients catch up on what they missed.
+    Under a supervisor ``relay`` is the worker's SupervisorLink: events go
+    there to be numbered and come back through ``deliver`` in every worker,
+    so ids agree whichever process a client reconnects to.
+    """
+
+    def __init__(self, history=SSE_HISTORY, buffer_size=SSE_CLIENT_BUFFER):
+        self.buffer_size = buffer_size
+        self._lock = threading.Lock()
+        self._subscribers = set()
+        self._history = deque(maxlen=history)
+        self._last_id = 0
+        self._closed = False
+        self.relay = None
+        self.published = 0
+        self.dropped = 0
+
+    def publish(self, event: str, data):
+        if self.relay is not None:
+            self.relay.publish(event, data)
+        else:
+            self.deliver(None, event, data)
+
+    def deliver(self, event_id, event: str, data):
+        """Fan out one event; ``event_id`` is None to number it here."""
+        with self._lock:
+            self._last_id = self._last_id + 1 if event_id is None else event_id
+            payload = f"id: {self._last_id}\nevent: {event}\ndata: {json.dumps(data)}\n\n".encode()
+            self._history.append((self._last_id, payload))
+            self.published += 1
+            subscribers = list(self._subscribers)
+        for subscriber in subscribers:
+            subscriber.push(payload)
+
+    def subscribe(self, notify, last_event_id=None) -> FeedSubscriber:
+        subscriber = FeedSubscriber(notify, self.buffer_size)
+        with self._lock:
+            if self._closed:
+                subscriber.closed = True
+                return subscriber
+            if last_event_id is not None:
+                oldest = self._history[0][0] if self._history else self._last_id + 1
+                if last_event_id > self._last_id or last_event_id < oldest - 1:
+                    # ids restarted or the gap is older than the history: reload from scratch
+                    subscriber.events.append(b"event: reset\ndata: {}\n\n")
+                else:
+                    subscriber.events.extend(payload for event_id, payload in self._history if event_id > last_event_id)
+            self._subscribers.add(subscriber)
+        if subscriber.events:
+            subscriber.notify()
+        return subscriber
+
+    def resume_from(self, last_id):
+        """Continue numbering after ``last_id`` (a worker joining a running supervisor)."""
+        with self._lock:
+            self._last_id = max(self._last_id, last_id)
+
+    def unsubscribe(self, subscriber):
+        with self._lock:
+            self._subscribers.discard(subscriber)
+            if subscriber.overflowed:
+                self.dropped += 1
+
+    def close(self):
+        """Wake and end every stream; used on shutdown so streaming workers return."""
+        with self._lock:
+            self._closed = True
+            subscribers = list(self._subscribers)
+        for subscriber in subscribers:
+            subscriber.close()
+
+    def stats(self):
+        with self._lock:
+            return {
+                "clients": len(self._subscribers),
+                "published": self.published,
+                "dropped": self.dropped,
+                "last_event_id": self._last_id,
+            }
+
+
+LIVE_FEED = EventBroadcaster()
+
+
+def subsystem_stats():
+    return {
+        "response_cache": RESPONSE_CACHE.stats(),
+        "live_feed": LIVE_FEED.stats(),
+        "group_commit": WRITE_BATCHER.stats(),
+        "rate_limiter": RATE_LIMITER.stats(),
+        "scrypt_pool": {"pending": SCRYPT_POOL.pending, "shed": SCRYPT_POOL.shed},
+        "static_files": STATIC_FILES.stats(),
+        "compression": COMPRESSOR.stats(),
+    }
+
+
+def metrics_snapshot():
+    return {
+        "pid": os.getpid(),
+        "routes": {
+            name: {"requests": statuses, "latency": latency.snapshot()}
+            for name, statuses, latency in METRICS.route_items()
+        },
+        "timers": {name: histogram.snapshot() for name, histogram in METRICS.timers().items()},
+        "subsystems": subsystem_stats(),
+    }
+
+
+def _prometheus_histogram(lines, name, histogram, labels=""):
+    for bound, count in histogram.cumulative():
+        lines.append(f'{name}_bucket{{{labels}le="{bound}"}} {count}')
+    selector = "{" + labels.rstrip(",") + "}" if labels else ""
+    lines.append(f"{name}_sum{selector} {histogram.total}")
+    lines.append(f"{name}_count{selector} {histogram.count}")
+
+
+def prometheus_metrics():
+    """METRICS and the subsystem counters in the Prometheus text exposition format."""
+    routes = METRICS.route_items()
+    lines = [
+        "# HELP garden_requests_total API requests by route and response status (0: client left first).",
+        "# TYPE garden_requests_total counter",
+    ]
+    for name, statuses, _ in routes:
+        for status, count in sorted(statuses.items()):
+            lines.append(f'garden_requests_total{{route="{name}",status="{status}"}} {count}')
+    lines += [
+        "# HELP garden_request_duration_seconds API request latency by route.",
+        "# TYPE garden_request_duration_seconds histogram",
+    ]
+    for name, _, latency in routes:
+        _prometheus_histogram(lines, "garden_request_duration_seconds", latency, f'route="{name}",')
+    for timer, histogram in METRICS.timers().items():
+        lines += [
+            f"# HELP garden_{timer}_seconds Time spent in {timer.replace('_', ' ')}.",
+            f"# TYPE garden_{timer}_seconds histogram",
+        ]
+        _prometheus_histogram(lines, f"garden_{timer}_seconds", histogram)
+    for section, stats in subsystem_stats().items():
+        for key, value in stats.items():
+            if isinstance(value, (int, float)):  # bools count as 0 / 1
+                lines.append(f"garden_{section}_{key} {float(value)}")
+    return "\n".join(lines) + "\n"
+
+
+class ChunkedWriter:
+    """Buffers small writes and frames them as HTTP/1.1 chunks.
+
+    With ``chunked=False`` (HTTP/1.0 clients) the bytes are written as-is and
+    the response ends when the connection closes. A ``compressor``
+    (StreamCompressor) encodes the bytes before they are framed.
+    """
+
+    def __init__(self, wfile, chunked=True, chunk_size=STREAM_CHUNK_SIZE, compressor=None):
+        self.wfile = wfile
+        self.chunked = chunked
+        self.chunk_size = chunk_size
+        self.compressor = compressor
+        self._buffer = []
+        self._buffered = 0
+
+    def write(self, data: bytes):
+        self._buffer.append(data)
+        self._buffered += len(data)
+        if self._buffered >= self.chunk_size:
+            self.flush()
+
+    def flush(self):
+        if not self._buffered:
+            return
+        data = b"".join(self._buffer)
+        self._buffer.clear()
+        self._buffered = 0
+        if self.compressor is not None:
+            data = self.compressor.compress(data)
+        self._send(data)
+
+    def _send(self, data):
+        if not data:
+            return  # an empty chunk would end the body
+        if self.chunked:
+            self.wfile.write(b"%x\r\n%s\r\n" % (len(data), data))
+        else:
+            self.wfile.write(data)
+
+    def close(self):
+        self.flush()
+        if self.compressor is not None:
+            self._send(self.compressor.flush())
+        if self.chunked:
+            self.wfile.write(b"0\r\n\r\n")
+        self.wfile.flush()
+
+
+class Route:
+    """One API endpoint: the handler plus the metadata the dispatcher acts on.
+
+    ``auth`` is None for public routes, "any" for any logged-in session, or the
+    role the session must have. ``limit`` names the RATE_POLICIES entry charged
+    per client IP before the handler runs. A path ending in ``/<id>`` takes one
+    integer id.
+    """
+
+    __slots__ = ("method", "path", "auth", "limit", "name")
+
+    def __init__(self, method, path, handler, auth=None, limit=None):
+        self.method = method
+        self.path = path
+        self.auth = auth
+        self.limit = limit
+        # looked up by name on the handler instance so subclasses can override it
+        self.name = handler.__name__
+
+
+class Router:
+    """Dict lookups for exact paths and ``prefix/<id>`` paths, keyed by method."""
+
+    def __init__(self, routes):
+        self.static = {}
+        self.by_prefix = {}
+        for route in routes:
+            if route.path.endswith("/<id>"):
+                methods = self.by_prefix.setdefault(route.path[: -len("/<id>")], {})
+            else:
+                methods = self.static.setdefault(route.path, {})
+            if route.method in methods:
+                raise ValueError(f"duplicate route {route.method} {route.path}")
+            methods[route.method] = route
+
+    def match(self, method, path):
+        """Return ``(route, args, allowed)``.
+
+        ``route`` is None when nothing matches; ``allowed`` then lists the
+        methods the path does accept (empty for an unknown path).
+        """
+        args = ()
+        methods = self.static.get(path)
+        if methods is None:
+            prefix, _, tail = path.rpartition("/")
+            methods = self.by_prefix.get(prefix)
+            if methods is None or not (tail.isascii() and tail.isdigit()):
+                return None, (), ()
+            args = (int(tail),)
+        route = methods.get(method)
+        if route is None:
+            return None, (), tuple(methods)
+        return route, args, ()
+
+    def __iter__(self):
+        for table in (self.static, self.by_prefix):
+            for methods in table.values():
+                yield from methods.values()
+
+
+def precompress(data):
+    """gzip (and br, with the brotli package) encodings of ``data`` that come out smaller than it."""
+    variants = {"gzip": gzip.compress(data, 9, mtime=0)}
+    if brotli is not None:
+        variants["br"] = brotli.compress(data)
+    return {encoding: body for encoding, body in variants.items() if len(body) < len(data)}
+
+
+def negotiate_encoding(accept_encoding, available):
+    """Pick br or gzip from ``available`` when Accept-Encoding allows it, else identity."""
+    accepted = {}
+    for part in (accept_encoding or "").split(","):
+        coding, _, params = part.partition(";")
+        quality = 1.0
+        match = re.search(r"q=([0-9.]+)", params)
+        if match:
+            try:
+                quality = float(match.group(1))
+            except ValueError:
+                quality = 0.0
+        accepted[coding.strip().lower()] = quality
+    for coding in ("br", "gzip"):
+        if coding in available and accepted.get(coding, accepted.get("*", 0)) > 0:
+            return coding
+    return "identity"
+
+
+class StreamCompressor:
+    """Incremental gzip or br encoder for a streamed response body."""
+
+    def __init__(self, encoding, level):
+        if encoding == "br":
+            encoder = brotli.Compressor(quality=level)
+            self.compress, self.flush = encoder.process, encoder.finish
+        else:
+            encoder = zlib.compressobj(level, zlib.DEFLATED, 31)  # wbits 31: gzip framing
+            self.compress, self.flush = encoder.compress, encoder.flush
+
+
+class ResponseCompressor:
+    """Content-Encoding of API responses, negotiated per request.
+
+    Bodies of at least ``min_bytes`` are compressed at ``level`` for clients
+    that accept br or gzip. Callers holding a body for reuse (the response
+    cache) pass a ``variants`` dict, so each encoding of it is built once.
+    """
+
+    def __init__(self, level=API_COMPRESS_LEVEL, min_bytes=API_COMPRESS_MIN_BYTES):
+        self.level = level
+        self.min_bytes = min_bytes
+        self.encodings = {"gzip", "br"} if brotli is not None else {"gzip"}
+        self._lock = threading.Lock()
+        self.compressed = dict.fromkeys(self.encodings, 0)
+        self.reused = 0
+        self.bytes_in = 0
+        self.bytes_out = 0
+
+    def configure(self, level, min_bytes):
+        self.level = level
+        self.min_bytes = min_bytes
+
+    def applies(self, size=None):
+        """Whether a body of ``size`` bytes (None: not known yet) may be compressed."""
+        return self.level > 0 and (size is None or size >= self.min_bytes)
+
+    def compress(self, body, encoding, variants=None):
+        if variants is not None:
+            encoded = variants.get(encoding)
+            if encoded is not None:
+                with self._lock:
+                    self.reused += 1
+                return encoded
+        if encoding == "br":
+            encoded = brotli.compress(body, quality=self.level)
+        else:
+            encoded = gzip.compress(body, self.level, mtime=0)
+        if variants is not None:
+            variants[encoding] = encoded
+        with self._lock:
+            self.compressed[encoding] += 1
+            self.bytes_in += len(body)
+            self.bytes_out += len(encoded)
+        return encoded
+
+    def stream(self, encoding):
+        with self._lock:
+            self.compressed[encoding] += 1
+        return StreamCompressor(encoding, self.level)
+
+    def stats(self):
+        with self._lock:
+            stats = {f"{encoding}_responses": count for encoding, count in self.compressed.items()}
+            stats.update(
+                reused=self.reused,
+                bytes_in=self.bytes_in,
+                bytes_out=self.bytes_out,
+                ratio=round(self.bytes_out / self.bytes_in, 4) if self.bytes_in else 0.0,
+            )
+            return stats
+
+
+COMPRESSOR = ResponseCompressor()
+
+
+def encoded_etag(etag, encoding):
+    """``etag`` of the identity body turned into the strong validator of another encoding."""
+    return etag if encoding == "identity" else f'{etag[:-1]}-{encoding}"'
+
+
+def _compressible(path):
+    return path.suffix.lower() in STATIC_COMPRESSIBLE
+
+
+def _prebuilt_variants(path, mtime_ns):
+    """``.br``/``.gz`` files next to ``path`` written since it last changed."""
+    variants = {}
+    for encoding, suffix in STATIC_VARIANT_SUFFIXES.items():
+        variant = path.with_name(path.name + suffix)
+        try:
+            stat = variant.stat()
+        except OSError:
+            continue
+        if stat.st_mtime_ns >= mtime_ns:
+            variants[encoding] = (variant, stat.st_size)
+    return variants
+
+
+class StaticAsset:
+    """One file under the static root, with every representation of it we can send.
+
+    ``bodies`` holds the representations kept in memory and ``files`` the ones
+    sent from disk, both keyed by content coding ("identity", "gzip", "br").
+    """
+
+    __slots__ = ("stamp", "mtime", "content_type", "digest", "bodies", "files", "deps", "held")
+
+    def __init__(self, stamp, content_type, digest, bodies, files, deps):
+        self.stamp = stamp
+        self.mtime = stamp[0] / 1e9
+        self.content_type = content_type
+        self.digest = digest
+        self.bodies = bodies
+        self.files = files
+        self.deps = deps  # {path: digest} of the assets an HTML page links to by version
+        self.held = sum(map(len, bodies.values()))
+
+    @property
+    def encodings(self):
+        return self.bodies.keys() | self.files.keys()
+
+    def etag(self, encoding):
+        # each representation needs its own strong validator
+        suffix = "" if encoding == "identity" else f"-{encoding}"
+        return f'"{self.digest}{suffix}"'
+
+
+class StaticFiles:
+    """In-memory index of the files under ``root``, as served to browsers.
+
+    Files are loaded on first use (or by ``warm`` at startup) and re-read once
+    their mtime or size changes. Files up to STATIC_INLINE_BYTES are held in
+    memory together with gzip/br variants; larger ones are sent with sendfile,
+    along with any fresh ``.gz``/``.br`` files written by ``--build-static``.
+    HTML pages get their links to local CSS/JS rewritten to ``?v=<hash>`` URLs,
+    so those can be cached for good. When the cache holds more than
+    ``max_bytes`` the least recently served files are dropped.
+    """
+
+    def __init__(self, root, max_bytes=STATIC_CACHE_BYTES):
+        self.root = root.resolve()
+        self.max_bytes = max_bytes
+        self._assets = OrderedDict()
+        self._lock = threading.Lock()
+        self._held = 0
+        self.hits = 0
+        self.loads = 0
+
+    def resolve(self, url_path):
+        """The file a URL path names, or None if it is missing or outside ``root``."""
+        rel_path = unquote(url_path).lstrip("/")
+        if not rel_path or rel_path.endswith("/"):
+            rel_path += "index.html"
+        target = (self.root / rel_path).resolve()
+        if not target.is_relative_to(self.root) or target.suffix in STATIC_VARIANT_SUFFIXES.values():
+            return None
+        return target if target.is_file() else None
+
+    def get(self, url_path):
+        path = self.resolve(url_path)
+        return None if path is None else self._get(path)
+
+    def warm(self):
+        """Load (and compress) every file now rather than on its first request."""
+        for path in sorted(self.root.rglob("*")):
+            if path.is_file() and path.suffix not in STATIC_VARIANT_SUFFIXES.values():
+                self._get(path)
+
+    def _get(self, path):
+        stamp = self._stamp(path)
+        if stamp is None:
+            return None
+        with self._lock:
+            asset = self._assets.get(path)
+            if asset is not None and asset.stamp == stamp:
+                self._assets.move_to_end(path)
+        if asset is not None and asset.stamp == stamp and self._deps_current(asset):
+            self.hits += 1
+            return asset
+        # loaded outside the lock: two threads loading one file just both do the work
+        asset = self._load(path, stamp)
+        with self._lock:
+            previous = self._assets.pop(path, None)
+            if previous is not None:
+                self._held -= previous.held
+            self._assets[path] = asset
+            self._held += asset.held
+            self.loads += 1
+            while self._held > self.max_bytes and len(self._assets) > 1:
+                _, dropped = self._assets.popitem(last=False)
+                self._held -= dropped.held
+        return asset
+
+    @staticmethod
+    def _stamp(path):
+        """(mtime_ns, size), plus the mtimes of any prebuilt variants a large file is sent from."""
+        try:
+            stat = path.stat()
+        except OSError:
+            return None
+        stamp = (stat.st_mtime_ns, stat.st_size)
+        if stat.st_size > STATIC_INLINE_BYTES and _compressible(path):
+            for suffix in STATIC_VARIANT_SUFFIXES.values():
+                try:
+                    stamp += (path.with_name(path.name + suffix).stat().st_mtime_ns,)
+                except OSError:
+                    stamp += (None,)
+        return stamp
+
+    def _deps_current(self, asset):
+        for path, digest in asset.deps.items():
+            dep = self._get(path)
+            if dep is None or dep.digest != digest:
+                return False
+        return True
+
+    def _load(self, path, stamp):
+        content_type = mimetypes.guess_type(path.name)[0] or "application/octet-stream"
+        if content_type.startswith("text/") or content_type in STATIC_UTF8_TYPES:
+            content_type += "; charset=utf-8"
+        mtime_ns, size = stamp[:2]
+        if size > STATIC_INLINE_BYTES:
+            with open(path, "rb") as file:
+                digest = hashlib.file_digest(file, "sha256").hexdigest()[:16]
+            files = {"identity": (path, size)}
+            if _compressible(path):
+                files.update(_prebuilt_variants(path, mtime_ns))
+            return StaticAsset(stamp, content_type, digest, {}, files, {})
+        body = path.read_bytes()
+        deps = {}
+        if path.suffix.lower() == ".html":
+            body, deps = self._version_links(body)
+        bodies = {"identity": body}
+        if _compressible(path) and len(body) >= STATIC_MIN_COMPRESS_BYTES:
+            prebuilt = {} if deps else _prebuilt_variants(path, mtime_ns)
+            bodies.update({encoding: variant.read_bytes() for encoding, (variant, _) in prebuilt.items()})
+            for encoding, variant in precompress(body).items():
+                bodies.setdefault(encoding, variant)
+        return StaticAsset(stamp, content_type, hashlib.sha256(body).hexdigest()[:16], bodies, {}, deps)
+
+    def _version_links(self, body):
+        """Point the page's local stylesheet and script links at ``?v=<hash>`` URLs."""
+        deps = {}
+
+        def versioned(match):
+            path = self.resolve(match.group(2))
+            asset = None if path is None else self._get(path)
+            if asset is None:
+                return match.group(0)
+            deps[path] = asset.digest
+            return f"{match.group(1)}{match.group(2)}?v={asset.digest}{match.group(3)}"
+
+        text = STATIC_LINK_PATTERN.sub(versioned, body.decode("utf-8"))
+        return text.encode("utf-8"), deps
+
+    def stats(self):
+        with self._lock:
+            return {"files": len(self._assets), "bytes": self._held, "hits": self.hits, "loads": self.loads}
+
+
+STATIC_FILES = StaticFiles(PUBLIC_DIR)
+
+
+def build_static(roots=STATIC_SITE_DIRS):
+    """Write ``.gz``/``.br`` variants next to every compressible file under ``roots``.
+
+    Variants that are already newer than their source are left alone.
+    Returns the number of files written.
+    """
+    written = 0
+    base = Path(__file__).parent
+    for root in roots:
+        for path in sorted(root.rglob("*")):
+            if not path.is_file() or not _compressible(path):
+                continue
+            stat = path.stat()
+            if stat.st_size < STATIC_MIN_COMPRESS_BYTES:
+                continue
+            fresh = _prebuilt_variants(path, stat.st_mtime_ns)
+            wanted = {encoding for encoding in STATIC_VARIANT_SUFFIXES if encoding != "br" or brotli is not None}
+            if wanted <= fresh.keys():
+                continue
+            sizes = []
+            for encoding, body in precompress(path.read_bytes()).items():
+                path.with_name(path.name + STATIC_VARIANT_SUFFIXES[encoding]).write_bytes(body)
+                sizes.append(f"{encoding} {len(body)}")
+                written += 1
+            shown = path.relative_to(base) if path.is_relative_to(base) else path
+            print(f"{shown}: {stat.st_size} -> {', '.join(sizes) or 'not compressible'}")
+    if brotli is None:
+        print("brotli is not installed; only .gz variants were built")
+    return written
 
 
 class GardenHandler(SimpleHTTPRequestHandler):
-    def translate_path(self, path):
-        """Serve files from the /public directory instead of CWD."""
-        rel_path = urlparse(path).path.lstrip("/")
-        if not rel_path:
-            rel_path = "index.html"
-        target = (PUBLIC_DIR / rel_path).resolve()
-        return str(target)
+    # HTTP/1.1 so large responses can use chunked transfer; each connection
+    # still carries a single request unless keep_alive is switched on
+    protocol_version = "HTTP/1.1"
+    keep_alive = False
+    timeout = REQUEST_TIMEOUT
+    response_started = False
+    route = None  # the matched Route, set by handle_api
+    status_code = None  # status of the response sent, for METRICS
+    request_id = None  # X-Request-Id of the API request being handled
+    sql_trace = None  # SqlTrace of the API request while TRACER is active
+    session = None  # {"token", "role", "username"} for routes that require a login
 
     def end_headers(self):
         self.send_header("Access-Control-Allow-Origin", "*")
-        self.send_header("Access-Control-Allow-Headers", "Content-Type, Authorization")
+        self.send_header(
+            "Access-Control-Allow-Headers",
+            "Content-Type, Authorization, If-None-Match, If-Modified-Since, X-Request-Id, X-Debug-Sql",
+        )
+        self.send_header(
+            "Access-Control-Expose-Headers", "ETag, Last-Modified, Content-Disposition, X-Request-Id, Server-Timing"
+        )
+        if self.request_id:
+            self.send_header("X-Request-Id", self.request_id)
+        if self.sql_trace is not None and TRACER.timeline and self.headers.get("X-Debug-Sql") == "1":
+            timing = TRACER.server_timing(self.sql_trace)
+            if timing:
+                self.send_header("Server-Timing", timing)
         self.send_header("Access-Control-Allow-Methods", "GET, POST, PUT, DELETE, OPTIONS")
+        if not self.keep_alive:
+            self.send_header("Connection", "close")
         super().end_headers()
 
     def do_OPTIONS(self):
         self.send_response(200)
+        self.send_header("Content-Length", "0")
         self.end_headers()
 
     def do_GET(self):
         parsed = urlparse(self.path)
         if parsed.path.startswith("/api/"):
             return self.handle_api("GET", parsed)
-        return super().do_GET()
+        return self.serve_static(parsed)
+
+    def do_HEAD(self):
+        parsed = urlparse(self.path)
+        if parsed.path.startswith("/api/"):
+            self.send_error(405)
+            return
+        return self.serve_static(parsed, head=True)
 
     def do_POST(self):
         parsed = urlparse(self.path)
@@ -257,158 +2607,397 @@ class GardenHandler(SimpleHTTPRequestHandler):
             return self.handle_api("DELETE", parsed)
         self.send_error(405)
 
-    def json_body(self):
-        length = int(self.headers.get("Content-Length", 0))
-        if length == 0:
-            return {}
-        data = self.rfile.read(length)
+    def json_body(self):
+        length = int(self.headers.get("Content-Length", 0))
+        if length == 0:
+            return {}
+        data = self.rfile.read(length)
+        try:
+            return json.loads(data.decode())
+        except json.JSONDecodeError:
+            return {}
+
+    def send_response(self, code, message=None):
+        self.status_code = code
+        super().send_response(code, message)
+
+    def send_json(self, data, status=200, headers=None):
+        self.send_body(encode_json(data), status, headers)
+
+    def negotiate_compression(self, size, headers):
+        """Content coding for an API body of ``size`` bytes (None: streamed).
+
+        Adds Accept-Encoding to the Vary entry of ``headers`` whenever the
+        answer could have been different for another client.
+        """
+        if not COMPRESSOR.applies(size):
+            return "identity"
+        vary = headers.get("Vary")
+        headers["Vary"] = f"{vary}, Accept-Encoding" if vary else "Accept-Encoding"
+        return negotiate_encoding(self.headers.get("Accept-Encoding"), COMPRESSOR.encodings)
+
+    def send_body(
+        self, body, status=200, headers=None, content_type="application/json; charset=utf-8", variants=None
+    ):
+        headers = dict(headers or {})
+        encoding = headers.pop("Content-Encoding", None) or self.negotiate_compression(len(body), headers)
+        if encoding != "identity":
+            headers["Content-Encoding"] = encoding
+            body = COMPRESSOR.compress(body, encoding, variants)
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def send_file(self, path, size):
+        with open(path, "rb") as file:
+            self.wfile.flush()
+            if self.connection.sendfile(file, 0, size) < size:
+                # the file shrank under us; the client can only tell from a closed connection
+                self.close_connection = True
+
+    def serve_static(self, parsed, head=False):
+        asset = STATIC_FILES.get(parsed.path)
+        if asset is None:
+            self.send_error(404, "File not found")
+            return
+        encodings = asset.encodings
+        encoding = negotiate_encoding(self.headers.get("Accept-Encoding"), encodings)
+        etag = asset.etag(encoding)
+        versioned = parse_qs(parsed.query).get("v", [None])[0] == asset.digest
+        headers = {
+            "ETag": etag,
+            "Last-Modified": formatdate(asset.mtime, usegmt=True),
+            "Cache-Control": f"public, max-age={STATIC_IMMUTABLE_AGE}, immutable" if versioned else "no-cache",
+        }
+        if len(encodings) > 1:
+            headers["Vary"] = "Accept-Encoding"
+        if encoding != "identity":
+            headers["Content-Encoding"] = encoding
+        if self.not_modified(etag, asset.mtime):
+            self.send_response(304)
+            for name, value in headers.items():
+                self.send_header(name, value)
+            self.end_headers()
+            return
+        body = asset.bodies.get(encoding)
+        path, size = (None, len(body)) if body is not None else asset.files[encoding]
+        self.send_response(200)
+        self.send_header("Content-Type", asset.content_type)
+        self.send_header("Content-Length", str(size))
+        for name, value in headers.items():
+            self.send_header(name, value)
+        self.end_headers()
+        if head:
+            return
+        if body is not None:
+            self.wfile.write(body)
+        else:
+            self.send_file(path, size)
+
+    def start_stream(self, content_type, headers=None):
+        """Send 200 headers for a body of unknown length and return its writer."""
+        headers = dict(headers or {})
+        encoding = headers.pop("Content-Encoding", None) or self.negotiate_compression(None, headers)
+        compressor = None
+        if encoding != "identity":
+            headers["Content-Encoding"] = encoding
+            compressor = COMPRESSOR.stream(encoding)
+        self.send_response(200)
+        self.send_header("Content-Type", content_type)
+        chunked = self.request_version == "HTTP/1.1"
+        if chunked:
+            self.send_header("Transfer-Encoding", "chunked")
+        else:
+            self.close_connection = True
+        for name, value in headers.items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.response_started = True
+        return ChunkedWriter(self.wfile, chunked, compressor=compressor)
+
+    def send_json_stream(self, items, page, tables):
+        """Stream ``{"items": [...], "next_cursor": ...}`` one item at a time.
+
+        Produces the same bytes as ``json.dumps`` of the whole page. The body
+        is not known up front, so the ETag is a weak one built from the table
+        versions, the request target and the caller's role. ``items`` must not
+        have started its query yet: the validators are read before it runs.
+        """
+        # Last-Modified only has whole seconds; the ETag also sees writes within the same second
+        etag = version_etag(tables, self.path, self.session["role"] if self.session else None)
+        last_modified = last_changed(tables)
+        headers = {"Cache-Control": "private, no-cache", "Vary": "Authorization"}
+        encoding = self.negotiate_compression(None, headers)
+        headers["ETag"] = encoded_etag(etag, encoding)
+        if last_modified is not None:
+            headers["Last-Modified"] = formatdate(last_modified, usegmt=True)
+        if self.not_modified(headers["ETag"], last_modified):
+            self.send_response(304)
+            for name, value in headers.items():
+                self.send_header(name, value)
+            self.end_headers()
+            return
+        headers["Content-Encoding"] = encoding
+        out = self.start_stream("application/json; charset=utf-8", headers)
+        out.write(b'{"items": [')
+        separator = b""
+        for item in items:
+            out.write(separator + json.dumps(item).encode())
+            separator = b", "
+        out.write(b'], "next_cursor": ' + json.dumps(page["next_cursor"]).encode() + b"}")
+        out.close()
+
+    def client_disconnected(self):
         try:
-            return json.loads(data.decode())
-        except json.JSONDecodeError:
-            return {}
+            readable, _, _ = select.select([self.connection], [], [], 0)
+            return bool(readable) and not self.connection.recv(1, socket.MSG_PEEK)
+        except OSError:
+            return True
 
-    def send_json(self, data, status=200):
-        self.send_response(status)
-        self.send_header("Content-Type", "application/json; charset=utf-8")
+    def last_event_id(self):
+        value = self.headers.get("Last-Event-ID") or self.query.get("last_event_id", [""])[0]
+        return int(value) if value.isascii() and value.isdigit() else None
+
+    def start_event_stream(self):
+        """Send the headers of a text/event-stream response delimited by connection close."""
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream; charset=utf-8")
+        self.send_header("Cache-Control", "no-cache")
+        self.send_header("X-Accel-Buffering", "no")
+        if self.keep_alive:
+            self.send_header("Connection", "close")
         self.end_headers()
-        self.wfile.write(json.dumps(data).encode())
+        self.close_connection = True
+        self.response_started = True
+        self.wfile.write(f"retry: {SSE_RETRY_MS}\n\n".encode())
+        self.wfile.flush()
+
+    def send_search(self, sql, to_item, **params):
+        self.send_json(fetch_search(get_db().cursor(), sql, search_params(self.query, **params), to_item))
+
+    def send_cached_json(self, key, build, page_sizes, tables):
+        params = page_params(self.query, page_sizes)
+        if params["before_id"] != FIRST_PAGE[1] or params["limit"] != page_sizes[0] + 1:
+            # only the default first page, which every visitor loads, is cached
+            return self.send_list_json(build(params), tables, private=False)
+        entry = RESPONSE_CACHE.get(key)
+        if entry is not None and RESPONSE_CACHE.shared and entry.last_modified != last_changed(tables):
+            # another worker process changed the feed; its invalidate() never reached this cache
+            RESPONSE_CACHE.expire(key, entry)
+            entry = None
+        if entry is None:
+            generation = RESPONSE_CACHE.generation(key)
+            # read the change time first so Last-Modified never claims newer data than the body
+            last_modified = last_changed(tables)
+            body = encode_json(build(params))
+            entry = CachedBody(body, make_etag(body), last_modified)
+            RESPONSE_CACHE.put(key, entry, generation)
+        self.send_validated(entry.body, entry.etag, entry.last_modified, variants=entry.variants)
+
+    def send_list_json(self, data, tables, private=True):
+        """Send a list or detail response with ETag/Last-Modified validators."""
+        last_modified = last_changed(tables)
+        body = encode_json(data)
+        self.send_validated(body, make_etag(body), last_modified, private=private)
+
+    def send_validated(self, body, etag, last_modified, private=False, variants=None):
+        headers = {"Cache-Control": "private, no-cache" if private else "no-cache"}
+        if private:
+            headers["Vary"] = "Authorization"
+        encoding = self.negotiate_compression(len(body), headers)
+        # each encoding is its own representation and needs its own strong validator
+        etag = encoded_etag(etag, encoding)
+        headers["ETag"] = etag
+        if last_modified is not None:
+            headers["Last-Modified"] = formatdate(last_modified, usegmt=True)
+        if self.not_modified(etag, last_modified):
+            self.send_response(304)
+            for name, value in headers.items():
+                self.send_header(name, value)
+            self.end_headers()
+            return
+        headers["Content-Encoding"] = encoding
+        self.send_body(body, 200, headers, variants=variants)
+
+    def not_modified(self, etag, last_modified):
+        if_none_match = self.headers.get("If-None-Match")
+        if if_none_match is not None:
+            if etag is None:
+                return False
+            # If-None-Match wins over If-Modified-Since; compare weakly as RFC 9110 asks
+            candidates = [tag.strip().removeprefix("W/") for tag in if_none_match.split(",")]
+            return "*" in candidates or etag.removeprefix("W/") in candidates
+        if_modified_since = self.headers.get("If-Modified-Since")
+        if if_modified_since and last_modified is not None:
+            try:
+                since = parsedate_to_datetime(if_modified_since).timestamp()
+            except (TypeError, ValueError):
+                return False
+            # HTTP dates drop the fraction of changed_at, so a write later in the same second as the
+            # client's date still counts as modified; clients sending the ETag get their 304 from it
+            return last_modified <= since
+        return False
 
     def handle_api(self, method, parsed):
+        self.route = self.status_code = None
+        request_id = self.headers.get("X-Request-Id", "")
+        self.request_id = request_id if REQUEST_ID.fullmatch(request_id) else secrets.token_hex(8)
+        self.sql_trace = TRACER.begin(self.request_id) if TRACER.active else None
+        started = time.perf_counter()
+        try:
+            self.dispatch_api(method, parsed)
+        finally:
+            # status 0: the client went away before any response was sent
+            name = self.route.name if self.route else "unmatched"
+            METRICS.observe_request(name, self.status_code or 0, time.perf_counter() - started)
+            if self.sql_trace is not None:
+                TRACER.finish(self.sql_trace, name)
+
+    def dispatch_api(self, method, parsed):
         path = parsed.path
+        self.query = parse_qs(parsed.query)
+        charged = None  # rate-limit policy a token was taken from
         try:
-            if path == "/api/public/diaries" and method == "GET":
-                return self.api_public_diaries()
-            if path == "/api/public/messages" and method == "GET":
-                return self.api_public_messages()
-            if path == "/api/public/messages" and method == "POST":
-                return self.api_post_public_message()
-            if path == "/api/public/user-messages" and method == "GET":
-                return self.api_public_user_messages()
-            if path == "/api/auth/register" and method == "POST":
-                return self.api_auth_register()
-            if path == "/api/auth/login" and method == "POST":
-                return self.api_auth_login()
-            if path == "/api/auth/me" and method == "GET":
-                return self.api_auth_me()
-            if path == "/api/auth/summary" and method == "GET":
-                return self.api_auth_summary()
-            if path == "/api/secret/diaries" and method == "GET":
-                return self.api_secret_diaries()
-            if path == "/api/secret/diaries" and method == "POST":
-                return self.api_secret_create_diary()
-            if path.startswith("/api/secret/diaries/") and method == "PUT":
-                return self.api_secret_update_diary(path)
-            if path.startswith("/api/secret/diaries/") and method == "DELETE":
-                return self.api_secret_delete_diary(path)
-            if path == "/api/secret/messages" and method == "GET":
-                return self.api_secret_messages()
-            if path == "/api/secret/messages" and method == "POST":
-                return self.api_secret_post_message()
-            if path == "/api/secret/user-messages" and method == "POST":
-                return self.api_secret_post_user_message()
-            if path == "/api/admin/login" and method == "POST":
-                return self.api_admin_login()
-            if path == "/api/admin/summary" and method == "GET":
-                return self.api_admin_summary()
-            if path == "/api/admin/diaries" and method == "GET":
-                return self.api_admin_diaries()
-            if path.startswith("/api/admin/diaries/") and method == "PUT":
-                return self.api_admin_toggle_public(path)
-            if path == "/api/admin/messages/public" and method == "GET":
-                return self.api_admin_messages_public()
-            if path == "/api/admin/messages/private" and method == "GET":
-                return self.api_admin_messages_private()
-            if path.startswith("/api/admin/messages/public/") and method == "PUT":
-                return self.api_admin_update_public_message(path)
-            if path.startswith("/api/admin/messages/public/") and method == "DELETE":
-                return self.api_admin_delete_public_message(path)
-            if path.startswith("/api/admin/messages/private/") and method == "DELETE":
-                return self.api_admin_delete_private_message(path)
-            if path == "/api/admin/users" and method == "GET":
-                return self.api_admin_users()
-            return self.send_json({"error": "Not found"}, 404)
-        except Exception as exc:  # pragma: no cover - logging omitted for brevity
+            route, args, allowed = ROUTER.match(method, path)
+            if route is None:
+                if allowed:
+                    allow = ", ".join((*allowed, "OPTIONS"))
+                    return self.send_json({"error": "Method not allowed"}, 405, {"Allow": allow})
+                return self.send_json({"error": "Not found"}, 404)
+            self.route = route
+            if route.limit:
+                retry_after = RATE_LIMITER.hit(route.limit, self.client_address[0])
+                if retry_after:
+                    message = RATE_LIMITER.policies[route.limit].message
+                    return self.send_json({"error": message}, 429, {"Retry-After": str(math.ceil(retry_after))})
+                charged = route.limit
+            if route.auth:
+                self.session = require_token(self.headers, role=None if route.auth == "any" else route.auth)
+                if not self.session:
+                    return self.send_json({"error": "未授权" if route.auth == "admin" else "未登录"}, 401)
+            return getattr(self, route.name)(*args)
+        except BadRequest as exc:
+            self.send_json({"error": str(exc)}, 400)
+        except AuthOverloaded:
+            self.send_json({"error": "登录的人太多啦，请稍后再试"}, 503, {"Retry-After": "1"})
+        except WriteOverloaded:
+            self.send_json({"error": "留言的人太多啦，请稍后再试"}, 503, {"Retry-After": "1"})
+        except (BrokenPipeError, ConnectionResetError):
+            self.close_connection = True
+        except Exception as exc:
+            print(f"[{self.request_id}] {method} {path} failed")
+            traceback.print_exc()
+            conn = get_db()
+            if conn.in_transaction:
+                conn.rollback()
+            if self.response_started:
+                # a streamed body is already on the wire; cut it short instead
+                self.close_connection = True
+                return
             self.send_json({"error": "Server error", "detail": str(exc)}, 500)
+        finally:
+            if charged and self.status_code in (400, 503):
+                # rejected or shed before anything happened; the retry (after Retry-After) should not be throttled
+                RATE_LIMITER.refund(charged, self.client_address[0])
 
     # --- Public endpoints
     def api_public_diaries(self):
-        conn = sqlite3.connect(DB_PATH)
-        cur = conn.cursor()
-        cur.execute(
-            "SELECT id, author_name, title, content, created_at FROM diaries WHERE is_public=1 ORDER BY created_at DESC LIMIT 6"
-        )
-        diaries = [
-            {
-                "id": row[0],
-                "author": row[1],
-                "title": row[2],
-                "excerpt": (row[3] or "")[:120],
-                "created_at": row[4],
-            }
-            for row in cur.fetchall()
-        ]
-        conn.close()
-        self.send_json({"items": diaries})
+        self.send_cached_json(CACHE_PUBLIC_DIARIES, public_diaries_payload, PAGE_PUBLIC_DIARIES, ("diaries",))
+
+    def api_public_diary(self, diary_id):
+        cur = get_db().cursor()
+        cur.execute(SQL_DIARY, (diary_id,))
+        row = cur.fetchone()
+        if not row or not row[4]:
+            # private diaries are indistinguishable from missing ones here
+            return self.send_json({"error": "未找到日记"}, 404)
+        self.send_list_json(diary_detail(row), ("diaries",), private=False)
 
     def api_public_messages(self):
-        conn = sqlite3.connect(DB_PATH)
-        cur = conn.cursor()
-        cur.execute(
-            "SELECT id, nickname, content, created_at FROM messages_public WHERE is_hidden=0 ORDER BY created_at DESC LIMIT 50"
+        self.send_cached_json(
+            CACHE_PUBLIC_MESSAGES, public_messages_payload, PAGE_PUBLIC_MESSAGES, ("messages_public",)
         )
-        messages = [
-            {"id": row[0], "nickname": row[1] or "匿名", "content": row[2], "created_at": row[3]}
-            for row in cur.fetchall()
-        ]
-        conn.close()
-        self.send_json({"items": messages})
 
     def api_public_user_messages(self):
-        conn = sqlite3.connect(DB_PATH)
-        cur = conn.cursor()
-        cur.execute(
-            """
-            SELECT id, username, content, created_at
-            FROM messages_user
-            ORDER BY created_at DESC
-            LIMIT 80
-            """
-        )
-        items = [
-            {"id": row[0], "username": row[1], "content": row[2], "created_at": row[3]}
-            for row in cur.fetchall()
-        ]
-        conn.close()
-        self.send_json({"items": items})
+        self.send_cached_json(
+            CACHE_PUBLIC_USER_MESSAGES, public_user_messages_payload, PAGE_PUBLIC_USER_MESSAGES, ("messages_user",)
+        )
 
-    def api_post_public_message(self):
-        ip = self.client_address[0]
-        now = time.time()
-        if ip in LAST_PUBLIC_MESSAGE and now - LAST_PUBLIC_MESSAGE[ip] < PUBLIC_MESSAGE_COOLDOWN:
-            return self.send_json({"error": "留言太快啦，稍等一下下。"}, 429)
+    def api_public_stream(self):
+        """Push new and moderated messages over SSE, holding this worker thread.
 
+        Only a share of the worker pool may stream at once so live clients
+        cannot starve ordinary requests; single mode has no share at all.
+        """
+        slots = getattr(self.server, "stream_slots", None)
+        if slots is None or not slots.acquire(blocking=False):
+            return self.send_json({"error": "实时推送暂不可用，请稍后刷新"}, 503, {"Retry-After": "30"})
+        wake = threading.Event()
+        subscriber = LIVE_FEED.subscribe(wake.set, self.last_event_id())
+        try:
+            self.start_event_stream()
+            idle = 0
+            while not subscriber.closed:
+                if not wake.wait(SSE_DISCONNECT_POLL):
+                    # give the slot back soon after the browser goes away
+                    if self.client_disconnected():
+                        break
+                    idle += SSE_DISCONNECT_POLL
+                    if idle < SSE_HEARTBEAT:
+                        continue
+                wake.clear()
+                idle = 0
+                if subscriber.overflowed:
+                    break
+                self.wfile.write(subscriber.drain() or b": ping\n\n")
+                self.wfile.flush()
+        finally:
+            LIVE_FEED.unsubscribe(subscriber)
+            slots.release()
+
+    def api_post_public_message(self):
         data = self.json_body()
         nickname = (data.get("nickname") or "匿名").strip()[:24]
         content = (data.get("content") or "").strip()
         if not content or len(content) > 260:
             return self.send_json({"error": "内容不能为空，且不超过260字"}, 400)
         safe_content = content.replace("<", "&lt;").replace(">", "&gt;")
-        conn = sqlite3.connect(DB_PATH)
-        cur = conn.cursor()
-        cur.execute(
-            "INSERT INTO messages_public (nickname, content) VALUES (?, ?)",
+        msg_id, created_at = WRITE_BATCHER.execute(
+            "INSERT INTO messages_public (nickname, content) VALUES (?, ?) RETURNING id, created_at",
             (nickname, safe_content),
         )
-        conn.commit()
-        conn.close()
-        LAST_PUBLIC_MESSAGE[ip] = now
+        RESPONSE_CACHE.invalidate(CACHE_PUBLIC_MESSAGES)
+        LIVE_FEED.publish(
+            "public_message", {"id": msg_id, "nickname": nickname or "匿名", "content": safe_content, "created_at": created_at}
+        )
         self.send_json({"message": "感谢你的轻声留言"}, 201)
 
+    # --- Search (ranked by bm25, paged with ?cursor=)
+    def api_public_search_diaries(self):
+        self.send_search(SQL_PUBLIC_SEARCH_DIARIES, _diary_hit)
+
+    def api_public_search_messages(self):
+        self.send_search(SQL_PUBLIC_SEARCH_MESSAGES, _message_hit)
+
+    def api_public_search_user_messages(self):
+        self.send_search(SQL_PUBLIC_SEARCH_USER_MESSAGES, _user_message_hit)
+
+    def api_secret_search_diaries(self):
+        self.send_search(SQL_SECRET_SEARCH_DIARIES, _diary_hit, username=self.session["username"])
+
+    def api_admin_search_diaries(self):
+        self.send_search(SQL_ADMIN_SEARCH_DIARIES, _diary_hit)
+
+    def api_admin_search_messages(self):
+        self.send_search(SQL_ADMIN_SEARCH_MESSAGES, _admin_message_hit)
+
     # --- Auth endpoints
     def api_auth_register(self):
         ip = self.client_address[0]
-        if not check_login_window(ip, "register"):
-            return self.send_json({"error": "尝试过于频繁，请稍后再试"}, 429)
         data = self.json_body()
         username = (data.get("username") or "").strip()
         password = data.get("password") or ""
@@ -417,59 +3006,56 @@ class GardenHandler(SimpleHTTPRequestHandler):
             return self.send_json({"error": "用户名至少3个字符，密码至少6位"}, 400)
         if password != confirm:
             return self.send_json({"error": "两次输入的密码不一致"}, 400)
-        conn = sqlite3.connect(DB_PATH)
+        password_hash = SCRYPT_POOL.hash(password)
+        conn = get_db()
         cur = conn.cursor()
         try:
             cur.execute(
                 "INSERT INTO users (username, role, password_hash, registration_ip) VALUES (?, ?, ?, ?)",
-                (username, "user", hash_password(password), ip),
+                (username, "user", password_hash, ip),
             )
             conn.commit()
         except sqlite3.IntegrityError:
-            conn.close()
+            conn.rollback()
             return self.send_json({"error": "用户名已存在"}, 409)
-        conn.close()
         token = make_token("user", username)
         self.send_json({"token": token, "username": username}, 201)
 
     def api_auth_login(self):
         ip = self.client_address[0]
-        if not check_login_window(ip, "login"):
-            return self.send_json({"error": "尝试太多，请稍后重试"}, 429)
         data = self.json_body()
         username = data.get("username", "")
         password = data.get("password", "")
-        conn = sqlite3.connect(DB_PATH)
+        conn = get_db()
         cur = conn.cursor()
         cur.execute(
             "SELECT id, password_hash FROM users WHERE username=? AND role!='admin'",
             (username,),
         )
         row = cur.fetchone()
-        if not row or not verify_password(password, row[1]):
-            conn.close()
+        if not row or not SCRYPT_POOL.verify(password, row[1]):
             return self.send_json({"error": "账号或密码错误"}, 401)
+        password_hash = SCRYPT_POOL.hash(password) if needs_rehash(row[1]) else row[1]
         cur.execute(
-            "UPDATE users SET last_login_ip=?, last_login_at=CURRENT_TIMESTAMP WHERE id=?",
-            (ip, row[0]),
+            "UPDATE users SET password_hash=?, last_login_ip=?, last_login_at=CURRENT_TIMESTAMP WHERE id=?",
+            (password_hash, ip, row[0]),
         )
         conn.commit()
-        conn.close()
         token = make_token("user", username)
         self.send_json({"token": token, "username": username})
 
+    def api_auth_logout(self):
+        revoke_token(self.session["token"])
+        self.send_json({"message": "已退出登录"})
+
     def api_auth_me(self):
-        session = require_token(self.headers, role="user")
-        if not session:
-            return self.send_json({"error": "未登录"}, 401)
-        conn = sqlite3.connect(DB_PATH)
+        conn = get_db()
         cur = conn.cursor()
         cur.execute(
             "SELECT username, created_at, registration_ip, last_login_ip, last_login_at FROM users WHERE username=?",
-            (session["username"],),
+            (self.session["username"],),
         )
         row = cur.fetchone()
-        conn.close()
         if not row:
             return self.send_json({"error": "未找到用户"}, 404)
         self.send_json(
@@ -483,385 +3069,1184 @@ class GardenHandler(SimpleHTTPRequestHandler):
         )
 
     def api_auth_summary(self):
-        if not require_token(self.headers, role="user"):
-            return self.send_json({"error": "未登录"}, 401)
-        conn = sqlite3.connect(DB_PATH)
-        cur = conn.cursor()
-        cur.execute("SELECT COUNT(*) FROM users WHERE role!='admin'")
-        user_count = cur.fetchone()[0]
-        cur.execute("SELECT COUNT(DISTINCT author_name) FROM diaries")
-        poster_count = cur.fetchone()[0]
-        cur.execute("SELECT COUNT(*) FROM messages_user")
-        user_messages = cur.fetchone()[0]
-        conn.close()
+        stats = read_stats()
         self.send_json(
             {
-                "user_count": user_count,
-                "poster_count": poster_count,
-                "user_messages": user_messages,
+                "user_count": stats["users"],
+                "poster_count": stats["diary_authors"],
+                "user_messages": stats["messages_user"],
             }
         )
 
     # --- Secret zone
     def api_secret_diaries(self):
-        session = require_token(self.headers, role="user")
-        if not session:
-            return self.send_json({"error": "未登录"}, 401)
-        conn = sqlite3.connect(DB_PATH)
-        cur = conn.cursor()
-        cur.execute(
-            """
-            SELECT id, author_name, title, content, is_public, created_at
-            FROM diaries
-            WHERE author_name=?
-            ORDER BY created_at DESC
-            """,
-            (session["username"],),
-        )
-        items = [
-            {
+        params = page_params(self.query, PAGE_SECRET_DIARIES, username=self.session["username"])
+        page = fetch_page(
+            get_db().cursor(),
+            SQL_SECRET_DIARIES,
+            params,
+            lambda row: {
                 "id": row[0],
                 "author": row[1],
                 "title": row[2],
-                "content": row[3],
+                **excerpt_fields(row[3]),
                 "is_public": bool(row[4]),
                 "created_at": row[5],
-                "can_edit": row[1] == session["username"],
-            }
-            for row in cur.fetchall()
-        ]
-        conn.close()
-        self.send_json({"items": items})
+                "can_edit": row[1] == self.session["username"],
+            },
+            _created_cursor,
+        )
+        self.send_list_json(page, ("diaries",))
+
+    def api_secret_diary(self, diary_id):
+        cur = get_db().cursor()
+        cur.execute(SQL_DIARY, (diary_id,))
+        row = cur.fetchone()
+        if not row:
+            return self.send_json({"error": "未找到日记"}, 404)
+        if row[1] != self.session["username"]:
+            return self.send_json({"error": "无权查看他人日记"}, 403)
+        self.send_list_json(diary_detail(row), ("diaries",))
 
     def api_secret_create_diary(self):
-        session = require_token(self.headers, role="user")
-        if not session:
-            return self.send_json({"error": "未登录"}, 401)
         data = self.json_body()
-        author = session["username"]
+        author = self.session["username"]
         title = (data.get("title") or "无题").strip()[:80]
         content = (data.get("content") or "").strip()
         is_public = 1 if data.get("is_public") else 0
         if not content:
             return self.send_json({"error": "内容不能为空"}, 400)
-        conn = sqlite3.connect(DB_PATH)
+        conn = get_db()
         cur = conn.cursor()
         cur.execute(
             "INSERT INTO diaries (author_name, title, content, is_public) VALUES (?, ?, ?, ?)",
             (author, title, content, is_public),
         )
         conn.commit()
-        conn.close()
+        if is_public:
+            RESPONSE_CACHE.invalidate(CACHE_PUBLIC_DIARIES)
         self.send_json({"message": "已种下一朵花"}, 201)
 
-    def api_secret_update_diary(self, path):
-        session = require_token(self.headers, role="user")
-        if not session:
-            return self.send_json({"error": "未登录"}, 401)
-        diary_id = path.rsplit("/", 1)[-1]
-        conn = sqlite3.connect(DB_PATH)
+    def api_secret_update_diary(self, diary_id):
+        conn = get_db()
         cur = conn.cursor()
-        cur.execute("SELECT author_name, title, content FROM diaries WHERE id=?", (diary_id,))
+        cur.execute("SELECT author_name, title, content, is_public FROM diaries WHERE id=?", (diary_id,))
         owner = cur.fetchone()
         if not owner:
-            conn.close()
             return self.send_json({"error": "未找到日记"}, 404)
-        if owner[0] != session["username"]:
-            conn.close()
+        if owner[0] != self.session["username"]:
             return self.send_json({"error": "无权编辑他人日记"}, 403)
         data = self.json_body()
         current_title = owner[1] or "无题"
         current_content = owner[2] or ""
         new_title = (data.get("title") or current_title).strip()[:80]
         new_content = (data.get("content") or current_content).strip()
+        is_public = 1 if data.get("is_public") else 0
         cur.execute(
             "UPDATE diaries SET title=?, content=?, is_public=?, updated_at=CURRENT_TIMESTAMP WHERE id=?",
             (
                 new_title or "无题",
                 new_content,
-                1 if data.get("is_public") else 0,
+                is_public,
                 diary_id,
             ),
         )
         conn.commit()
-        conn.close()
+        if is_public or owner[3]:
+            RESPONSE_CACHE.invalidate(CACHE_PUBLIC_DIARIES)
         self.send_json({"message": "日记已更新"})
 
-    def api_secret_delete_diary(self, path):
-        session = require_token(self.headers, role="user")
-        if not session:
-            return self.send_json({"error": "未登录"}, 401)
-        diary_id = path.rsplit("/", 1)[-1]
-        conn = sqlite3.connect(DB_PATH)
+    def api_secret_delete_diary(self, diary_id):
+        conn = get_db()
         cur = conn.cursor()
-        cur.execute("SELECT author_name FROM diaries WHERE id=?", (diary_id,))
+        cur.execute("SELECT author_name, is_public FROM diaries WHERE id=?", (diary_id,))
         owner = cur.fetchone()
         if not owner:
-            conn.close()
             return self.send_json({"error": "未找到日记"}, 404)
-        if owner[0] != session["username"]:
-            conn.close()
+        if owner[0] != self.session["username"]:
             return self.send_json({"error": "无权删除他人日记"}, 403)
         cur.execute("DELETE FROM diaries WHERE id=?", (diary_id,))
         conn.commit()
-        conn.close()
+        if owner[1]:
+            RESPONSE_CACHE.invalidate(CACHE_PUBLIC_DIARIES)
         self.send_json({"message": "删除完成"})
 
     def api_secret_messages(self):
-        session = require_token(self.headers, role="user")
-        if not session:
-            return self.send_json({"error": "未登录"}, 401)
-        conn = sqlite3.connect(DB_PATH)
-        cur = conn.cursor()
-        cur.execute(
-            """
-            SELECT id, from_name, to_name, content, created_at
-            FROM messages_private
-            WHERE from_name=? OR to_name=?
-            ORDER BY created_at DESC
-            LIMIT 80
-            """,
-            (session["username"], session["username"]),
-        )
-        items = [
-            {
+        params = page_params(self.query, PAGE_SECRET_MESSAGES, username=self.session["username"])
+        page = fetch_page(
+            get_db().cursor(),
+            SQL_SECRET_MESSAGES,
+            params,
+            lambda row: {
                 "id": row[0],
                 "from_name": row[1],
                 "to_name": row[2],
                 "content": row[3],
                 "created_at": row[4],
-            }
-            for row in cur.fetchall()
-        ]
-        conn.close()
-        self.send_json({"items": items})
+            },
+            _created_cursor,
+        )
+        self.send_list_json(page, ("messages_private",))
 
     def api_secret_post_message(self):
-        session = require_token(self.headers, role="user")
-        if not session:
-            return self.send_json({"error": "未登录"}, 401)
         data = self.json_body()
-        from_name = session["username"]
+        from_name = self.session["username"]
         to_name = (data.get("to_name") or "你").strip()[:20]
         content = (data.get("content") or "").strip()
         if not content or len(content) > 300:
             return self.send_json({"error": "小纸条不能为空，且不超过300字"}, 400)
-        conn = sqlite3.connect(DB_PATH)
+        conn = get_db()
         cur = conn.cursor()
         cur.execute("SELECT 1 FROM users WHERE username=?", (to_name,))
         if not cur.fetchone():
-            conn.close()
             return self.send_json({"error": "只允许给已注册用户发送站内信"}, 400)
-        cur.execute(
+        WRITE_BATCHER.execute(
             "INSERT INTO messages_private (from_name, to_name, content) VALUES (?, ?, ?)",
             (from_name, to_name, content),
         )
-        conn.commit()
-        conn.close()
         self.send_json({"message": "纸条送达"}, 201)
 
     def api_secret_post_user_message(self):
-        session = require_token(self.headers, role="user")
-        if not session:
-            return self.send_json({"error": "未登录"}, 401)
         data = self.json_body()
         content = (data.get("content") or "").strip()
         if not content or len(content) > 260:
             return self.send_json({"error": "留言不能为空，且不超过260字"}, 400)
         safe_content = content.replace("<", "&lt;").replace(">", "&gt;")
-        conn = sqlite3.connect(DB_PATH)
-        cur = conn.cursor()
-        cur.execute(
-            "INSERT INTO messages_user (username, content) VALUES (?, ?)",
-            (session["username"], safe_content),
+        msg_id, created_at = WRITE_BATCHER.execute(
+            "INSERT INTO messages_user (username, content) VALUES (?, ?) RETURNING id, created_at",
+            (self.session["username"], safe_content),
+        )
+        RESPONSE_CACHE.invalidate(CACHE_PUBLIC_USER_MESSAGES)
+        LIVE_FEED.publish(
+            "user_message",
+            {"id": msg_id, "username": self.session["username"], "content": safe_content, "created_at": created_at},
         )
-        conn.commit()
-        conn.close()
         self.send_json({"message": "留言已发布到游客区"}, 201)
 
     # --- Admin endpoints
     def api_admin_login(self):
-        ip = self.client_address[0]
-        if not check_login_window(ip, "admin_login"):
-            return self.send_json({"error": "尝试太多，请稍后再试"}, 429)
         data = self.json_body()
         username = data.get("username", "")
         password = data.get("password", "")
-        conn = sqlite3.connect(DB_PATH)
+        conn = get_db()
         cur = conn.cursor()
-        cur.execute("SELECT password_hash FROM users WHERE username=? AND role='admin'", (username,))
+        cur.execute("SELECT id, password_hash FROM users WHERE username=? AND role='admin'", (username,))
         row = cur.fetchone()
-        conn.close()
-        if not row or not verify_password(password, row[0]):
+        if not row or not SCRYPT_POOL.verify(password, row[1]):
             return self.send_json({"error": "账号或密码错误"}, 401)
+        if needs_rehash(row[1]):
+            cur.execute("UPDATE users SET password_hash=? WHERE id=?", (SCRYPT_POOL.hash(password), row[0]))
+            conn.commit()
         token = make_token("admin", username)
         self.send_json({"token": token})
 
     def api_admin_summary(self):
-        if not require_token(self.headers, role="admin"):
-            return self.send_json({"error": "未授权"}, 401)
-        conn = sqlite3.connect(DB_PATH)
-        cur = conn.cursor()
-        cur.execute("SELECT COUNT(*), SUM(is_public) FROM diaries")
-        total, public_count = cur.fetchone()
-        cur.execute("SELECT COUNT(*) FROM messages_public")
-        public_msgs = cur.fetchone()[0]
-        cur.execute("SELECT COUNT(*) FROM messages_private")
-        private_msgs = cur.fetchone()[0]
-        conn.close()
+        stats = read_stats()
         self.send_json(
             {
-                "diary_total": total or 0,
-                "diary_public": public_count or 0,
-                "messages_public": public_msgs,
-                "messages_private": private_msgs,
+                "diary_total": stats["diaries"],
+                "diary_public": stats["diaries_public"],
+                "messages_public": stats["messages_public"],
+                "messages_private": stats["messages_private"],
             }
         )
 
+    def api_admin_stats_reconcile(self):
+        drift = reconcile_stats()
+        self.send_json({"drift": {name: {"stored": stored, "actual": actual} for name, (stored, actual) in drift.items()}})
+
     def api_admin_diaries(self):
-        if not require_token(self.headers, role="admin"):
-            return self.send_json({"error": "未授权"}, 401)
-        conn = sqlite3.connect(DB_PATH)
-        cur = conn.cursor()
-        cur.execute(
-            "SELECT id, author_name, title, content, is_public, created_at FROM diaries ORDER BY created_at DESC"
-        )
-        items = [
-            {
+        page = {}
+        items = iter_page(
+            get_db().cursor(),
+            SQL_ADMIN_DIARIES,
+            page_params(self.query, PAGE_ADMIN_DIARIES),
+            lambda row: {
                 "id": row[0],
                 "author": row[1],
                 "title": row[2],
-                "content": row[3],
+                **excerpt_fields(row[3]),
                 "is_public": bool(row[4]),
                 "created_at": row[5],
-            }
-            for row in cur.fetchall()
-        ]
-        conn.close()
-        self.send_json({"items": items})
+            },
+            _created_cursor,
+            page,
+        )
+        self.send_json_stream(items, page, ("diaries",))
+
+    def api_admin_diary(self, diary_id):
+        cur = get_db().cursor()
+        cur.execute(SQL_DIARY, (diary_id,))
+        row = cur.fetchone()
+        if not row:
+            return self.send_json({"error": "未找到日记"}, 404)
+        self.send_list_json(diary_detail(row), ("diaries",))
 
-    def api_admin_toggle_public(self, path):
-        if not require_token(self.headers, role="admin"):
-            return self.send_json({"error": "未授权"}, 401)
-        diary_id = path.rsplit("/", 1)[-1]
+    def api_admin_toggle_public(self, diary_id):
         data = self.json_body()
-        conn = sqlite3.connect(DB_PATH)
+        conn = get_db()
         cur = conn.cursor()
         cur.execute(
             "UPDATE diaries SET is_public=?, updated_at=CURRENT_TIMESTAMP WHERE id=?",
             (1 if data.get("is_public") else 0, diary_id),
         )
         conn.commit()
-        conn.close()
+        RESPONSE_CACHE.invalidate(CACHE_PUBLIC_DIARIES)
         self.send_json({"message": "状态已更新"})
 
-    def api_admin_delete_public_message(self, path):
-        if not require_token(self.headers, role="admin"):
-            return self.send_json({"error": "未授权"}, 401)
-        msg_id = path.rsplit("/", 1)[-1]
-        conn = sqlite3.connect(DB_PATH)
+    def api_admin_delete_public_message(self, msg_id):
+        conn = get_db()
         cur = conn.cursor()
         cur.execute("DELETE FROM messages_public WHERE id=?", (msg_id,))
+        deleted = cur.rowcount
         conn.commit()
-        conn.close()
+        RESPONSE_CACHE.invalidate(CACHE_PUBLIC_MESSAGES)
+        if deleted:
+            LIVE_FEED.publish("public_message_removed", {"id": msg_id})
         self.send_json({"message": "已删除留言"})
 
-    def api_admin_delete_private_message(self, path):
-        if not require_token(self.headers, role="admin"):
-            return self.send_json({"error": "未授权"}, 401)
-        msg_id = path.rsplit("/", 1)[-1]
-        conn = sqlite3.connect(DB_PATH)
+    def api_admin_delete_private_message(self, msg_id):
+        conn = get_db()
         cur = conn.cursor()
         cur.execute("DELETE FROM messages_private WHERE id=?", (msg_id,))
         conn.commit()
-        conn.close()
         self.send_json({"message": "已删除纸条"})
 
     def api_admin_messages_public(self):
-        if not require_token(self.headers, role="admin"):
-            return self.send_json({"error": "未授权"}, 401)
-        conn = sqlite3.connect(DB_PATH)
-        cur = conn.cursor()
-        cur.execute(
-            "SELECT id, nickname, content, is_hidden, created_at FROM messages_public ORDER BY created_at DESC LIMIT 100"
-        )
-        items = [
-            {
+        page = {}
+        items = iter_page(
+            get_db().cursor(),
+            SQL_ADMIN_MESSAGES_PUBLIC,
+            page_params(self.query, PAGE_ADMIN_MESSAGES_PUBLIC),
+            lambda row: {
                 "id": row[0],
                 "nickname": row[1] or "匿名",
                 "content": row[2],
                 "is_hidden": bool(row[3]),
                 "created_at": row[4],
-            }
-            for row in cur.fetchall()
-        ]
-        conn.close()
-        self.send_json({"items": items})
+            },
+            _created_cursor,
+            page,
+        )
+        self.send_json_stream(items, page, ("messages_public",))
 
-    def api_admin_update_public_message(self, path):
-        if not require_token(self.headers, role="admin"):
-            return self.send_json({"error": "未授权"}, 401)
-        msg_id = path.rsplit("/", 1)[-1]
+    def api_admin_update_public_message(self, msg_id):
         data = self.json_body()
-        conn = sqlite3.connect(DB_PATH)
+        conn = get_db()
         cur = conn.cursor()
-        cur.execute(
-            "UPDATE messages_public SET is_hidden=? WHERE id=?",
-            (1 if data.get("is_hidden") else 0, msg_id),
-        )
+        is_hidden = 1 if data.get("is_hidden") else 0
+        cur.execute("UPDATE messages_public SET is_hidden=? WHERE id=?", (is_hidden, msg_id))
+        updated = cur.rowcount
         conn.commit()
-        conn.close()
+        RESPONSE_CACHE.invalidate(CACHE_PUBLIC_MESSAGES)
+        if updated:
+            LIVE_FEED.publish("public_message_removed" if is_hidden else "public_message_restored", {"id": msg_id})
         self.send_json({"message": "状态已更新"})
 
     def api_admin_messages_private(self):
-        if not require_token(self.headers, role="admin"):
-            return self.send_json({"error": "未授权"}, 401)
-        conn = sqlite3.connect(DB_PATH)
-        cur = conn.cursor()
-        cur.execute(
-            "SELECT id, from_name, to_name, content, created_at FROM messages_private ORDER BY created_at DESC LIMIT 120"
-        )
-        items = [
-            {
+        page = {}
+        items = iter_page(
+            get_db().cursor(),
+            SQL_ADMIN_MESSAGES_PRIVATE,
+            page_params(self.query, PAGE_ADMIN_MESSAGES_PRIVATE),
+            lambda row: {
                 "id": row[0],
                 "from_name": row[1],
                 "to_name": row[2],
                 "content": row[3],
                 "created_at": row[4],
-            }
-            for row in cur.fetchall()
-        ]
-        conn.close()
-        self.send_json({"items": items})
+            },
+            _created_cursor,
+            page,
+        )
+        self.send_json_stream(items, page, ("messages_private",))
 
     def api_admin_users(self):
-        if not require_token(self.headers, role="admin"):
-            return self.send_json({"error": "未授权"}, 401)
-        conn = sqlite3.connect(DB_PATH)
-        cur = conn.cursor()
-        cur.execute(
-            "SELECT username, role, registration_ip, created_at, last_login_ip, last_login_at FROM users ORDER BY created_at DESC"
+        page = {}
+        items = iter_page(
+            get_db().cursor(),
+            SQL_ADMIN_USERS,
+            page_params(self.query, PAGE_ADMIN_USERS),
+            lambda row: {
+                "id": row[0],
+                "username": row[1],
+                "role": row[2],
+                "registration_ip": row[3] or "",
+                "created_at": row[4],
+                "last_login_ip": row[5] or "",
+                "last_login_at": row[6] or "",
+            },
+            lambda row: (row[4], row[0]),
+            page,
         )
-        items = [
-            {
-                "username": row[0],
-                "role": row[1],
-                "registration_ip": row[2] or "",
-                "created_at": row[3],
-                "last_login_ip": row[4] or "",
-                "last_login_at": row[5] or "",
-            }
-            for row in cur.fetchall()
+        self.send_json_stream(items, page, ("users",))
+
+    def api_admin_cache(self):
+        self.send_json(RESPONSE_CACHE.stats())
+
+    def api_admin_metrics(self):
+        """JSON by default; ``?format=prometheus`` for the text exposition format."""
+        if self.query.get("format", [""])[0] == "prometheus":
+            body = prometheus_metrics().encode()
+            return self.send_body(body, content_type="text/plain; version=0.0.4; charset=utf-8")
+        self.send_json(metrics_snapshot())
+
+    def api_admin_export(self):
+        """Dump a whole table as NDJSON, one row per line, without buffering it."""
+        table = self.query.get("table", [""])[0]
+        columns = EXPORT_TABLES.get(table)
+        if columns is None:
+            raise BadRequest("未知的导出表")
+        try:
+            after_id = int(self.query.get("after_id", ["0"])[0])
+        except ValueError:
+            raise BadRequest("after_id 格式不正确") from None
+        cur = get_db().cursor()
+        cur.execute(export_sql(table), (after_id,))
+        try:
+            out = self.start_stream(
+                "application/x-ndjson; charset=utf-8",
+                {
+                    "Cache-Control": "no-store",
+                    "Content-Disposition": f'attachment; filename="{table}.ndjson"',
+                },
+            )
+            for row in cur:
+                out.write(json.dumps(dict(zip(columns, row)), ensure_ascii=False).encode() + b"\n")
+            out.close()
+        finally:
+            cur.close()
+
+
+ROUTER = Router(
+    [
+        Route("GET", "/api/public/diaries", GardenHandler.api_public_diaries),
+        Route("GET", "/api/public/diaries/<id>", GardenHandler.api_public_diary),
+        Route("GET", "/api/public/messages", GardenHandler.api_public_messages),
+        Route("POST", "/api/public/messages", GardenHandler.api_post_public_message, limit="public_message"),
+        Route("GET", "/api/public/user-messages", GardenHandler.api_public_user_messages),
+        Route("GET", "/api/public/stream", GardenHandler.api_public_stream),
+        Route("GET", "/api/public/search/diaries", GardenHandler.api_public_search_diaries),
+        Route("GET", "/api/public/search/messages", GardenHandler.api_public_search_messages),
+        Route("GET", "/api/public/search/user-messages", GardenHandler.api_public_search_user_messages),
+        Route("GET", "/api/secret/search/diaries", GardenHandler.api_secret_search_diaries, auth="user"),
+        Route("GET", "/api/admin/search/diaries", GardenHandler.api_admin_search_diaries, auth="admin"),
+        Route("GET", "/api/admin/search/messages", GardenHandler.api_admin_search_messages, auth="admin"),
+        Route("POST", "/api/auth/register", GardenHandler.api_auth_register, limit="register"),
+        Route("POST", "/api/auth/login", GardenHandler.api_auth_login, limit="login"),
+        Route("POST", "/api/auth/logout", GardenHandler.api_auth_logout, auth="any"),
+        Route("GET", "/api/auth/me", GardenHandler.api_auth_me, auth="user"),
+        Route("GET", "/api/auth/summary", GardenHandler.api_auth_summary, auth="user"),
+        Route("GET", "/api/secret/diaries", GardenHandler.api_secret_diaries, auth="user"),
+        Route("GET", "/api/secret/diaries/<id>", GardenHandler.api_secret_diary, auth="user"),
+        Route("POST", "/api/secret/diaries", GardenHandler.api_secret_create_diary, auth="user"),
+        Route("PUT", "/api/secret/diaries/<id>", GardenHandler.api_secret_update_diary, auth="user"),
+        Route("DELETE", "/api/secret/diaries/<id>", GardenHandler.api_secret_delete_diary, auth="user"),
+        Route("GET", "/api/secret/messages", GardenHandler.api_secret_messages, auth="user"),
+        Route("POST", "/api/secret/messages", GardenHandler.api_secret_post_message, auth="user"),
+        Route("POST", "/api/secret/user-messages", GardenHandler.api_secret_post_user_message, auth="user"),
+        Route("POST", "/api/admin/login", GardenHandler.api_admin_login, limit="admin_login"),
+        Route("GET", "/api/admin/summary", GardenHandler.api_admin_summary, auth="admin"),
+        Route("GET", "/api/admin/diaries", GardenHandler.api_admin_diaries, auth="admin"),
+        Route("GET", "/api/admin/diaries/<id>", GardenHandler.api_admin_diary, auth="admin"),
+        Route("PUT", "/api/admin/diaries/<id>", GardenHandler.api_admin_toggle_public, auth="admin"),
+        Route("GET", "/api/admin/messages/public", GardenHandler.api_admin_messages_public, auth="admin"),
+        Route("PUT", "/api/admin/messages/public/<id>", GardenHandler.api_admin_update_public_message, auth="admin"),
+        Route("DELETE", "/api/admin/messages/public/<id>", GardenHandler.api_admin_delete_public_message, auth="admin"),
+        Route("GET", "/api/admin/messages/private", GardenHandler.api_admin_messages_private, auth="admin"),
+        Route("DELETE", "/api/admin/messages/private/<id>", GardenHandler.api_admin_delete_private_message, auth="admin"),
+        Route("GET", "/api/admin/users", GardenHandler.api_admin_users, auth="admin"),
+        Route("GET", "/api/admin/cache", GardenHandler.api_admin_cache, auth="admin"),
+        Route("GET", "/api/admin/metrics", GardenHandler.api_admin_metrics, auth="admin"),
+        Route("POST", "/api/admin/stats/reconcile", GardenHandler.api_admin_stats_reconcile, auth="admin"),
+        Route("GET", "/api/admin/export", GardenHandler.api_admin_export, auth="admin"),
+    ]
+)
+
+
+class PooledHTTPServer(HTTPServer):
+    """HTTPServer that hands each accepted connection to a bounded thread pool.
+
+    At most ``workers`` requests run at once; while every worker is busy the
+    accept loop waits and new connections queue in the kernel backlog.
+    ``server_close`` drains in-flight requests before returning.
+    """
+
+    def __init__(
+        self, server_address, handler_class, workers=DEFAULT_WORKERS, backlog=DEFAULT_BACKLOG, bind_and_activate=True
+    ):
+        self.request_queue_size = backlog
+        self.workers = workers
+        self._slots = threading.BoundedSemaphore(workers)
+        # live-feed streams hold a worker each, so cap them at a quarter of the pool
+        self.stream_slots = threading.BoundedSemaphore(max(1, workers // 4))
+        self._pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="garden-worker")
+        super().__init__(server_address, handler_class, bind_and_activate)
+
+    def process_request(self, request, client_address):
+        self._slots.acquire()
+        try:
+            self._pool.submit(self._process_request_worker, request, client_address)
+        except RuntimeError:  # pool already shut down
+            self._slots.release()
+            self.shutdown_request(request)
+
+    def _process_request_worker(self, request, client_address):
+        try:
+            self.finish_request(request, client_address)
+        except Exception:
+            self.handle_error(request, client_address)
+        finally:
+            self.shutdown_request(request)
+            self._slots.release()
+
+    def server_close(self):
+        super().server_close()
+        self._pool.shutdown(wait=True)
+
+
+class LoopWriter:
+    """``wfile`` for a handler running on a worker thread in asyncio mode.
+
+    Writes are buffered and handed to the event loop in chunks; each hand-off
+    waits for ``drain`` so a slow client throttles the worker, not memory.
+    """
+
+    def __init__(self, loop, writer):
+        self.loop = loop
+        self.writer = writer
+        self._buffer = []
+        self._buffered = 0
+
+    def write(self, data):
+        self._buffer.append(bytes(data))
+        self._buffered += len(data)
+        if self._buffered >= STREAM_CHUNK_SIZE:
+            self.flush()
+        return len(data)
+
+    def flush(self):
+        if not self._buffered:
+            return
+        data = b"".join(self._buffer)
+        self._buffer.clear()
+        self._buffered = 0
+        asyncio.run_coroutine_threadsafe(self._send(data), self.loop).result(REQUEST_TIMEOUT)
+
+    async def _send(self, data):
+        self.writer.write(data)
+        await self.writer.drain()
+
+    def sendfile(self, file, count):
+        """Flush, then let the event loop send ``count`` bytes of ``file``; returns the bytes sent."""
+        self.flush()
+        sent = 0
+        while sent < count:
+            chunk = min(STATIC_SENDFILE_CHUNK, count - sent)
+            done = asyncio.run_coroutine_threadsafe(
+                self.loop.sendfile(self.writer.transport, file, sent, chunk), self.loop
+            ).result(REQUEST_TIMEOUT)
+            sent += done
+            if done < chunk:
+                break
+        return sent
+
+
+class BufferedGardenHandler(GardenHandler):
+    """GardenHandler for one request the asyncio engine has already read.
+
+    ``request`` is the raw request bytes; responses go to a LoopWriter. The
+    connection stays open between requests unless the client asks otherwise.
+    """
+
+    keep_alive = True
+    event_stream = None  # (subscriber, wake) once the event loop should take the connection over as an SSE stream
+
+    def __init__(self, raw_request, client_address, server, wfile):
+        self._out = wfile
+        super().__init__(raw_request, client_address, server)
+
+    def setup(self):
+        self.connection = None
+        self.rfile = io.BytesIO(self.request)
+        self.wfile = self._out
+
+    def handle(self):
+        self.close_connection = True
+        self.handle_one_request()
+
+    def finish(self):
+        self.wfile.flush()
+
+    def handle_expect_100(self):
+        # the body was read before the handler ran, so there is nothing to continue
+        return True
+
+    def send_file(self, path, size):
+        with open(path, "rb") as file:
+            if self.wfile.sendfile(file, size) < size:
+                self.close_connection = True
+
+    def api_public_stream(self):
+        # subscribe before the headers go out so no event falls in between,
+        # then hand the connection to the event loop
+        subscriber, wake = self.server.subscribe_feed(self.last_event_id())
+        try:
+            self.start_event_stream()
+        except Exception:
+            LIVE_FEED.unsubscribe(subscriber)
+            raise
+        self.event_stream = (subscriber, wake)
+
+
+def request_body_length(head: bytes):
+    """Return ``(content_length, error_status)`` for a raw request head."""
+    length = 0
+    for line in head.split(b"\r\n")[1:]:
+        name, _, value = line.partition(b":")
+        name = name.strip().lower()
+        if name == b"transfer-encoding":
+            return 0, HTTPStatus.LENGTH_REQUIRED
+        if name == b"content-length":
+            value = value.strip()
+            if not value.isdigit():
+                return 0, HTTPStatus.BAD_REQUEST
+            length = int(value)
+    if length > MAX_BODY_BYTES:
+        return 0, HTTPStatus.REQUEST_ENTITY_TOO_LARGE
+    return length, None
+
+
+def _error_response(status: HTTPStatus) -> bytes:
+    return f"HTTP/1.1 {status.value} {status.phrase}\r\nContent-Length: 0\r\nConnection: close\r\n\r\n".encode()
+
+
+class AsyncGardenServer:
+    """asyncio engine: connections live on one event loop, handlers on a thread pool.
+
+    Each connection is a coroutine that reads one request at a time, so
+    pipelined requests are answered in order, and runs BufferedGardenHandler
+    for it on the worker pool where the SQLite work happens. Idle keep-alive
+    connections hold no thread. It offers the same serve_forever / shutdown /
+    server_close calls as the socketserver-based modes.
+    """
+
+    def __init__(
+        self,
+        server_address,
+        handler_class=BufferedGardenHandler,
+        workers=DEFAULT_WORKERS,
+        backlog=DEFAULT_BACKLOG,
+        sock=None,
+    ):
+        self.handler_class = handler_class
+        self.workers = workers
+        self.loop = asyncio.new_event_loop()
+        self._pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="garden-worker")
+        self._connections = set()
+        self._idle = set()  # writers of connections waiting for their next request
+        self._streams = set()  # wake-up events of live-feed streams
+        self._closing = False
+        self._stop = asyncio.Event()
+        self._stopped = threading.Event()
+        host, port = (None, None) if sock is not None else server_address
+        self._server = self.loop.run_until_complete(
+            asyncio.start_server(
+                self._serve_connection, host, port, sock=sock, backlog=backlog, limit=MAX_HEADER_BYTES
+            )
+        )
+        self.server_address = self._server.sockets[0].getsockname()[:2]
+
+    def serve_forever(self):
+        """Serve until ``shutdown`` or, on the main thread, SIGINT / SIGTERM."""
+        self._stopped.clear()
+        # a KeyboardInterrupt raised inside the loop would abandon half-accepted
+        # connections, so the signals stop the loop cleanly instead
+        signals = (signal.SIGINT, signal.SIGTERM) if threading.current_thread() is threading.main_thread() else ()
+        for signum in signals:
+            self.loop.add_signal_handler(signum, self._stop.set)
+        try:
+            self.loop.run_until_complete(self._stop.wait())
+        finally:
+            for signum in signals:
+                self.loop.remove_signal_handler(signum)
+            self._stopped.set()
+
+    def shutdown(self):
+        """Stop serve_forever from another thread and wait for it to return."""
+        self.loop.call_soon_threadsafe(self._stop.set)
+        self._stopped.wait()
+
+    def server_close(self):
+        """Stop accepting, let in-flight requests finish, then drop idle connections."""
+        self._closing = True
+        self.loop.run_until_complete(self._drain())
+        self._pool.shutdown(wait=True)
+        self.loop.close()
+
+    async def _drain(self):
+        self._server.close()
+        await self._server.wait_closed()
+        for writer in self._idle:
+            # the pending read sees EOF and the connection coroutine returns
+            writer.close()
+        for wake in self._streams:
+            wake.set()
+        # connections accepted just before the close still start up and then see _closing
+        while self._connections:
+            await asyncio.gather(*self._connections, return_exceptions=True)
+
+    async def _serve_connection(self, reader, writer):
+        task = asyncio.current_task()
+        self._connections.add(task)
+        peer = writer.get_extra_info("peername")
+        client_address = tuple(peer[:2]) if peer else ("", 0)
+        out = LoopWriter(self.loop, writer)
+        served = 0
+        try:
+            # a connection accepted as shutdown began still gets its first request
+            # answered (with --processes another worker would have taken it), so it
+            # only counts as idle, and is closed by _drain, between requests
+            while not self._closing or not served:
+                if served:
+                    self._idle.add(writer)
+                try:
+                    head = await asyncio.wait_for(reader.readuntil(b"\r\n\r\n"), KEEPALIVE_TIMEOUT)
+                finally:
+                    self._idle.discard(writer)
+                served += 1
+                length, error = request_body_length(head)
+                if error:
+                    writer.write(_error_response(error))
+                    break
+                body = await asyncio.wait_for(reader.readexactly(length), REQUEST_TIMEOUT) if length else b""
+                handler = await self.loop.run_in_executor(self._pool, self._handle, head + body, client_address, out)
+                if handler is None:
+                    break
+                if handler.event_stream:
+                    await self._stream_events(reader, writer, *handler.event_stream)
+                    break
+                if handler.close_connection:
+                    break
+        except asyncio.LimitOverrunError:
+            writer.write(_error_response(HTTPStatus.REQUEST_HEADER_FIELDS_TOO_LARGE))
+        except (asyncio.IncompleteReadError, asyncio.TimeoutError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+            try:
+                await writer.wait_closed()
+            except ConnectionError:
+                pass
+            self._connections.discard(task)
+
+    def subscribe_feed(self, resume_from):
+        """Subscribe to LIVE_FEED with a wake-up that lands on this event loop."""
+        wake = asyncio.Event()
+
+        def notify():
+            try:
+                self.loop.call_soon_threadsafe(wake.set)
+            except RuntimeError:  # loop already closed during shutdown
+                pass
+
+        return LIVE_FEED.subscribe(notify, resume_from), wake
+
+    async def _stream_events(self, reader, writer, subscriber, wake):
+        """Relay the live feed to one SSE client without holding a worker thread."""
+        self._streams.add(wake)
+        # a stream client sends nothing more, so any read completing means it hung up
+        hangup = asyncio.ensure_future(reader.read(1))
+        try:
+            while not (self._closing or subscriber.closed):
+                woken = asyncio.ensure_future(wake.wait())
+                await asyncio.wait((woken, hangup), timeout=SSE_HEARTBEAT, return_when=asyncio.FIRST_COMPLETED)
+                woken.cancel()
+                if hangup.done():
+                    break
+                wake.clear()
+                if subscriber.overflowed:
+                    break
+                writer.write(subscriber.drain() or b": ping\n\n")
+                await asyncio.wait_for(writer.drain(), REQUEST_TIMEOUT)
+        finally:
+            hangup.cancel()
+            self._streams.discard(wake)
+            LIVE_FEED.unsubscribe(subscriber)
+
+    def _handle(self, raw_request, client_address, out):
+        """Run one request on a worker thread; return the finished handler, or None to drop the connection."""
+        try:
+            return self.handler_class(raw_request, client_address, self, out)
+        except (ConnectionError, TimeoutError):
+            return None
+        except Exception:
+            print(f"Exception occurred during processing of request from {client_address}")
+            traceback.print_exc()
+            return None
+
+
+def make_server(
+    mode="single", host="0.0.0.0", port=8000, workers=DEFAULT_WORKERS, backlog=DEFAULT_BACKLOG, sock=None
+):
+    """Build the server for ``mode``; ``sock`` is an already listening socket to serve instead of binding."""
+    if mode == "asyncio":
+        return AsyncGardenServer((host, port), workers=workers, backlog=backlog, sock=sock)
+    if mode == "threaded":
+        server = PooledHTTPServer((host, port), GardenHandler, workers=workers, backlog=backlog, bind_and_activate=False)
+    else:
+        server = HTTPServer((host, port), GardenHandler, bind_and_activate=False)
+        server.request_queue_size = backlog
+    if sock is not None:
+        server.socket.close()
+        server.socket = sock
+        server.server_address = sock.getsockname()[:2]
+        server.server_name, server.server_port = server.server_address
+        return server
+    try:
+        server.server_bind()
+        server.server_activate()
+    except Exception:
+        server.server_close()
+        raise
+    return server
+
+
+def _raise_keyboard_interrupt(signum, frame):
+    raise KeyboardInterrupt
+
+
+def _shutdown_on_signal(server):
+    def handler(signum, frame):
+        # shutdown() waits for serve_forever to return, so it cannot run on the serving thread
+        threading.Thread(target=server.shutdown, name="shutdown", daemon=True).start()
+
+    return handler
+
+
+class SupervisorLink:
+    """A worker's end of its control socket to the supervisor.
+
+    Lines of JSON both ways: the worker reports ``ready`` and forwards feed
+    events; the supervisor sends back numbered events for LIVE_FEED. If the
+    supervisor goes away the worker shuts itself down rather than linger.
+    """
+
+    def __init__(self, sock):
+        self.sock = sock
+        self._lock = threading.Lock()
+        self._closing = False
+        self._thread = None
+
+    def send(self, message):
+        line = (json.dumps(message) + "\n").encode()
+        with self._lock:
+            self.sock.sendall(line)
+
+    def publish(self, event, data):
+        self.send({"event": event, "data": data})
+
+    def ready(self):
+        self.send({"ready": os.getpid()})
+
+    def _read_loop(self):
+        try:
+            for line in self.sock.makefile("rb"):
+                message = json.loads(line)
+                if "last_id" in message:
+                    LIVE_FEED.resume_from(message["last_id"])
+                else:
+                    LIVE_FEED.deliver(message["id"], message["event"], message["data"])
+        except (OSError, ValueError):
+            pass
+        if not self._closing:
+            print(f"[worker {os.getpid()}] lost the supervisor, shutting down")
+            os.kill(os.getpid(), signal.SIGTERM)
+
+    def start(self):
+        self._thread = threading.Thread(target=self._read_loop, name="supervisor-link", daemon=True)
+        self._thread.start()
+        return self
+
+    def close(self):
+        self._closing = True
+        self.sock.close()
+
+
+class WorkerProcess:
+    __slots__ = ("slot", "process", "control", "buffer", "started", "ready", "retiring")
+
+    def __init__(self, slot, process, control):
+        self.slot = slot
+        self.process = process
+        self.control = control
+        self.buffer = b""
+        self.started = time.monotonic()
+        self.ready = False
+        self.retiring = False
+
+
+class Supervisor:
+    """Keep ``processes`` worker processes serving one shared listening socket.
+
+    Workers are fresh interpreters running this file, so a rolling restart
+    (SIGHUP) picks up new code: each slot gets a replacement, and the old
+    worker is told to drain only once the new one is serving. Workers that
+    die are restarted, after a growing delay if they keep dying at startup.
+    Slot 0 is the primary and runs the database-wide background jobs. The
+    supervisor also numbers and fans out live-feed events between workers.
+    """
+
+    def __init__(self, args, sock):
+        self.args = args
+        self.sock = sock
+        self.workers = []
+        self.selector = selectors.DefaultSelector()
+        self.reload_requested = False
+        self.stopping = False
+        self._restart_at = {}  # slot -> monotonic time of a pending restart
+        self._restart_delay = {}
+        self._event_id = 0
+
+    def _worker_argv(self, control_fd, slot):
+        args = self.args
+        argv = [
+            sys.executable,
+            os.path.abspath(__file__),
+            "--mode", args.mode,
+            "--db", str(args.db),
+            "--workers", str(args.workers),
+            "--backlog", str(args.backlog),
+            "--scrypt-workers", str(args.scrypt_workers),
+            "--scrypt-max-pending", str(args.scrypt_max_pending),
+            "--rate-limit-store", args.rate_limit_store,
+            "--group-commit-ms", str(args.group_commit_ms),
+            "--compress-level", str(args.compress_level),
+            "--compress-min-bytes", str(args.compress_min_bytes),
+            "--listen-fd", str(self.sock.fileno()),
+            "--control-fd", str(control_fd),
         ]
-        conn.close()
-        self.send_json({"items": items})
+        if args.group_commit:
+            argv.append("--group-commit")
+        if args.slow_query_ms is not None:
+            argv += ["--slow-query-ms", str(args.slow_query_ms), "--slow-query-log", f"{args.slow_query_log}.{slot}"]
+        if args.trace_sql:
+            argv.append("--trace-sql")
+        return [*argv, "--slot", str(slot)]
+
+    def _spawn(self, slot):
+        control, child_end = socket.socketpair()
+        try:
+            process = subprocess.Popen(
+                self._worker_argv(child_end.fileno(), slot),
+                pass_fds=(self.sock.fileno(), child_end.fileno()),
+                # Ctrl+C reaches the supervisor only; it stops the workers itself
+                start_new_session=True,
+            )
+        finally:
+            child_end.close()
+        control.settimeout(SUPERVISOR_LINK_TIMEOUT)
+        worker = WorkerProcess(slot, process, control)
+        self.workers.append(worker)
+        self.selector.register(control, selectors.EVENT_READ, worker)
+        self._send(worker, {"last_id": self._event_id})
+        return worker
+
+    def _drop_link(self, worker):
+        if worker.control is not None:
+            self.selector.unregister(worker.control)
+            worker.control.close()
+            worker.control = None
 
+    def _send(self, worker, message):
+        if worker.control is None:
+            return
+        try:
+            worker.control.sendall((json.dumps(message) + "\n").encode())
+        except OSError:
+            # a worker that stops reading loses its link and shuts itself down
+            self._drop_link(worker)
+
+    def _read_control(self, worker):
+        try:
+            chunk = worker.control.recv(65536)
+        except OSError:
+            chunk = b""
+        if not chunk:
+            self._drop_link(worker)
+            return
+        worker.buffer += chunk
+        *lines, worker.buffer = worker.buffer.split(b"\n")
+        for line in lines:
+            message = json.loads(line)
+            if "ready" in message:
+                worker.ready = True
+                self._restart_delay.pop(worker.slot, None)
+            else:
+                self._event_id += 1
+                numbered = {"id": self._event_id, "event": message["event"], "data": message["data"]}
+                for other in list(self.workers):
+                    self._send(other, numbered)
+
+    def _reap(self):
+        for worker in list(self.workers):
+            code = worker.process.poll()
+            if code is None:
+                continue
+            self.workers.remove(worker)
+            self._drop_link(worker)
+            if worker.retiring or self.stopping:
+                continue
+            if any(other.slot == worker.slot and not other.retiring for other in self.workers):
+                continue  # a replacement is already running in this slot
+            delay = 0
+            if time.monotonic() - worker.started < WORKER_MIN_UPTIME:
+                delay = min(self._restart_delay.get(worker.slot, 0.5) * 2, WORKER_MAX_RESTART_DELAY)
+                self._restart_delay[worker.slot] = delay
+            print(f"[supervisor] worker {worker.process.pid} exited with {code}; restarting in {delay:.0f}s")
+            self._restart_at[worker.slot] = time.monotonic() + delay
+
+    def _pump(self, timeout):
+        for key, _ in self.selector.select(timeout):
+            if key.data.control is not None:
+                self._read_control(key.data)
+        self._reap()
+        now = time.monotonic()
+        for slot, due in list(self._restart_at.items()):
+            if now >= due and not self.stopping:
+                del self._restart_at[slot]
+                self._spawn(slot)
+
+    def serve_forever(self):
+        for slot in range(self.args.processes):
+            self._spawn(slot)
+        while not self.stopping:
+            self._pump(1)
+            if self.reload_requested:
+                self.reload_requested = False
+                self.rolling_restart()
+
+    def rolling_restart(self):
+        """Replace the workers one slot at a time; stop if a replacement fails to start."""
+        print("[supervisor] rolling restart")
+        for old in [worker for worker in self.workers if not worker.retiring]:
+            new = self._spawn(old.slot)
+            deadline = time.monotonic() + WORKER_READY_TIMEOUT
+            while not new.ready and new.process.poll() is None and time.monotonic() < deadline and not self.stopping:
+                self._pump(0.1)
+            if not new.ready:
+                print(f"[supervisor] replacement for slot {old.slot} did not start; keeping the current workers")
+                new.retiring = True
+                new.process.kill()
+                return
+            old.retiring = True
+            old.process.terminate()
+
+    def stop(self):
+        """SIGTERM every worker, wait for them to drain, and kill any that overrun."""
+        self.stopping = True
+        for worker in self.workers:
+            worker.process.terminate()
+        deadline = time.monotonic() + WORKER_STOP_TIMEOUT
+        for worker in self.workers:
+            try:
+                worker.process.wait(max(0, deadline - time.monotonic()))
+            except subprocess.TimeoutExpired:
+                worker.process.kill()
+                worker.process.wait()
+            self._drop_link(worker)
+        self.workers.clear()
+        self.selector.close()
+
+
+def run_supervisor(args):
+    sock = socket.create_server((args.host, args.port), backlog=args.backlog)
+    # every worker polls the shared socket; the losers of a race must not block in accept()
+    sock.setblocking(False)
+    supervisor = Supervisor(args, sock)
+
+    def request_reload(signum, frame):
+        supervisor.reload_requested = True
+
+    signal.signal(signal.SIGTERM, _raise_keyboard_interrupt)
+    signal.signal(signal.SIGHUP, request_reload)
+    port = sock.getsockname()[1]
+    print(f"Secret Garden running at http://localhost:{port} ({args.processes} {args.mode} processes)")
+    try:
+        supervisor.serve_forever()
+    except KeyboardInterrupt:
+        print("Shutting down, waiting for workers to drain...")
+    finally:
+        supervisor.stop()
+        sock.close()
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Secret Garden journal server")
+    parser.add_argument("--host", default="0.0.0.0")
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--db", type=Path, default=DB_PATH, help="SQLite database file")
+    parser.add_argument(
+        "--mode",
+        choices=("single", "threaded", "asyncio"),
+        default="single",
+        help="single: one request at a time; threaded: bounded worker pool; "
+        "asyncio: keep-alive connections on an event loop, requests on the worker pool",
+    )
+    parser.add_argument("--workers", type=int, default=DEFAULT_WORKERS, help="worker threads in threaded / asyncio mode")
+    parser.add_argument("--backlog", type=int, default=DEFAULT_BACKLOG, help="listen backlog size")
+    parser.add_argument(
+        "--processes",
+        type=int,
+        default=1,
+        help="worker processes sharing one listening socket under a supervisor (SIGHUP restarts them one by one)",
+    )
+    parser.add_argument(
+        "--scrypt-workers",
+        type=int,
+        help=f"processes for password hashing per server process (0 hashes on the request thread; "
+        f"default {SCRYPT_WORKERS} split across --processes)",
+    )
+    parser.add_argument(
+        "--scrypt-max-pending",
+        type=int,
+        default=SCRYPT_MAX_PENDING,
+        help="hashes running or queued before logins are answered with 503",
+    )
+    parser.add_argument(
+        "--rate-limit-store",
+        choices=("memory", "sqlite"),
+        help="memory: per-process buckets; sqlite: buckets in the database, shared by every process using it "
+        "(default: memory, or sqlite with --processes above 1)",
+    )
+    parser.add_argument(
+        "--group-commit",
+        action="store_true",
+        help="commit message posts from concurrent requests together, a batch at a time",
+    )
+    parser.add_argument(
+        "--group-commit-ms",
+        type=float,
+        default=GROUP_COMMIT_WINDOW * 1000,
+        help="milliseconds a batch waits for more messages after its first one (default: none, "
+        "messages arriving during a commit form the next batch)",
+    )
+    parser.add_argument(
+        "--slow-query-ms",
+        type=float,
+        help="log SQL statements slower than this many milliseconds, with their route and request id",
+    )
+    parser.add_argument(
+        "--slow-query-log",
+        type=Path,
+        default=SLOW_QUERY_LOG,
+        help="rotating slow-query log file (with --processes, one per worker slot: <file>.0, <file>.1, ...)",
+    )
+    parser.add_argument(
+        "--trace-sql",
+        action="store_true",
+        help="answer requests sending 'X-Debug-Sql: 1' with their SQL timeline in a Server-Timing header",
+    )
+    parser.add_argument(
+        "--compress-level",
+        type=int,
+        choices=range(10),
+        default=API_COMPRESS_LEVEL,
+        metavar="0-9",
+        help=f"gzip level (brotli quality) of API responses; 0 sends them uncompressed (default: {API_COMPRESS_LEVEL})",
+    )
+    parser.add_argument(
+        "--compress-min-bytes",
+        type=int,
+        default=API_COMPRESS_MIN_BYTES,
+        help=f"API responses smaller than this are not compressed (default: {API_COMPRESS_MIN_BYTES})",
+    )
+    parser.add_argument(
+        "--build-static",
+        action="store_true",
+        help="write .gz/.br variants next to the compressible files in public/, assets/ and orange/assets/ and exit",
+    )
+    parser.add_argument(
+        "--reconcile-stats",
+        action="store_true",
+        help="recount the summary counters from scratch and exit (status 1 if any had drifted)",
+    )
+    parser.add_argument(
+        "--explain",
+        action="store_true",
+        help="print EXPLAIN QUERY PLAN for every endpoint query and exit (status 1 on an unexpected scan)",
+    )
+    # set by the supervisor on the worker processes it starts
+    parser.add_argument("--listen-fd", type=int, help=argparse.SUPPRESS)
+    parser.add_argument("--control-fd", type=int, help=argparse.SUPPRESS)
+    parser.add_argument("--slot", type=int, help=argparse.SUPPRESS)
+    args = parser.parse_args(argv)
+    if args.scrypt_workers is None:
+        args.scrypt_workers = max(1, SCRYPT_WORKERS // args.processes)
+    if args.rate_limit_store is None:
+        args.rate_limit_store = "sqlite" if args.processes > 1 else "memory"
+    return args
 
-def run():
+
+def run(argv=None):
+    global DB_PATH
+    args = parse_args(argv)
+    DB_PATH = args.db
+    if args.build_static:
+        print(f"wrote {build_static()} file(s)")
+        raise SystemExit(0)
     init_db()
-    server = HTTPServer(("0.0.0.0", 8000), GardenHandler)
-    print("Secret Garden running at http://localhost:8000")
-    server.serve_forever()
+    if args.explain:
+        raise SystemExit(0 if print_query_plans() else 1)
+    if args.reconcile_stats:
+        drift = reconcile_stats()
+        close_db_connections()
+        print("stats ok" if not drift else f"fixed {len(drift)} drifted counter(s)")
+        raise SystemExit(1 if drift else 0)
+    if args.processes > 1 and args.listen_fd is None:
+        # the workers start from the schema migrated above
+        return run_supervisor(args)
+    sock = link = None
+    if args.listen_fd is not None:
+        sock = socket.socket(fileno=args.listen_fd)
+        link = SupervisorLink(socket.socket(fileno=args.control_fd))
+        LIVE_FEED.relay = link
+        RESPONSE_CACHE.shared = True
+    server = make_server(args.mode, args.host, args.port, args.workers, args.backlog, sock=sock)
+    # SIGTERM ends serve_forever between requests (never inside one) so in-flight requests drain
+    signal.signal(signal.SIGTERM, _shutdown_on_signal(server))
+    SCRYPT_POOL.workers = args.scrypt_workers
+    SCRYPT_POOL.max_pending = args.scrypt_max_pending
+    SCRYPT_POOL.start()
+    STATIC_FILES.warm()
+    RATE_LIMITER.backend = args.rate_limit_store
+    TRACER.configure(args.slow_query_ms, args.trace_sql, args.slow_query_log)
+    COMPRESSOR.configure(args.compress_level, args.compress_min_bytes)
+    if args.group_commit:
+        WRITE_BATCHER.window = args.group_commit_ms / 1000
+        WRITE_BATCHER.start()
+    tasks = [task.start() for task in background_tasks(primary=link is None or args.slot == 0)]
+    if link is None:
+        print(f"Secret Garden running at http://localhost:{args.port} ({args.mode} mode)")
+    else:
+        link.start().ready()
+        print(f"[worker {os.getpid()}] serving ({args.mode} mode)")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        print("Shutting down, waiting for in-flight requests...")
+        # end live-feed streams first so their workers are free to drain
+        LIVE_FEED.close()
+        server.server_close()
+        WRITE_BATCHER.stop()
+        for task in tasks:
+            task.stop()
+        SCRYPT_POOL.shutdown()
+        close_db_connections()
+        if link is not None:
+            link.close()
 
 
 if __name__ == "__main__":
@@ -0,0 +1,356 @@
+"""Durable outbox for the contact-form mail sent by ``server.py``.
+
+``MailOutbox.enqueue`` stores a message in a local SQLite file and returns
+at once. A background thread delivers queued messages in batches over one
+authenticated SMTP connection, which it keeps open between batches, and
+retries failures with exponential backoff. Several processes may share one
+outbox file: each batch is leased to its sender under a random token, the
+lease is renewed before every message, and a message is only sent and
+marked sent while its sender still holds the lease.
+
+SMTP settings come from environment variables:
+- SMTP_HOST, SMTP_PORT (default 587, or 465 with ssl), SMTP_USER, SMTP_PASSWORD
+- SMTP_SECURITY: starttls (default), ssl, or none (plain text, for a local test server;
+  SMTP_USER/SMTP_PASSWORD are optional then and without a password no login is attempted)
+"""
+from __future__ import annotations
+
+import os
+import random
+import smtplib
+import sqlite3
+import ssl
+import threading
+import time
+from dataclasses import dataclass
+from email import message_from_bytes, policy
+from email.message import EmailMessage
+from pathlib import Path
+from typing import Callable, Dict, List, Optional, Tuple, Union
+
+SMTP_IDLE_TIMEOUT = 60  # idle seconds after which the persistent SMTP connection is closed
+SMTP_TIMEOUT = 30  # seconds before a stalled SMTP command fails
+OUTBOX_BATCH = 20  # messages claimed and sent per round
+# seconds a message stays reserved for its sender, renewed before each one is sent; it covers
+# the slowest single delivery: two connection attempts of up to ~8 commands, each SMTP_TIMEOUT long
+OUTBOX_LEASE = 20 * SMTP_TIMEOUT
+OUTBOX_MAX_ATTEMPTS = 8  # deliveries tried before a message is marked failed
+OUTBOX_RETRY_BASE = 30  # seconds before the first retry; doubles with every attempt
+OUTBOX_RETRY_MAX = 3600
+OUTBOX_POLL = 5  # seconds between checks for due retries while idle
+OUTBOX_KEEP_SENT = 7 * 24 * 3600  # seconds sent messages are kept before they are pruned
+
+OUTBOX_SCHEMA = (
+    """
+    CREATE TABLE IF NOT EXISTS outbox (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        message BLOB NOT NULL,
+        status TEXT NOT NULL DEFAULT 'pending',
+        attempts INTEGER NOT NULL DEFAULT 0,
+        next_attempt_at REAL NOT NULL,
+        last_error TEXT,
+        created_at REAL NOT NULL,
+        sent_at REAL,
+        lease_token TEXT
+    )
+    """,
+    "CREATE INDEX IF NOT EXISTS idx_outbox_due ON outbox(status, next_attempt_at)",
+)
+SQL_CLAIM = (
+    "UPDATE outbox SET next_attempt_at = :lease, lease_token = :token WHERE id IN ("
+    "SELECT id FROM outbox WHERE status = 'pending' AND next_attempt_at <= :now ORDER BY id LIMIT :batch"
+    ") RETURNING id, message, attempts"
+)
+# every update by the sender holding a lease is conditional on still holding it
+SQL_RENEW = (
+    "UPDATE outbox SET next_attempt_at = ? WHERE id = ? AND lease_token = ? AND status = 'pending'"
+)
+
+
+class ConfigError(RuntimeError):
+    """Raised when required email configuration is missing."""
+
+
+@dataclass(frozen=True)
+class SmtpSettings:
+    host: str
+    port: int
+    user: str
+    password: str
+    security: str
+
+    @classmethod
+    def from_env(cls) -> "SmtpSettings":
+        host = os.environ.get("SMTP_HOST")
+        user = os.environ.get("SMTP_USER") or ""
+        password = os.environ.get("SMTP_PASSWORD") or ""
+        security = os.environ.get("SMTP_SECURITY", "starttls").lower()
+        if security not in ("starttls", "ssl", "none"):
+            raise ConfigError("SMTP_SECURITY 只能是 starttls、ssl 或 none。")
+        # a local stand-in server usually has no AUTH; real providers always want a login
+        if not host or (security != "none" and (not user or not password)):
+            raise ConfigError("SMTP_HOST/SMTP_USER/SMTP_PASSWORD 配置缺失。")
+        port = int(os.environ.get("SMTP_PORT", "465" if security == "ssl" else "587"))
+        return cls(host, port, user, password, security)
+
+
+class SmtpSession:
+    """One SMTP connection, opened (and logged in, given a password) on demand and reused across sends."""
+
+    def __init__(self, settings: Callable[[], SmtpSettings] = SmtpSettings.from_env) -> None:
+        self._settings_factory = settings
+        self._settings: Optional[SmtpSettings] = None
+        self._smtp: Optional[smtplib.SMTP] = None
+        self._last_used = 0.0
+        self.connects = 0
+
+    def send(self, msg: EmailMessage) -> None:
+        settings = self._settings_factory()
+        if self._smtp is not None and (settings != self._settings or self.idle_for() > SMTP_IDLE_TIMEOUT):
+            self.close()
+        # a kept-open connection may have been dropped by the server; retry that once on a fresh one
+        for retry in (False, True):
+            if self._smtp is None:
+                self._connect(settings)
+            try:
+                self._smtp.send_message(msg)
+            except (smtplib.SMTPServerDisconnected, ConnectionError):
+                self._abandon()
+                if retry:
+                    raise
+                continue
+            self._last_used = time.monotonic()
+            return
+
+    def idle_for(self) -> float:
+        return time.monotonic() - self._last_used
+
+    def _connect(self, settings: SmtpSettings) -> None:
+        context = ssl.create_default_context()
+        if settings.security == "ssl":
+            smtp = smtplib.SMTP_SSL(settings.host, settings.port, timeout=SMTP_TIMEOUT, context=context)
+        else:
+            smtp = smtplib.SMTP(settings.host, settings.port, timeout=SMTP_TIMEOUT)
+        try:
+            if settings.security == "starttls":
+                smtp.starttls(context=context)
+            if settings.password:
+                smtp.login(settings.user, settings.password)
+        except Exception:
+            smtp.close()
+            raise
+        self._smtp = smtp
+        self._settings = settings
+        self._last_used = time.monotonic()
+        self.connects += 1
+
+    def _abandon(self) -> None:
+        if self._smtp is not None:
+            self._smtp.close()
+            self._smtp = None
+
+    def close(self) -> None:
+        if self._smtp is None:
+            return
+        try:
+            self._smtp.quit()
+        except (smtplib.SMTPException, OSError):
+            pass
+        self._abandon()
+
+    @property
+    def connected(self) -> bool:
+        return self._smtp is not None
+
+
+def is_permanent(exc: Exception) -> bool:
+    """A 5xx answer about the message itself; retrying it cannot help."""
+    if isinstance(exc, smtplib.SMTPRecipientsRefused):
+        # a 4xx per recipient (greylisting, a full mailbox) may well pass later
+        return all(500 <= code < 600 for code, _ in exc.recipients.values())
+    if isinstance(exc, smtplib.SMTPAuthenticationError):
+        return False  # fixed by correcting the configuration, after which the message should still go out
+    return isinstance(exc, smtplib.SMTPResponseException) and 500 <= exc.smtp_code < 600
+
+
+class MailOutbox:
+    """Messages waiting for delivery, kept in SQLite, and the thread that sends them."""
+
+    def __init__(
+        self,
+        path: Union[str, Path],
+        session: Optional[SmtpSession] = None,
+        batch: int = OUTBOX_BATCH,
+        max_attempts: int = OUTBOX_MAX_ATTEMPTS,
+        retry_base: float = OUTBOX_RETRY_BASE,
+        retry_max: float = OUTBOX_RETRY_MAX,
+    ) -> None:
+        self.path = str(path)
+        self.session = session or SmtpSession()
+        self.batch = batch
+        self.max_attempts = max_attempts
+        self.retry_base = retry_base
+        self.retry_max = retry_max
+        self.sent = 0
+        self.failed = 0
+        self.retried = 0
+        self.lost = 0  # claimed messages whose lease had passed to another sender before they went out
+        self._local = threading.local()
+        self._wake = threading.Event()
+        self._stopping = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+        self._pid: Optional[int] = None
+        self._lock = threading.Lock()
+        with self._db() as conn:
+            for statement in OUTBOX_SCHEMA:
+                conn.execute(statement)
+            columns = {row[1] for row in conn.execute("PRAGMA table_info(outbox)")}
+            if "lease_token" not in columns:  # outbox files created before leases carried a token
+                conn.execute("ALTER TABLE outbox ADD COLUMN lease_token TEXT")
+
+    def _db(self) -> sqlite3.Connection:
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=10, check_same_thread=False)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+    def enqueue(self, msg: EmailMessage) -> int:
+        """Store ``msg`` for delivery and wake the sender; returns the outbox id."""
+        now = time.time()
+        with self._db() as conn:
+            cur = conn.execute(
+                "INSERT INTO outbox (message, next_attempt_at, created_at) VALUES (?, ?, ?)",
+                (msg.as_bytes(policy=policy.SMTP), now, now),
+            )
+        self._wake.set()
+        return cur.lastrowid
+
+    def start(self) -> "MailOutbox":
+        """Start the sender thread in this process if it is not running yet."""
+        with self._lock:
+            # a forked worker inherits the flag but not the thread
+            if self._thread is not None and self._pid == os.getpid() and self._thread.is_alive():
+                return self
+            self._stopping.clear()
+            self._pid = os.getpid()
+            self._thread = threading.Thread(target=self._run, name="mail-outbox", daemon=True)
+            self._thread.start()
+        return self
+
+    def stop(self, timeout: float = SMTP_TIMEOUT) -> None:
+        self._stopping.set()
+        self._wake.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
+            self._thread = None
+
+    def _run(self) -> None:
+        last_prune = 0.0
+        while not self._stopping.is_set():
+            try:
+                token, claimed = self._claim()
+                for outbox_id, raw, attempts in claimed:
+                    if self._stopping.is_set():
+                        self._release(outbox_id, token)
+                        continue
+                    self._deliver(outbox_id, raw, attempts, token)
+                if claimed:
+                    continue
+                if self.session.connected and self.session.idle_for() > SMTP_IDLE_TIMEOUT:
+                    self.session.close()
+                if time.monotonic() - last_prune > OUTBOX_POLL * 60:
+                    last_prune = time.monotonic()
+                    self._prune()
+            except sqlite3.Error as exc:
+                print(f"[outbox] database error: {exc}")
+            self._wake.wait(OUTBOX_POLL)
+            self._wake.clear()
+        self.session.close()
+
+    def _claim(self) -> Tuple[str, List[Tuple[int, bytes, int]]]:
+        """Lease up to ``batch`` due messages; returns the lease token and the messages."""
+        now = time.time()
+        token = os.urandom(8).hex()
+        params = {"now": now, "lease": now + OUTBOX_LEASE, "token": token, "batch": self.batch}
+        with self._db() as conn:
+            return token, conn.execute(SQL_CLAIM, params).fetchall()
+
+    def _renew(self, outbox_id: int, token: str, until: float) -> bool:
+        """Extend (or with ``until`` = now, give up) the lease; False if another sender took it over."""
+        with self._db() as conn:
+            return conn.execute(SQL_RENEW, (until, outbox_id, token)).rowcount == 1
+
+    def _release(self, outbox_id: int, token: str) -> None:
+        self._renew(outbox_id, token, time.time())
+
+    def _deliver(self, outbox_id: int, raw: bytes, attempts: int, token: str) -> None:
+        # earlier messages of the batch may have taken a while; never send on an expired lease
+        if not self._renew(outbox_id, token, time.time() + OUTBOX_LEASE):
+            self.lost += 1
+            return
+        msg = message_from_bytes(raw, _class=EmailMessage, policy=policy.SMTP)
+        try:
+            self.session.send(msg)
+        except Exception as exc:
+            self._failed(outbox_id, attempts + 1, exc, token)
+            return
+        with self._db() as conn:
+            conn.execute(
+                "UPDATE outbox SET status = 'sent', attempts = ?, sent_at = ?, last_error = NULL "
+                "WHERE id = ? AND lease_token = ?",
+                (attempts + 1, time.time(), outbox_id, token),
+            )
+        self.sent += 1
+
+    def _failed(self, outbox_id: int, attempts: int, exc: Exception, token: str) -> None:
+        error = f"{type(exc).__name__}: {exc}"[:500]
+        if not is_permanent(exc):
+            # the connection may be in any state after a transient failure
+            self.session.close()
+        if is_permanent(exc) or attempts >= self.max_attempts:
+            status, next_attempt_at = "failed", time.time()
+            self.failed += 1
+            print(f"[outbox] giving up on message {outbox_id} after {attempts} attempt(s): {error}")
+        else:
+            delay = min(self.retry_base * 2 ** (attempts - 1), self.retry_max)
+            status, next_attempt_at = "pending", time.time() + delay * random.uniform(0.8, 1.2)
+            self.retried += 1
+        with self._db() as conn:
+            conn.execute(
+                "UPDATE outbox SET status = ?, attempts = ?, next_attempt_at = ?, last_error = ? "
+                "WHERE id = ? AND lease_token = ?",
+                (status, attempts, next_attempt_at, error, outbox_id, token),
+            )
+
+    def _prune(self) -> None:
+        with self._db() as conn:
+            conn.execute("DELETE FROM outbox WHERE status = 'sent' AND sent_at < ?", (time.time() - OUTBOX_KEEP_SENT,))
+
+    def stats(self) -> Dict[str, object]:
+        """Queue depth by state plus this process's sender counters."""
+        now = time.time()
+        with self._db() as conn:
+            rows = conn.execute(
+                "SELECT status, COUNT(*), MIN(created_at), SUM(attempts > 0) FROM outbox GROUP BY status"
+            ).fetchall()
+        by_status = {status: (count, oldest, retrying) for status, count, oldest, retrying in rows}
+        pending, oldest, retrying = by_status.get("pending", (0, None, 0))
+        return {
+            "pending": pending,
+            "retrying": retrying or 0,
+            "oldest_pending_seconds": round(now - oldest, 1) if oldest else 0,
+            "failed": by_status.get("failed", (0,))[0],
+            "sent_kept": by_status.get("sent", (0,))[0],
+            "sender": {
+                "running": self._thread is not None and self._thread.is_alive(),
+                "sent": self.sent,
+                "retried": self.retried,
+                "failed": self.failed,
+                "lost_leases": self.lost,
+                "smtp_connects": self.session.connects,
+                "smtp_connected": self.session.connected,
+            },
+        }
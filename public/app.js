@@ -1,7 +1,9 @@
 // ---- 基础工具：简化选择与 API 调用 ----
 const $ = (selector) => document.querySelector(selector);
+// cache: "no-cache" 让浏览器带上 ETag 向服务端校验，内容未变时只收到 304，不必重新下载
 const api = (path, options = {}) =>
   fetch(path, {
+    cache: "no-cache",
     headers: { "Content-Type": "application/json", ...(options.headers || {}) },
     ...options,
   });
@@ -36,6 +38,31 @@ function formatLocalTime(value) {
   }).format(date);
 }
 
+// 列表接口按游标分页：带 before 参数取下一页，有 next_cursor 时在列表末尾放“加载更多”
+function pagePath(path, before) {
+  return before ? `${path}?before=${encodeURIComponent(before)}` : path;
+}
+
+function renderLoadMore(wrap, cursor, loadMore) {
+  wrap.querySelector(".load-more")?.remove();
+  if (!cursor) return;
+  const btn = document.createElement("button");
+  btn.className = "btn ghost load-more";
+  btn.textContent = "加载更多";
+  btn.addEventListener("click", () => loadMore(cursor));
+  wrap.appendChild(btn);
+}
+
+// 列表只带摘要，点开时再取全文替换摘要段落
+async function expandDiary(trigger, path, token) {
+  const res = await api(path, token ? { headers: { Authorization: `Bearer ${token}` } } : {});
+  if (!res.ok) return;
+  const data = await res.json();
+  const text = trigger.closest("[data-diary]")?.querySelector(".diary-text");
+  if (text) text.textContent = data.content;
+  trigger.remove();
+}
+
 function updateClock() {
   const el = $("#clock");
   if (!el) return;
@@ -85,10 +112,11 @@ async function loadPublicDiaries() {
       row.innerHTML = `
         <div class="dot"></div>
         <div class="line"></div>
-        <div class="timeline__card">
+        <div class="timeline__card" data-diary="${item.id}">
           <div class="timeline__meta">${formatLocalTime(item.created_at)} · ${item.author}</div>
           <div class="timeline__title">${item.title}</div>
-          <p class="muted">${item.excerpt || "..."}</p>
+          <p class="muted diary-text">${item.excerpt || "..."}${item.truncated ? "…" : ""}</p>
+          ${item.truncated ? `<span class="tool" data-expand="${item.id}">阅读全文</span>` : ""}
         </div>
       `;
       timeline.appendChild(row);
@@ -96,18 +124,32 @@ async function loadPublicDiaries() {
   });
 }
 
+const publicMessageHtml = (m) =>
+  `<div class="message-item" data-id="${m.id}"><div>${m.content}</div><div class="message-meta">${m.nickname} · ${formatLocalTime(
+    m.created_at
+  )}</div></div>`;
+
+const userMessageHtml = (m) => `
+        <div class="message-item" data-id="${m.id}">
+          <div>${m.content}</div>
+          <div class="message-meta">${m.username} · ${formatLocalTime(m.created_at)}</div>
+        </div>`;
+
+function bindPublicDiaryExpand() {
+  const timeline = document.getElementById("timeline");
+  if (!timeline) return;
+  timeline.addEventListener("click", (e) => {
+    const id = e.target.dataset.expand;
+    if (id) expandDiary(e.target, `/api/public/diaries/${id}`);
+  });
+}
+
 async function loadPublicMessages() {
   const res = await api("/api/public/messages");
   const data = await res.json();
   const list = data.items || [];
   const wrap = document.getElementById("publicMessageList");
-  wrap.innerHTML = list
-    .map(
-      (m) => `<div class="message-item"><div>${m.content}</div><div class="message-meta">${m.nickname} · ${formatLocalTime(
-        m.created_at
-      )}</div></div>`
-    )
-    .join("");
+  wrap.innerHTML = list.map(publicMessageHtml).join("");
 }
 
 async function loadPublicUserMessages() {
@@ -117,15 +159,34 @@ async function loadPublicUserMessages() {
   const list = data.items || [];
   const wrap = document.getElementById("userMessageList");
   if (!wrap) return;
-  wrap.innerHTML = list
-    .map(
-      (m) => `
-        <div class="message-item">
-          <div>${m.content}</div>
-          <div class="message-meta">${m.username} · ${formatLocalTime(m.created_at)}</div>
-        </div>`
-    )
-    .join("");
+  wrap.innerHTML = list.map(userMessageHtml).join("");
+}
+
+// 实时推送：新留言、隐藏/删除通过 SSE 送达，不必反复刷新列表；断线后浏览器会带上 Last-Event-ID 自动续传
+function prependMessage(wrapId, item, toHtml) {
+  const wrap = document.getElementById(wrapId);
+  if (!wrap || wrap.querySelector(`[data-id="${item.id}"]`)) return;
+  wrap.insertAdjacentHTML("afterbegin", toHtml(item));
+}
+
+function subscribeLiveFeed() {
+  if (!window.EventSource) return;
+  const source = new EventSource("/api/public/stream");
+  source.addEventListener("public_message", (e) =>
+    prependMessage("publicMessageList", JSON.parse(e.data), publicMessageHtml)
+  );
+  source.addEventListener("user_message", (e) =>
+    prependMessage("userMessageList", JSON.parse(e.data), userMessageHtml)
+  );
+  source.addEventListener("public_message_removed", (e) => {
+    const { id } = JSON.parse(e.data);
+    document.querySelector(`#publicMessageList [data-id="${id}"]`)?.remove();
+  });
+  source.addEventListener("public_message_restored", loadPublicMessages);
+  source.addEventListener("reset", () => {
+    loadPublicMessages();
+    loadPublicUserMessages();
+  });
 }
 
 function setupPublicMessageForm() {
@@ -177,6 +238,13 @@ function requireUser() {
 }
 
 function logoutUser() {
+  if (state.userToken) {
+    // 通知服务端作废令牌，失败也不影响本地退出
+    api("/api/auth/logout", {
+      method: "POST",
+      headers: { Authorization: `Bearer ${state.userToken}` },
+    }).catch(() => {});
+  }
   state.userToken = "";
   state.me = null;
   localStorage.removeItem("userToken");
@@ -282,9 +350,9 @@ function bindAuthForms() {
   }
 }
 
-async function loadSecretArea() {
+async function loadSecretArea(before = "") {
   if (!requireUser()) return;
-  const res = await api("/api/secret/diaries", {
+  const res = await api(pagePath("/api/secret/diaries", before), {
     headers: { Authorization: `Bearer ${state.userToken}` },
   });
   if (!res.ok) {
@@ -294,17 +362,22 @@ async function loadSecretArea() {
   const list = data.items || [];
   const wrap = document.getElementById("secretDiaryList");
   const adminWrap = document.getElementById("adminDiaryList");
-  if (wrap) wrap.innerHTML = "";
-  if (adminWrap) adminWrap.innerHTML = "";
+  if (!before) {
+    if (wrap) wrap.innerHTML = "";
+    if (adminWrap) adminWrap.innerHTML = "";
+  }
+  wrap?.querySelector(".load-more")?.remove();
   list.forEach((item) => {
     if (wrap) {
       const div = document.createElement("div");
       div.className = "diary-item";
+      div.dataset.diary = item.id;
       div.innerHTML = `
         <div class="title">${item.title}</div>
         <div class="muted">${formatLocalTime(item.created_at)} · ${item.author}</div>
-        <p>${item.content}</p>
+        <p class="diary-text">${item.excerpt}${item.truncated ? "…" : ""}</p>
         <div class="tools">
+          ${item.truncated ? `<span class="tool" data-action="expand" data-id="${item.id}">展开全文</span>` : ""}
           ${
             item.can_edit
               ? `<span class="tool" data-action="toggle" data-id="${item.id}" data-public="${item.is_public ? 1 : 0}">${
@@ -331,14 +404,16 @@ async function loadSecretArea() {
       adminWrap.appendChild(row);
     }
   });
+  if (wrap) renderLoadMore(wrap, data.next_cursor, loadSecretArea);
+  if (before) return;
   bindDiaryActions();
   bindAdminToggle();
   loadPrivateMessages();
 }
 
-async function loadAdminDiaries() {
+async function loadAdminDiaries(before = "") {
   if (!requireAdmin()) return;
-  const res = await api("/api/admin/diaries", {
+  const res = await api(pagePath("/api/admin/diaries", before), {
     headers: { Authorization: `Bearer ${state.adminToken}` },
   });
   if (!res.ok) return;
@@ -346,7 +421,7 @@ async function loadAdminDiaries() {
   const list = data.items || [];
   const adminWrap = document.getElementById("adminDiaryList");
   if (!adminWrap) return;
-  adminWrap.innerHTML = "";
+  if (!before) adminWrap.innerHTML = "";
   list.forEach((item) => {
     const row = document.createElement("div");
     row.className = "admin-row";
@@ -359,7 +434,8 @@ async function loadAdminDiaries() {
     `;
     adminWrap.appendChild(row);
   });
-  bindAdminToggle();
+  renderLoadMore(adminWrap, data.next_cursor, loadAdminDiaries);
+  if (!before) bindAdminToggle();
 }
 
 async function loadAdminMessages() {
@@ -402,15 +478,15 @@ async function loadAdminMessages() {
   }
 }
 
-async function loadAdminUsers() {
+async function loadAdminUsers(before = "") {
   const wrap = document.getElementById("adminUsers");
   if (!wrap || !requireAdmin()) return;
-  const res = await api("/api/admin/users", {
+  const res = await api(pagePath("/api/admin/users", before), {
     headers: { Authorization: `Bearer ${state.adminToken}` },
   });
   if (!res.ok) return;
   const data = await res.json();
-  wrap.innerHTML = (data.items || [])
+  const html = (data.items || [])
     .map(
       (u) => `
         <div class="admin-row">
@@ -422,6 +498,13 @@ async function loadAdminUsers() {
         </div>`
     )
     .join("");
+  if (before) {
+    wrap.querySelector(".load-more")?.remove();
+    wrap.insertAdjacentHTML("beforeend", html);
+  } else {
+    wrap.innerHTML = html;
+  }
+  renderLoadMore(wrap, data.next_cursor, loadAdminUsers);
 }
 
 function bindAdminMessageActions() {
@@ -472,6 +555,10 @@ function bindDiaryActions() {
     const action = e.target.dataset.action;
     if (!action) return;
     const id = e.target.dataset.id;
+    if (action === "expand") {
+      await expandDiary(e.target, `/api/secret/diaries/${id}`, state.userToken);
+      return;
+    }
     if (action === "delete") {
       if (!e.target.dataset.canEdit) return;
       await api(`/api/secret/diaries/${id}`, {
@@ -533,6 +620,46 @@ function bindDiaryForm() {
   });
 }
 
+// 搜索自己的日记：服务端按相关度排序并用 <mark> 标出命中片段，清空关键词回到完整列表
+async function searchSecretDiaries(q, cursor = "") {
+  const wrap = document.getElementById("secretDiaryList");
+  if (!wrap || !requireUser()) return;
+  const params = new URLSearchParams({ q });
+  if (cursor) params.set("cursor", cursor);
+  const res = await api(`/api/secret/search/diaries?${params}`, {
+    headers: { Authorization: `Bearer ${state.userToken}` },
+  });
+  const data = await res.json();
+  if (!res.ok) {
+    wrap.innerHTML = `<p class="muted">${data.error || "搜索失败"}</p>`;
+    return;
+  }
+  if (!cursor) wrap.innerHTML = data.items.length ? "" : '<p class="muted">没有找到相关日记</p>';
+  wrap.querySelector(".load-more")?.remove();
+  data.items.forEach((item) => {
+    const div = document.createElement("div");
+    div.className = "diary-item";
+    div.innerHTML = `
+      <div class="title">${item.title}</div>
+      <div class="muted">${formatLocalTime(item.created_at)} · ${item.is_public ? "公开" : "私密"}</div>
+      <p>${item.snippet}</p>
+    `;
+    wrap.appendChild(div);
+  });
+  renderLoadMore(wrap, data.next_cursor, (next) => searchSecretDiaries(q, next));
+}
+
+function bindDiarySearch() {
+  const form = document.getElementById("diarySearchForm");
+  if (!form) return;
+  form.addEventListener("submit", (e) => {
+    e.preventDefault();
+    const q = form.q.value.trim();
+    if (q) searchSecretDiaries(q);
+    else loadSecretArea();
+  });
+}
+
 function bindPrivateMessageForm() {
   const form = document.getElementById("privateMessageForm");
   const hint = document.getElementById("privateHint");
@@ -723,7 +850,9 @@ function init() {
     loadPublicDiaries();
     loadPublicMessages();
     loadPublicUserMessages();
+    subscribeLiveFeed();
     setupPublicMessageForm();
+    bindPublicDiaryExpand();
     const refresh = document.getElementById("refreshDiaries");
     if (refresh) refresh.addEventListener("click", loadPublicDiaries);
   }
@@ -733,6 +862,7 @@ function init() {
     setupSecretModal();
     bindAuthForms();
     bindDiaryForm();
+    bindDiarySearch();
     bindPrivateMessageForm();
     bindUserMessageForm();
   }
@@ -1,11 +1,17 @@
 """Simple Flask backend for forwarding contact form messages to email.
 
+Submissions are queued in a local outbox (see mail_outbox.py) and mailed by a
+background sender, so the request never waits on the mail server.
+
 The service expects SMTP credentials from environment variables:
 - SMTP_HOST: SMTP server host
 - SMTP_PORT: SMTP server port (default: 587)
 - SMTP_USER: SMTP username / from address
 - SMTP_PASSWORD: SMTP password or app token
+- SMTP_SECURITY: starttls (default), ssl, or none for a local test server (login only if SMTP_PASSWORD is set)
 - CONTACT_TO: Recipient email (defaults to SMTP_USER when unset)
+- OUTBOX_PATH: outbox database (default: outbox.db next to this file)
+- OUTBOX_METRICS_TOKEN: if set, required as a Bearer token by /api/contact/outbox
 
 Run locally:
     pip install -r requirements.txt
@@ -14,20 +20,20 @@ Run locally:
 from __future__ import annotations
 
 import os
-import smtplib
-import ssl
+import secrets
 from email.message import EmailMessage
+from pathlib import Path
 from typing import Dict
 
 from flask import Flask, jsonify, request
 from flask_cors import CORS
 
+from mail_outbox import ConfigError, MailOutbox, SmtpSettings
+
 app = Flask(__name__)
 CORS(app, resources={r"/api/*": {"origins": "*"}})
 
-
-class ConfigError(RuntimeError):
-    """Raised when required email configuration is missing."""
+OUTBOX = MailOutbox(os.environ.get("OUTBOX_PATH") or Path(__file__).with_name("outbox.db"))
 
 
 def build_email_payload(data: Dict[str, str]) -> EmailMessage:
@@ -57,20 +63,11 @@ def build_email_payload(data: Dict[str, str]) -> EmailMessage:
     return email_msg
 
 
-def send_email(msg: EmailMessage) -> None:
-    smtp_host = os.environ.get("SMTP_HOST")
-    smtp_port = int(os.environ.get("SMTP_PORT", "587"))
-    smtp_user = os.environ.get("SMTP_USER")
-    smtp_password = os.environ.get("SMTP_PASSWORD")
-
-    if not smtp_host or not smtp_user or not smtp_password:
-        raise ConfigError("SMTP_HOST/SMTP_USER/SMTP_PASSWORD 配置缺失。")
-
-    context = ssl.create_default_context()
-    with smtplib.SMTP(smtp_host, smtp_port) as server:
-        server.starttls(context=context)
-        server.login(smtp_user, smtp_password)
-        server.send_message(msg)
+def queue_email(msg: EmailMessage) -> int:
+    # check the settings now so a misconfigured server still answers 400 instead of queueing forever
+    SmtpSettings.from_env()
+    OUTBOX.start()
+    return OUTBOX.enqueue(msg)
 
 
 @app.route("/api/contact", methods=["POST"])
@@ -83,13 +80,21 @@ def contact():
             "email": data.get("email", ""),
             "message": data.get("message", ""),
         })
-        send_email(email_message)
+        queue_email(email_message)
     except (ValueError, ConfigError) as exc:
         return jsonify({"message": str(exc)}), 400
     except Exception:
-        return jsonify({"message": "服务器发送邮件失败，请稍后再试。"}), 500
+        return jsonify({"message": "服务器保存留言失败，请稍后再试。"}), 500
+
+    return jsonify({"message": "留言已收到，会尽快转发到站长邮箱，感谢你的分享！"})
+
 
-    return jsonify({"message": "留言已发送到站长邮箱，感谢你的分享！"})
+@app.route("/api/contact/outbox", methods=["GET"])
+def contact_outbox():
+    token = os.environ.get("OUTBOX_METRICS_TOKEN")
+    if token and not secrets.compare_digest(request.headers.get("Authorization", ""), f"Bearer {token}"):
+        return jsonify({"message": "未授权。"}), 401
+    return jsonify(OUTBOX.stats())
 
 
 if __name__ == "__main__":
@@ -0,0 +1,75 @@
+import json
+import sys
+import threading
+import urllib.error
+import urllib.request
+from pathlib import Path
+
+import pytest
+
+# the modules under test live at the repository root, next to this directory
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+import journal  # noqa: E402
+
+
+@pytest.fixture
+def garden_db(tmp_path, monkeypatch):
+    """A freshly initialised database that get_db() hands out for the test."""
+    path = tmp_path / "garden.db"
+    monkeypatch.setattr(journal, "DB_PATH", path)
+    monkeypatch.setattr(journal, "RATE_LIMITER", journal.RateLimiter(journal.RATE_POLICIES))
+    monkeypatch.setattr(journal, "RESPONSE_CACHE", journal.ResponseCache())
+    journal.init_db()
+    yield path
+    journal.close_db_connections()
+
+
+class GardenClient:
+    """JSON requests against a server started by the ``garden_server`` fixture."""
+
+    def __init__(self, base):
+        self.base = base
+
+    def call(self, method, path, body=None, token=None, headers=None):
+        status, _, data = self.request(method, path, body, token, headers)
+        return status, data
+
+    def request(self, method, path, body=None, token=None, headers=None):
+        """Like ``call`` but also return the response headers."""
+        headers = {"Content-Type": "application/json", **(headers or {})}
+        if token:
+            headers["Authorization"] = f"Bearer {token}"
+        data = json.dumps(body).encode() if body is not None else None
+        request = urllib.request.Request(self.base + path, data=data, method=method, headers=headers)
+        try:
+            with urllib.request.urlopen(request, timeout=10) as response:
+                status, response_headers, raw = response.status, response.headers, response.read()
+        except urllib.error.HTTPError as exc:
+            status, response_headers, raw = exc.code, exc.headers, exc.read()
+        return status, response_headers, json.loads(raw) if raw else None
+
+    def admin(self):
+        status, data = self.call("POST", "/api/admin/login", {"username": "admin", "password": "garden-admin"})
+        assert status == 200, data
+        return data["token"]
+
+    def register(self, username, password="secret1"):
+        status, data = self.call(
+            "POST",
+            "/api/auth/register",
+            {"username": username, "password": password, "confirm_password": password},
+        )
+        assert status == 201, data
+        return data["token"]
+
+
+@pytest.fixture
+def garden_server(garden_db, monkeypatch):
+    monkeypatch.setattr(journal.GardenHandler, "log_message", lambda *args: None)
+    server = journal.make_server("threaded", "127.0.0.1", 0, workers=4, backlog=16)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield GardenClient(f"http://127.0.0.1:{server.server_address[1]}")
+    server.shutdown()
+    server.server_close()
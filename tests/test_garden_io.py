@@ -0,0 +1,137 @@
+"""Round trips through garden_io export/import."""
+
+import garden_io
+import journal
+
+TABLES = tuple(garden_io.IO_TABLES)
+
+
+def populate(db_path):
+    conn = journal.connect_db(db_path)
+    conn.executemany(
+        "INSERT INTO users (username, role, password_hash) VALUES (?, 'user', 'x')", [("alice",), ("bob",)]
+    )
+    conn.executemany(
+        "INSERT INTO diaries (author_name, title, content, is_public) VALUES (?, ?, ?, ?)",
+        [("alice", "月光", "花园里的月光很亮", 1), ("bob", "小径", "萤火虫" * 100, 0)],
+    )
+    conn.executemany("INSERT INTO messages_public (nickname, content) VALUES (?, ?)", [("游客", "你好花园")])
+    conn.executemany("INSERT INTO messages_private (from_name, to_name, content) VALUES (?, ?, ?)", [("alice", "bob", "hi")])
+    conn.executemany("INSERT INTO messages_user (username, content) VALUES (?, ?)", [("bob", "留言")])
+    conn.commit()
+    conn.close()
+
+
+def dump(db_path):
+    conn = journal.connect_db(db_path)
+    rows = {
+        table: conn.execute(f"SELECT {', '.join(columns)} FROM {table} ORDER BY id").fetchall()
+        for table, columns in garden_io.IO_TABLES.items()
+    }
+    conn.close()
+    return rows
+
+
+def check_consistent(db_path):
+    """Counters, search index and schema match the imported rows."""
+    conn = journal.connect_db(db_path)
+    cur = conn.cursor()
+    cur.execute("BEGIN IMMEDIATE")
+    assert journal._recount_stats(cur) == {}
+    conn.rollback()
+    assert not garden_io.has_deferred_schema(conn)
+    for table, _, _ in journal.FTS_TABLES:
+        assert conn.execute(f"SELECT COUNT(*) FROM {table}_fts").fetchone()[0] == (
+            conn.execute(f"SELECT COUNT(*) FROM {table}").fetchone()[0]
+        )
+    indexes = {row[0] for row in conn.execute("SELECT name FROM sqlite_master WHERE type='index'")}
+    assert {"idx_diaries_public_created", "idx_diaries_author_created", "idx_diaries_created"} <= indexes
+    hits = conn.execute(
+        "SELECT COUNT(*) FROM diaries_fts WHERE diaries_fts MATCH ?", (journal.fts_query("月光"),)
+    ).fetchone()[0]
+    expected = conn.execute("SELECT COUNT(*) FROM diaries WHERE title || content LIKE '%月光%'").fetchone()[0]
+    conn.close()
+    assert hits == expected > 0
+
+
+def test_offline_round_trip(garden_db, tmp_path):
+    populate(garden_db)
+    backup = tmp_path / "backup"
+    garden_io.main(["export", "all", str(backup), "--db", str(garden_db), "--quiet"])
+    assert {path.name for path in backup.iterdir()} == {f"{table}.ndjson" for table in TABLES}
+
+    target = tmp_path / "copy.db"
+    garden_io.main(["import", "all", str(backup), "--db", str(target), "--quiet"])
+    assert dump(target) == dump(garden_db)
+    check_consistent(target)
+
+
+def test_csv_gz_round_trip(garden_db, tmp_path):
+    populate(garden_db)
+    path = tmp_path / "diaries.csv.gz"
+    garden_io.main(["export", "diaries", str(path), "--db", str(garden_db), "--quiet"])
+    target = tmp_path / "copy.db"
+    garden_io.main(["import", "diaries", str(path), "--db", str(target), "--quiet"])
+    assert dump(target)["diaries"] == dump(garden_db)["diaries"]
+    check_consistent(target)
+
+
+def test_online_import_keeps_counters_in_step(garden_db, tmp_path):
+    populate(garden_db)
+    path = tmp_path / "diaries.ndjson"
+    garden_io.main(["export", "diaries", str(path), "--db", str(garden_db), "--quiet"])
+    conn = journal.connect_db(garden_db)
+    conn.execute("UPDATE diaries SET is_public=0")
+    conn.commit()
+    conn.close()
+
+    garden_io.main(["import", "diaries", str(path), "--db", str(garden_db), "--online", "--on-conflict", "skip", "--quiet"])
+    assert sum(row[4] for row in dump(garden_db)["diaries"]) == 0
+    check_consistent(garden_db)
+
+    garden_io.main(
+        ["import", "diaries", str(path), "--db", str(garden_db), "--online", "--on-conflict", "replace", "--quiet"]
+    )
+    conn = journal.connect_db(garden_db)
+    counts = dict(conn.execute("SELECT name, value FROM stats"))
+    actual = conn.execute("SELECT COUNT(*), SUM(is_public) FROM diaries").fetchone()
+    conn.close()
+    assert (counts["diaries"], counts["diaries_public"]) == actual == (5, 3)
+    check_consistent(garden_db)
+
+
+def test_online_import_aborts_on_duplicate_ids(garden_db, tmp_path):
+    populate(garden_db)
+    path = tmp_path / "users.ndjson"
+    garden_io.main(["export", "users", str(path), "--db", str(garden_db), "--quiet"])
+    try:
+        garden_io.main(["import", "users", str(path), "--db", str(garden_db), "--online", "--quiet"])
+    except SystemExit as exc:
+        assert "on-conflict" in str(exc)
+    else:
+        raise AssertionError("duplicate ids were imported")
+    check_consistent(garden_db)
+
+
+def test_new_database_keeps_seed_rows_of_tables_not_imported(garden_db, tmp_path):
+    populate(garden_db)
+    path = tmp_path / "messages_public.ndjson"
+    garden_io.main(["export", "messages_public", str(path), "--db", str(garden_db), "--quiet"])
+    target = tmp_path / "copy.db"
+    garden_io.main(["import", "messages_public", str(path), "--db", str(target), "--quiet"])
+    rows = dump(target)
+    assert [row[1] for row in rows["users"]] == ["admin"]
+    assert len(rows["diaries"]) == 3
+    assert rows["messages_public"] == dump(garden_db)["messages_public"]
+    check_consistent(target)
+
+
+def test_new_database_drops_seed_rows_of_imported_tables(garden_db, tmp_path):
+    populate(garden_db)
+    path = tmp_path / "diaries.ndjson"
+    garden_io.main(["export", "diaries", str(path), "--db", str(garden_db), "--quiet"])
+    target = tmp_path / "copy.db"
+    garden_io.main(["import", "diaries", str(path), "--db", str(target), "--quiet"])
+    rows = dump(target)
+    assert rows["diaries"] == dump(garden_db)["diaries"]
+    assert [row[1] for row in rows["users"]] == ["admin"]
@@ -0,0 +1,96 @@
+"""WriteBatcher: concurrent inserts sharing one transaction."""
+
+import sqlite3
+import threading
+import time
+
+import pytest
+
+import journal
+
+INSERT_MESSAGE = "INSERT INTO messages_public (nickname, content) VALUES (?, ?) RETURNING id"
+INSERT_USER = "INSERT INTO users (username, role) VALUES (?, 'user') RETURNING id"
+
+
+def run_concurrently(batcher, writes):
+    """execute() every (sql, params) from its own thread; return results or exceptions in order."""
+    results = [None] * len(writes)
+
+    def write(index, sql, params):
+        try:
+            results[index] = batcher.execute(sql, params)
+        except Exception as exc:
+            results[index] = exc
+
+    threads = [threading.Thread(target=write, args=(i, *w), daemon=True) for i, w in enumerate(writes)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join(10)
+    return results
+
+
+def test_failing_row_only_fails_its_own_caller(garden_db):
+    batcher = journal.WriteBatcher(window=0.3).start()
+    try:
+        results = run_concurrently(
+            batcher,
+            [(INSERT_USER, ("carol",)), (INSERT_USER, ("admin",)), (INSERT_MESSAGE, ("n", "hi"))],
+        )
+    finally:
+        batcher.stop()
+    assert isinstance(results[1], sqlite3.IntegrityError)
+    assert isinstance(results[0], tuple) and isinstance(results[2], tuple)
+    assert batcher.stats()["batches"] == 1
+    conn = journal.connect_db()
+    assert conn.execute("SELECT COUNT(*) FROM users WHERE username='carol'").fetchone()[0] == 1
+    assert conn.execute("SELECT COUNT(*) FROM messages_public").fetchone()[0] == 1
+    conn.close()
+
+
+def test_full_queue_sheds_only_the_overflowing_caller(garden_db):
+    batcher = journal.WriteBatcher(window=1, max_pending=2).start()
+    try:
+        waiting = [threading.Thread(target=batcher.execute, args=(INSERT_MESSAGE, ("n", str(i)))) for i in range(2)]
+        for thread in waiting:
+            thread.start()
+        deadline = time.monotonic() + 5
+        while batcher.stats()["queued"] < 2 and time.monotonic() < deadline:
+            time.sleep(0.01)
+        with pytest.raises(journal.WriteOverloaded):
+            batcher.execute(INSERT_MESSAGE, ("n", "overflow"))
+        for thread in waiting:
+            thread.join(10)
+    finally:
+        batcher.stop()
+    assert batcher.stats()["shed"] == 1
+    conn = journal.connect_db()
+    assert [row[0] for row in conn.execute("SELECT content FROM messages_public ORDER BY id")] == ["0", "1"]
+    conn.close()
+
+
+def test_dead_writer_releases_queued_callers(garden_db, monkeypatch):
+    release = threading.Event()
+    real_connect = journal.connect_db
+
+    def broken_connect(path=None):
+        release.wait(5)
+        raise sqlite3.OperationalError("unable to open database file")
+
+    monkeypatch.setattr(journal, "connect_db", broken_connect)
+    batcher = journal.WriteBatcher().start()
+    results = []
+    caller = threading.Thread(
+        target=lambda: results.extend(run_concurrently(batcher, [(INSERT_MESSAGE, ("n", "x"))])), daemon=True
+    )
+    caller.start()
+    while not batcher.stats()["queued"]:
+        time.sleep(0.01)
+    release.set()
+    caller.join(5)
+    assert not caller.is_alive()
+    assert isinstance(results[0], journal.WriteOverloaded)
+    assert batcher.stats()["running"] is False
+    # with the writer gone, writes commit on the caller's connection again
+    monkeypatch.setattr(journal, "connect_db", real_connect)
+    assert batcher.execute(INSERT_MESSAGE, ("n", "y"))[0] >= 1
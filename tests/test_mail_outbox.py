@@ -0,0 +1,259 @@
+"""MailOutbox against an in-process stand-in SMTP server."""
+
+import socketserver
+import threading
+import time
+from email import message_from_bytes
+from email import policy as email_policy
+from email.message import EmailMessage
+
+import pytest
+
+import mail_outbox
+
+
+class StandInSmtp(socketserver.ThreadingTCPServer):
+    """Just enough SMTP to accept mail; ``transient``/``permanent`` recipients are refused."""
+
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, auth=True):
+        super().__init__(("127.0.0.1", 0), StandInHandler)
+        self.auth = auth
+        self.messages = []
+        self.connects = 0
+        self.logins = 0
+        self.transient_left = 0  # RCPTs to transient@ answered 451 before they are accepted
+
+    @property
+    def port(self):
+        return self.server_address[1]
+
+    def received(self):
+        return [message_from_bytes(data, policy=email_policy.default) for data in self.messages]
+
+
+class StandInHandler(socketserver.StreamRequestHandler):
+    def say(self, line):
+        self.wfile.write(line.encode() + b"\r\n")
+
+    def handle(self):
+        server = self.server
+        server.connects += 1
+        self.say("220 stand-in")
+        while True:
+            line = self.rfile.readline()
+            if not line:
+                return
+            command = line.decode().strip()
+            verb = command.split(" ", 1)[0].upper()
+            if verb == "EHLO":
+                self.say("250-stand-in")
+                self.say("250 AUTH PLAIN LOGIN" if server.auth else "250 8BITMIME")
+            elif verb == "AUTH":
+                server.logins += 1
+                self.say("235 ok" if server.auth else "502 not supported")
+            elif verb == "RCPT" and "permanent@" in command:
+                self.say("550 no such user")
+            elif verb == "RCPT" and "transient@" in command and server.transient_left:
+                server.transient_left -= 1
+                self.say("451 try again later")
+            elif verb == "DATA":
+                self.say("354 go ahead")
+                lines = []
+                while (line := self.rfile.readline()) != b".\r\n":
+                    lines.append(line[1:] if line.startswith(b".") else line)
+                server.messages.append(b"".join(lines))
+                self.say("250 queued")
+            elif verb == "QUIT":
+                self.say("221 bye")
+                return
+            else:
+                self.say("250 ok")
+
+
+def serve(server):
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+@pytest.fixture
+def smtp_server():
+    server = serve(StandInSmtp())
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+@pytest.fixture
+def open_smtp_server():
+    server = serve(StandInSmtp(auth=False))
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+def session_for(server, user="me@example.com", password="pw"):
+    settings = mail_outbox.SmtpSettings("127.0.0.1", server.port, user, password, "none")
+    return mail_outbox.SmtpSession(lambda: settings)
+
+
+def outbox_for(server, tmp_path, session=None, **options):
+    return mail_outbox.MailOutbox(tmp_path / "outbox.db", session=session or session_for(server), **options)
+
+
+def message(to="you@example.com", subject="新的留言"):
+    msg = EmailMessage()
+    msg["Subject"] = subject
+    msg["From"] = "me@example.com"
+    msg["To"] = to
+    msg.set_content("你好\n.a line starting with a dot")
+    return msg
+
+
+def wait_for(condition, timeout=10):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if condition():
+            return True
+        time.sleep(0.02)
+    return False
+
+
+def test_expired_lease_is_not_sent_by_its_old_holder(smtp_server, tmp_path):
+    first = outbox_for(smtp_server, tmp_path)
+    second = mail_outbox.MailOutbox(tmp_path / "outbox.db", session=session_for(smtp_server))
+    first.enqueue(message())
+    old_token, [(outbox_id, raw, attempts)] = first._claim()
+    # the first sender stalled past its lease and the second one took the message over
+    with first._db() as conn:
+        conn.execute("UPDATE outbox SET next_attempt_at = 0 WHERE id = ?", (outbox_id,))
+    new_token, claimed = second._claim()
+    assert [row[0] for row in claimed] == [outbox_id]
+
+    first._deliver(outbox_id, raw, attempts, old_token)
+    assert smtp_server.messages == [] and first.lost == 1
+    second._deliver(outbox_id, raw, attempts, new_token)
+    assert len(smtp_server.messages) == 1 and second.stats()["sent_kept"] == 1
+
+
+def test_lease_is_renewed_before_each_message(smtp_server, tmp_path, monkeypatch):
+    outbox = outbox_for(smtp_server, tmp_path)
+    for _ in range(2):
+        outbox.enqueue(message())
+    token, claimed = outbox._claim()
+    outbox._deliver(*claimed[0], token)
+    with outbox._db() as conn:
+        # the rest of the batch is close to expiring by the time its turn comes
+        conn.execute("UPDATE outbox SET next_attempt_at = ? WHERE id = ?", (time.time() + 1, claimed[1][0]))
+    renewed = []
+    real_send = outbox.session.send
+
+    def send(msg):
+        with outbox._db() as conn:
+            renewed.append(conn.execute("SELECT next_attempt_at FROM outbox WHERE id = ?", (claimed[1][0],)).fetchone()[0])
+        real_send(msg)
+
+    monkeypatch.setattr(outbox.session, "send", send)
+    outbox._deliver(*claimed[1], token)
+    assert renewed[0] > time.time() + mail_outbox.OUTBOX_LEASE - 60
+    assert len(smtp_server.messages) == 2
+
+
+def test_two_senders_deliver_every_message_once(smtp_server, tmp_path):
+    first = outbox_for(smtp_server, tmp_path, batch=3).start()
+    second = mail_outbox.MailOutbox(tmp_path / "outbox.db", session=session_for(smtp_server), batch=3).start()
+    try:
+        for index in range(40):
+            (first if index % 2 else second).enqueue(message(subject=f"#{index}"))
+        assert wait_for(lambda: len(smtp_server.messages) >= 40)
+        time.sleep(0.3)
+    finally:
+        first.stop()
+        second.stop()
+    subjects = sorted(msg["Subject"] for msg in smtp_server.received())
+    assert subjects == sorted(f"#{index}" for index in range(40))
+
+
+def test_settings_need_credentials_unless_security_is_none(monkeypatch):
+    for name in ("SMTP_PORT", "SMTP_USER", "SMTP_PASSWORD", "SMTP_SECURITY"):
+        monkeypatch.delenv(name, raising=False)
+    monkeypatch.setenv("SMTP_HOST", "127.0.0.1")
+    with pytest.raises(mail_outbox.ConfigError):
+        mail_outbox.SmtpSettings.from_env()
+    monkeypatch.setenv("SMTP_SECURITY", "none")
+    settings = mail_outbox.SmtpSettings.from_env()
+    assert (settings.user, settings.password, settings.port) == ("", "", 587)
+    monkeypatch.delenv("SMTP_HOST")
+    with pytest.raises(mail_outbox.ConfigError):
+        mail_outbox.SmtpSettings.from_env()
+
+
+def test_batch_goes_out_over_one_connection_without_login(open_smtp_server, tmp_path):
+    outbox = outbox_for(open_smtp_server, tmp_path, session=session_for(open_smtp_server, "", ""))
+    for index in range(5):
+        outbox.enqueue(message(subject=f"#{index}"))
+    assert outbox.stats()["pending"] == 5
+    outbox.start()
+    try:
+        assert wait_for(lambda: outbox.stats()["pending"] == 0)
+    finally:
+        outbox.stop()
+    assert open_smtp_server.connects == 1 and open_smtp_server.logins == 0
+    received = open_smtp_server.received()
+    assert sorted(msg["Subject"] for msg in received) == [f"#{index}" for index in range(5)]
+    assert "\n.a line starting with a dot" in received[0].get_content()
+
+
+def test_login_happens_once_per_connection(smtp_server, tmp_path):
+    outbox = outbox_for(smtp_server, tmp_path).start()
+    try:
+        for index in range(3):
+            outbox.enqueue(message(subject=f"#{index}"))
+        assert wait_for(lambda: len(smtp_server.messages) == 3)
+    finally:
+        outbox.stop()
+    assert smtp_server.connects == 1 and smtp_server.logins == 1
+
+
+def test_transient_failure_is_retried_with_backoff(smtp_server, tmp_path):
+    smtp_server.transient_left = 2
+    outbox = outbox_for(smtp_server, tmp_path, retry_base=0.2)
+    outbox_id = outbox.enqueue(message(to="transient@example.com"))
+    token, [claimed] = outbox._claim()
+    # the retry delay doubles: 0.2s then 0.4s, each with +-20% jitter
+    for attempt, (shortest, longest) in enumerate([(0.16, 0.24), (0.32, 0.48)], 1):
+        before = time.time()
+        outbox._deliver(*claimed, token)
+        after = time.time()
+        with outbox._db() as conn:
+            status, attempts, next_attempt_at = conn.execute(
+                "SELECT status, attempts, next_attempt_at FROM outbox WHERE id = ?", (outbox_id,)
+            ).fetchone()
+        assert status == "pending" and attempts == attempt
+        # the delay was added to a clock reading taken somewhere between before and after
+        assert next_attempt_at - after <= longest and next_attempt_at - before >= shortest
+        claimed = (outbox_id, claimed[1], attempts)
+    assert outbox.stats()["retrying"] == 1
+
+    outbox.start()
+    try:
+        assert wait_for(lambda: outbox.stats()["pending"] == 0)
+    finally:
+        outbox.stop()
+    assert len(smtp_server.messages) == 1
+
+
+def test_permanent_failure_is_not_retried(smtp_server, tmp_path):
+    outbox = outbox_for(smtp_server, tmp_path, retry_base=0.05).start()
+    try:
+        outbox.enqueue(message(to="permanent@example.com"))
+        outbox.enqueue(message())
+        assert wait_for(lambda: outbox.stats()["failed"] == 1 and outbox.stats()["pending"] == 0)
+        time.sleep(0.2)
+    finally:
+        outbox.stop()
+    with outbox._db() as conn:
+        assert conn.execute("SELECT attempts FROM outbox WHERE status = 'failed'").fetchone()[0] == 1
+    assert len(smtp_server.messages) == 1
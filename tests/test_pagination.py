@@ -0,0 +1,47 @@
+"""Query-string parsing of the paged list and search endpoints."""
+
+import base64
+import json
+
+import pytest
+
+import journal
+
+
+def encode(value):
+    return base64.urlsafe_b64encode(json.dumps(value).encode()).decode().rstrip("=")
+
+
+def test_cursor_round_trip():
+    cursor = journal.encode_cursor("2024-01-01 00:00:00", 7)
+    assert journal.decode_cursor(cursor) == ("2024-01-01 00:00:00", 7)
+
+
+@pytest.mark.parametrize("value", [5, "x", None, {"a": 1}, [1, 2, 3], ["2024-01-01", "7"]])
+def test_cursor_of_wrong_shape_is_a_bad_request(value):
+    with pytest.raises(journal.BadRequest):
+        journal.decode_cursor(encode(value))
+
+
+@pytest.mark.parametrize("cursor", ["%%%", "bm90IGpzb24"])
+def test_undecodable_cursor_is_a_bad_request(cursor):
+    with pytest.raises(journal.BadRequest):
+        journal.decode_cursor(cursor)
+
+
+@pytest.mark.parametrize("limit", ["0", "-1", "abc", "²", "١٢"])
+def test_invalid_limit_is_a_bad_request(limit):
+    with pytest.raises(journal.BadRequest):
+        journal.page_limit({"limit": [limit]}, (10, 50))
+
+
+def test_limit_defaults_and_caps():
+    assert journal.page_limit({}, (10, 50)) == 10
+    assert journal.page_limit({"limit": ["20"]}, (10, 50)) == 20
+    assert journal.page_limit({"limit": ["999"]}, (10, 50)) == 50
+
+
+@pytest.mark.parametrize("cursor", ["²", "-1", "x"])
+def test_invalid_search_cursor_is_a_bad_request(cursor):
+    with pytest.raises(journal.BadRequest):
+        journal.search_params({"q": ["花"], "cursor": [cursor]})
@@ -0,0 +1,92 @@
+"""Smoke test of ``--processes``: the supervisor replaces a worker that dies."""
+
+import os
+import signal
+import socket
+import subprocess
+import sys
+import time
+from pathlib import Path
+
+import pytest
+
+from conftest import GardenClient
+
+ROOT = Path(__file__).resolve().parent.parent
+
+pytestmark = pytest.mark.skipif(not Path("/proc/self/stat").exists(), reason="finds the workers through /proc")
+
+
+def children_of(pid):
+    children = set()
+    for stat in Path("/proc").glob("[0-9]*/stat"):
+        try:
+            fields = stat.read_text().rsplit(")", 1)[1].split()
+        except OSError:
+            continue  # the process went away while we looked
+        if int(fields[1]) == pid and fields[0] != "Z":
+            children.add(int(stat.parent.name))
+    return children
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def wait_for(condition, timeout=20):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            result = condition()
+        except OSError:
+            result = None
+        if result:
+            return result
+        time.sleep(0.1)
+    return None
+
+
+@pytest.fixture
+def supervisor(tmp_path):
+    port = free_port()
+    command = [sys.executable, str(ROOT / "journal.py"), "--processes", "2", "--mode", "threaded"]
+    command += ["--host", "127.0.0.1", "--port", str(port), "--db", str(tmp_path / "garden.db")]
+    with open(tmp_path / "supervisor.log", "w") as log:
+        process = subprocess.Popen(command, cwd=ROOT, stdout=log, stderr=subprocess.STDOUT)
+    client = GardenClient(f"http://127.0.0.1:{port}")
+    try:
+        assert wait_for(lambda: len(children_of(process.pid)) == 2 and client.call("GET", "/api/public/diaries")[0] == 200)
+        yield process, client
+    finally:
+        process.send_signal(signal.SIGTERM)
+        try:
+            process.wait(30)
+        except subprocess.TimeoutExpired:
+            process.kill()
+            process.wait()
+        print((tmp_path / "supervisor.log").read_text())
+
+
+def test_killed_worker_is_respawned_and_requests_keep_succeeding(supervisor):
+    process, client = supervisor
+    status, data = client.call("POST", "/api/admin/login", {"username": "admin", "password": "garden-admin"})
+    assert status == 200, data
+    admin = data["token"]
+    original = children_of(process.pid)
+    victim = min(original)
+
+    os.kill(victim, signal.SIGKILL)
+    for _ in range(20):
+        assert client.call("GET", "/api/public/diaries")[0] == 200
+    replacement = wait_for(lambda: children_of(process.pid) - original)
+    assert replacement and victim not in children_of(process.pid)
+
+    # the new worker serves requests off the shared socket, sessions and all
+    (new_pid,) = replacement
+    assert wait_for(lambda: client.call("GET", "/api/admin/metrics", token=admin)[1]["pid"] == new_pid)
+    token = client.register("after-restart")
+    status, _ = client.call("POST", "/api/secret/diaries", {"title": "still here", "content": "ok"}, token=token)
+    assert status == 201
+    assert process.poll() is None
@@ -0,0 +1,64 @@
+"""Token-bucket limits in front of the public message and auth endpoints."""
+
+import pytest
+
+import journal
+
+
+@pytest.mark.parametrize("backend", ["memory", "sqlite"])
+def test_refund_returns_the_token(garden_db, backend):
+    limiter = journal.RateLimiter(journal.RATE_POLICIES, backend=backend)
+    assert limiter.hit("public_message", "10.0.0.1") == 0
+    assert limiter.hit("public_message", "10.0.0.1") > 0
+    limiter.refund("public_message", "10.0.0.1")
+    assert limiter.hit("public_message", "10.0.0.1") == 0
+
+
+@pytest.mark.parametrize("backend", ["memory", "sqlite"])
+def test_refund_never_exceeds_capacity(garden_db, backend):
+    limiter = journal.RateLimiter(journal.RATE_POLICIES, backend=backend)
+    assert limiter.hit("public_message", "10.0.0.2") == 0
+    limiter.refund("public_message", "10.0.0.2")
+    limiter.refund("public_message", "10.0.0.2")
+    assert limiter.hit("public_message", "10.0.0.2") == 0
+    assert limiter.hit("public_message", "10.0.0.2") > 0
+
+
+def test_rejected_message_does_not_use_up_the_quota(garden_server):
+    status, data = garden_server.call("POST", "/api/public/messages", {"nickname": "a", "content": ""})
+    assert status == 400, data
+    status, data = garden_server.call("POST", "/api/public/messages", {"nickname": "a", "content": "x" * 300})
+    assert status == 400, data
+    status, data = garden_server.call("POST", "/api/public/messages", {"nickname": "a", "content": "你好"})
+    assert status == 201, data
+    status, data = garden_server.call("POST", "/api/public/messages", {"nickname": "a", "content": "再来"})
+    assert status == 429, data
+
+
+def overloaded(exc):
+    def raise_(*args, **kwargs):
+        raise exc
+
+    return raise_
+
+
+def test_shed_message_does_not_use_up_the_quota(garden_server, monkeypatch):
+    with monkeypatch.context() as patch:
+        patch.setattr(journal.WRITE_BATCHER, "execute", overloaded(journal.WriteOverloaded()))
+        for _ in range(3):
+            status, data = garden_server.call("POST", "/api/public/messages", {"nickname": "a", "content": "你好"})
+            assert status == 503, data
+    status, data = garden_server.call("POST", "/api/public/messages", {"nickname": "a", "content": "你好"})
+    assert status == 201, data
+
+
+def test_shed_login_does_not_use_up_the_quota(garden_server, monkeypatch):
+    garden_server.register("alice")
+    credentials = {"username": "alice", "password": "secret1"}
+    with monkeypatch.context() as patch:
+        patch.setattr(journal.SCRYPT_POOL, "verify", overloaded(journal.AuthOverloaded()))
+        for _ in range(journal.LOGIN_MAX_ATTEMPTS + 1):
+            status, data = garden_server.call("POST", "/api/auth/login", credentials)
+            assert status == 503, data
+    status, data = garden_server.call("POST", "/api/auth/login", credentials)
+    assert status == 200, data
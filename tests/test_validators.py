@@ -0,0 +1,65 @@
+"""Conditional GETs must never hide a write made in the same second."""
+
+import pytest
+
+ADMIN_LISTS = ["/api/admin/messages/public", "/api/admin/diaries", "/api/admin/users"]
+
+
+def post_message(client, content="你好"):
+    status, data = client.call("POST", "/api/public/messages", {"nickname": "游客", "content": content})
+    assert status == 201, data
+
+
+def test_hidden_message_shows_up_on_revalidation(garden_server):
+    admin = garden_server.admin()
+    post_message(garden_server)
+    status, headers, first = garden_server.request("GET", "/api/admin/messages/public", token=admin)
+    assert status == 200 and headers["ETag"].startswith("W/")
+    message_id = first["items"][0]["id"]
+    assert not first["items"][0]["is_hidden"]
+
+    status, _ = garden_server.call("PUT", f"/api/admin/messages/public/{message_id}", {"is_hidden": 1}, token=admin)
+    assert status == 200
+    for validator in ({"If-Modified-Since": headers["Last-Modified"]}, {"If-None-Match": headers["ETag"]}):
+        status, _, again = garden_server.request(
+            "GET", "/api/admin/messages/public", token=admin, headers=validator
+        )
+        assert status == 200
+        assert again["items"][0]["is_hidden"]
+
+
+@pytest.mark.parametrize("path", ADMIN_LISTS)
+def test_unchanged_admin_list_is_not_modified(garden_server, path):
+    admin = garden_server.admin()
+    status, headers, _ = garden_server.request("GET", path, token=admin)
+    assert status == 200
+    status, again, _ = garden_server.request("GET", path, token=admin, headers={"If-None-Match": headers["ETag"]})
+    assert status == 304 and again["ETag"] == headers["ETag"]
+    # another page of the same list is another representation
+    status, _, _ = garden_server.request(
+        "GET", path + "?limit=1", token=admin, headers={"If-None-Match": headers["ETag"]}
+    )
+    assert status == 200
+
+
+
+def test_public_list_sees_a_write_in_the_same_second(garden_server):
+    admin = garden_server.admin()
+    post_message(garden_server)
+    status, headers, first = garden_server.request("GET", "/api/public/messages")
+    assert status == 200 and len(first["items"]) == 1
+    message_id = first["items"][0]["id"]
+    status, _ = garden_server.call("PUT", f"/api/admin/messages/public/{message_id}", {"is_hidden": 1}, token=admin)
+    assert status == 200
+    status, _, again = garden_server.request(
+        "GET", "/api/public/messages", headers={"If-Modified-Since": headers["Last-Modified"]}
+    )
+    assert status == 200 and again["items"] == []
+
+
+def test_if_modified_since_after_the_last_write_is_not_modified(garden_server):
+    status, headers, _ = garden_server.request("GET", "/api/public/diaries")
+    assert status == 200
+    later = "Fri, 01 Jan 2100 00:00:00 GMT"
+    status, _, _ = garden_server.request("GET", "/api/public/diaries", headers={"If-Modified-Since": later})
+    assert status == 304